@@ -0,0 +1,92 @@
+"""
+Benchmark cluster labeling and summaries
+========================================
+
+Builds a smoothed noise z-map with thousands of suprathreshold clusters and
+times the per-cluster loops that report_first_level.py used (one full
+volume comparison for every cluster) against utils/clusters.py. The cluster
+volumes, sizes, voxel lists, peaks and means of both are checked to be
+identical.
+
+    python clusters.py --shape 91 109 91 --thr 1.5 --csize 5
+"""
+import argparse
+import os
+import sys
+import time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'utils'))
+import numpy as np
+from scipy import ndimage
+from clusters import label_clusters, cluster_summary
+
+
+def make_zmap(shape, fwhm=1.5, seed=0):
+    """Smoothed gaussian noise rescaled to unit variance"""
+    rng = np.random.RandomState(seed)
+    data = ndimage.gaussian_filter(rng.randn(*shape), fwhm / 2.3548)
+    return data / data.std()
+
+
+def naive_labels(data, thr, min_extent):
+    labels, nlabels = ndimage.label(abs(data) > thr)
+    for idx in range(1, nlabels + 1):
+        if np.sum(labels == idx) < min_extent:
+            labels[labels == idx] = 0
+    return labels
+
+
+def naive_summary(labels, data):
+    ids = np.setdiff1d(np.unique(labels.ravel()), [0])
+    sizes, voxels, peaks, means = [], [], [], []
+    for label in ids:
+        sizes.append(np.sum(labels == label))
+        coordinates = np.asarray(np.nonzero(labels == label))
+        values = data[coordinates[0, :], coordinates[1, :], coordinates[2, :]]
+        voxels.append(coordinates)
+        peaks.append(coordinates[:, np.argmax(abs(values))])
+        means.append(np.mean(values))
+    return dict(ids=ids, sizes=np.array(sizes), voxels=voxels, peaks=peaks,
+                means=np.array(means))
+
+
+def timed(func, *args, **kwargs):
+    t0 = time.time()
+    out = func(*args, **kwargs)
+    return out, time.time() - t0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="example: \
+                        python clusters.py --shape 91 109 91 --thr 1.5")
+    parser.add_argument('--shape', dest='shape', type=int, nargs=3,
+                        default=[91, 109, 91], help='volume shape')
+    parser.add_argument('--thr', dest='thr', type=float, default=1.5,
+                        help='cluster forming threshold')
+    parser.add_argument('--csize', dest='csize', type=int, default=5,
+                        help='minimum cluster size')
+    parser.add_argument('--fwhm', dest='fwhm', type=float, default=1.5,
+                        help='smoothness of the noise in voxels')
+    args = parser.parse_args()
+
+    data = make_zmap(tuple(args.shape), args.fwhm)
+    ref_labels, t_naive_label = timed(naive_labels, data, args.thr,
+                                      args.csize)
+    labels, t_label = timed(label_clusters, data, args.thr, args.csize)
+    assert np.array_equal(ref_labels, labels)
+    ref, t_naive_summary = timed(naive_summary, ref_labels, data)
+    summary, t_summary = timed(cluster_summary, labels, data)
+    assert np.array_equal(ref['ids'], summary['ids'])
+    assert np.array_equal(ref['sizes'], summary['sizes'])
+    for key in ['voxels', 'peaks']:
+        assert all([np.array_equal(a, b)
+                    for a, b in zip(ref[key], summary[key])])
+    assert np.allclose(ref['means'], summary['means'])
+
+    print("%d clusters of at least %d voxels" % (len(summary['ids']),
+                                                  args.csize))
+    print("%-10s %10s %10s %8s" % ('step', 'loops', 'engine', 'speedup'))
+    for name, naive, fast in [('label', t_naive_label, t_label),
+                              ('summary', t_naive_summary, t_summary)]:
+        print("%-10s %9.3fs %9.3fs %7.1fx" % (name, naive, fast,
+                                              naive / max(fast, 1e-9)))
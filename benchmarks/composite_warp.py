@@ -0,0 +1,162 @@
+"""
+Benchmark composite warp resampling
+===================================
+
+Builds a synthetic template, a smooth nonlinear warp, an ANTS style affine
+and an FSL to ITK affine, then normalizes several synthetic 4D runs:
+
+* chain : the transform list is evaluated again for every run, volumes are
+          resampled one at a time (like one WarpTimeSeriesImageMultiTransform
+          call per run)
+* composite : the list is composed once into a displacement field, runs are
+              resampled through it in chunks with a thread pool
+
+The outputs of both are compared. If WarpTimeSeriesImageMultiTransform is on
+the PATH, ANTS is run on the first run as well and the correlation with the
+native result is reported.
+
+    python composite_warp.py -r 4 -t 60 -w 4
+"""
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'utils'))
+import numpy as np
+import nibabel as nb
+from scipy import ndimage
+from fslaffine import write_itk_affine
+from compositewarp import (compose_warp, apply_composite_warp,
+                           apply_transforms, grid_points, _FLIP,
+                           _world_to_voxel)
+
+
+def make_inputs(out_dir, runs, frames, seed=0):
+    rng = np.random.RandomState(seed)
+    files = {}
+    # 2mm template
+    t_affine = np.diag([-2., 2., 2., 1.])
+    t_affine[:3, 3] = [90, -126, -72]
+    t_shape = (91, 109, 91)
+    files['template'] = os.path.join(out_dir, 'template.nii.gz')
+    nb.Nifti1Image(np.zeros(t_shape, np.float32), t_affine).to_filename(
+        files['template'])
+    # smooth LPS displacements of a few mm on the template grid
+    field = np.concatenate([ndimage.gaussian_filter(
+        rng.randn(*t_shape), 6)[..., None, None] for _ in range(3)], axis=-1)
+    field *= 3. / np.abs(field).max()
+    files['warp'] = os.path.join(out_dir, 'Warp.nii.gz')
+    img = nb.Nifti1Image(field.astype(np.float32), t_affine)
+    img.to_filename(files['warp'])
+    # struct -> template affine (ANTS writes a center)
+    angle = 0.05
+    rot = np.array([[np.cos(angle), -np.sin(angle), 0],
+                    [np.sin(angle), np.cos(angle), 0], [0, 0, 1]])
+    files['affine'] = os.path.join(out_dir, 'Affine.txt')
+    write_itk_affine(files['affine'], rot * 1.05, [2., -3., 1.5])
+    files['fsl2ants'] = os.path.join(out_dir, 'fsl2antsAffine.txt')
+    write_itk_affine(files['fsl2ants'], np.eye(3) * 0.98, [-1., 0.5, 2.])
+    # 3mm functional runs
+    f_affine = np.diag([-3., 3., 3.5, 1.])
+    f_affine[:3, 3] = [96, -110, -60]
+    f_shape = (64, 64, 36)
+    center = np.array(f_shape)[:, None, None, None] / 2.
+    radius = np.sqrt((((np.indices(f_shape) - center) / center) ** 2).sum(0))
+    base = 1000. * (radius < 0.8)
+    files['runs'] = []
+    for r in range(runs):
+        data = base[..., None] + 20 * rng.randn(*(f_shape + (frames,)))
+        fname = os.path.join(out_dir, 'run%02d.nii.gz' % r)
+        img = nb.Nifti1Image(data.astype(np.float32), f_affine)
+        img.get_header().set_zooms((3., 3., 3.5, 2.))
+        img.to_filename(fname)
+        files['runs'].append(fname)
+    return files
+
+
+def chain_warp(moving_image, reference, transforms, out_file):
+    """Evaluate the transform list for this run and resample each volume"""
+    ref = nb.load(reference)
+    shape = ref.get_shape()[:3]
+    points = apply_transforms(grid_points(shape, ref.get_affine()) * _FLIP,
+                              transforms)
+    img = nb.load(moving_image)
+    coords = _world_to_voxel(points * _FLIP, img.get_affine())
+    data = img.get_data()
+    out = np.zeros(shape + (data.shape[3],), np.float32)
+    for t in range(data.shape[3]):
+        out[..., t] = ndimage.map_coordinates(
+            np.asarray(data[..., t], np.float64), coords, order=1,
+            mode='constant', cval=0.).reshape(shape)
+    nb.Nifti1Image(out, ref.get_affine()).to_filename(out_file)
+    return out_file
+
+
+def run_ants(files, out_file):
+    exe = 'WarpTimeSeriesImageMultiTransform'
+    paths = os.environ.get('PATH', '').split(os.pathsep)
+    if not any([os.path.exists(os.path.join(p, exe)) for p in paths]):
+        return None
+    cmd = [exe, '4', files['runs'][0], out_file, '-R', files['template'],
+           files['warp'], files['affine'], files['fsl2ants']]
+    if subprocess.call(cmd) != 0:
+        return None
+    return out_file
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="example: \
+                        python composite_warp.py -r 4 -t 60 -w 4")
+    parser.add_argument('-r', '--runs', dest='runs', type=int, default=4,
+                        help='number of runs (times fwhm values)')
+    parser.add_argument('-t', '--frames', dest='frames', type=int,
+                        default=60, help='volumes per run')
+    parser.add_argument('-w', '--workers', dest='workers', type=int,
+                        default=4, help='resampling threads')
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        files = make_inputs(tmp_dir, args.runs, args.frames)
+        transforms = [files['warp'], files['affine'], files['fsl2ants']]
+
+        t0 = time.time()
+        chain = [chain_warp(run, files['template'], transforms,
+                            run.replace('.nii.gz', '_chain.nii.gz'))
+                 for run in files['runs']]
+        t_chain = time.time() - t0
+
+        t0 = time.time()
+        field = compose_warp(files['template'], transforms,
+                             os.path.join(tmp_dir, 'composite.nii.gz'),
+                             cache_dir=os.path.join(tmp_dir, 'cache'))
+        t_compose = time.time() - t0
+        native = [apply_composite_warp(
+            run, field, run.replace('.nii.gz', '_wtsimt.nii.gz'),
+            workers=args.workers) for run in files['runs']]
+        t_native = time.time() - t0
+
+        diff = 0
+        for a, b in zip(chain, native):
+            diff = max(diff, np.abs(nb.load(a).get_data() -
+                                    nb.load(b).get_data()).max())
+        print("%d runs x %d volumes" % (args.runs, args.frames))
+        print("chain      %8.2f s" % t_chain)
+        print("composite  %8.2f s (compose %.2f s)" % (t_native, t_compose))
+        print("max abs difference: %.4g" % diff)
+
+        ants = run_ants(files, os.path.join(tmp_dir, 'ants.nii.gz'))
+        if ants is None:
+            print("WarpTimeSeriesImageMultiTransform not found, skipping "
+                  "ANTS comparison")
+        else:
+            a = nb.load(ants).get_data().ravel()
+            b = nb.load(native[0]).get_data().ravel()
+            print("correlation with ANTS: %.4f, max abs difference: %.4g" %
+                  (np.corrcoef(a, b)[0, 1], np.abs(a - b).max()))
+    finally:
+        shutil.rmtree(tmp_dir)
@@ -0,0 +1,132 @@
+"""
+Benchmark eddy current correction
+=================================
+
+Runs utils/eddycorrect.py on a synthetic DWI series whose volumes are
+shifted by known amounts, with a stand-in for flirt: the stand-in reads the
+volume, undoes its known shift and sleeps --latency seconds, like an
+external registration process. The serial baseline does what
+create_eddy_correct_pipeline does: split the series to disk, write the
+reference again for every registration, register one volume at a time and
+merge the registered files.
+
+The corrected series must match the unshifted volumes, and the serial and
+parallel outputs must be identical.
+
+    python eddy_correct.py -t 60 -w 4 --latency 0.5
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'utils'))
+import numpy as np
+import nibabel as nb
+from scipy import ndimage
+from eddycorrect import eddy_correct
+
+SHIFT_X = 1.5  # largest simulated eddy current shift, in voxels
+
+
+def make_series(out_dir, frames, shape=(96, 96, 60), seed=0):
+    rng = np.random.RandomState(seed)
+    clean = ndimage.gaussian_filter(rng.rand(*shape) * 1000, 2)
+    shifts = np.round(rng.uniform(-1, 1, frames) * SHIFT_X * 2) / 2.
+    shifts[0] = 0
+    data = np.zeros(shape + (frames,), np.float32)
+    for t in range(frames):
+        data[..., t] = ndimage.shift(clean, (shifts[t], 0, 0), order=1)
+    fname = os.path.join(out_dir, 'dwi.nii')
+    nb.Nifti1Image(data, np.diag([2., 2., 2., 1.])).to_filename(fname)
+    return fname, shifts
+
+
+def stand_in(shifts, latency):
+    """Registration stand-in: undoes the known shift of a volume"""
+    def register(in_file, ref_file, out_file, out_matrix):
+        t = int(os.path.split(in_file)[1][len('eddy_vol'):][:4])
+        nb.load(ref_file).get_data()
+        vol = nb.load(in_file)
+        data = ndimage.shift(vol.get_data(), (-shifts[t], 0, 0), order=1)
+        time.sleep(latency)
+        nb.Nifti1Image(data.astype(np.float32),
+                       vol.get_affine()).to_filename(out_file)
+        mat = np.eye(4)
+        mat[0, 3] = -shifts[t] * 2
+        np.savetxt(out_matrix, mat)
+        return out_file
+    return register
+
+
+def split_merge(in_file, out_file, register, work_dir):
+    """Serial split / register / merge, as create_eddy_correct_pipeline"""
+    img = nb.load(in_file)
+    data = img.get_data()
+    vols = []
+    for t in range(data.shape[3]):
+        vol = os.path.join(work_dir, 'eddy_vol%04d.nii' % t)
+        nb.Nifti1Image(np.asarray(data[..., t]),
+                       img.get_affine()).to_filename(vol)
+        vols.append(vol)
+    registered = []
+    for t, vol in enumerate(vols):
+        ref = os.path.join(work_dir, 'ref%04d.nii' % t)
+        nb.Nifti1Image(np.asarray(nb.load(vols[0]).get_data()),
+                       img.get_affine()).to_filename(ref)
+        registered.append(register(vol, ref, vol.replace('.nii', '_r.nii'),
+                                   vol.replace('.nii', '.mat')))
+    merged = np.concatenate([nb.load(f).get_data()[..., None]
+                             for f in registered], axis=3)
+    nb.Nifti1Image(merged, img.get_affine()).to_filename(out_file)
+    return out_file
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="example: \
+                        python eddy_correct.py -t 60 -w 4 --latency 0.5")
+    parser.add_argument('-t', '--frames', dest='frames', type=int,
+                        default=60, help='volumes in the series')
+    parser.add_argument('-w', '--workers', dest='workers', type=int,
+                        default=4, help='concurrent registrations')
+    parser.add_argument('--latency', dest='latency', type=float, default=0.5,
+                        help='seconds each stand-in registration takes')
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        dwi, shifts = make_series(tmp_dir, args.frames)
+        register = stand_in(shifts, args.latency)
+        os.makedirs(os.path.join(tmp_dir, 'serial'))
+
+        t0 = time.time()
+        serial = split_merge(dwi, os.path.join(tmp_dir, 'serial.nii'),
+                             register, os.path.join(tmp_dir, 'serial'))
+        t_serial = time.time() - t0
+
+        t0 = time.time()
+        parallel = eddy_correct(dwi, os.path.join(tmp_dir, 'parallel.nii'),
+                                0, args.workers, register,
+                                os.path.join(tmp_dir, 'parallel'))[0]
+        t_parallel = time.time() - t0
+
+        a = nb.load(serial).get_data()
+        b = nb.load(parallel).get_data()
+        ref = a[..., 0]
+        inner = (slice(4, -4), slice(None), slice(None))
+        residual = max([np.abs(b[..., t][inner] - ref[inner]).max()
+                        for t in range(args.frames)
+                        if shifts[t] == np.round(shifts[t])])
+        print("%d volumes, %.2f s per registration" % (args.frames,
+                                                      args.latency))
+        print("split / merge      %8.2f s" % t_serial)
+        print("parallel (%2d)      %8.2f s (%.1fx)" % (
+            args.workers, t_parallel, t_serial / t_parallel))
+        print("max serial / parallel difference: %.3g" % np.abs(a - b).max())
+        print("max residual of integer shifts: %.3g" % residual)
+        assert np.abs(a - b).max() == 0
+        assert residual < 1e-2
+    finally:
+        shutil.rmtree(tmp_dir)
@@ -0,0 +1,135 @@
+"""
+Check FSL to ITK affine conversion
+==================================
+
+Converts FSL (flirt) matrices with utils/fslaffine.py and compares the ITK
+transforms with hand derived ones, for neurological and radiological
+storage orders, shifted and oblique headers. If c3d_affine_tool is on the
+PATH, its -fsl2ras -oitk output is compared as well.
+
+FSL coordinates are voxel indices times voxel sizes, with x flipped
+(x_fsl = dx * (nx - 1 - i)) when the header's determinant is positive. An
+ITK transform maps fixed (reference) LPS points to moving (source) LPS
+points.
+
+    python fslaffine.py
+"""
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'utils'))
+import numpy as np
+import nibabel as nb
+from fslaffine import fsl_to_itk, read_itk_affine
+
+
+def translation(x, y, z):
+    mat = np.eye(4)
+    mat[:3, 3] = [x, y, z]
+    return mat
+
+
+def header(zooms, origin=(0, 0, 0), rotation=None):
+    mat = np.diag(list(zooms) + [1.])
+    if rotation is not None:
+        mat[:3, :3] = rotation.dot(mat[:3, :3])
+    mat[:3, 3] = origin
+    return mat
+
+
+def rot_z(degrees):
+    t = np.radians(degrees)
+    return np.array([[np.cos(t), -np.sin(t), 0],
+                     [np.sin(t), np.cos(t), 0],
+                     [0, 0, 1]])
+
+
+SHAPE = (10, 12, 8)
+CASES = [
+    # same grid: FSL and world identity
+    ('identity', SHAPE, header([2, 2, 2]), SHAPE, header([2, 2, 2]),
+     np.eye(4), np.eye(3), [0, 0, 0]),
+    # source origin 4 mm to the right. x is flipped in FSL space:
+    # x_fsl_ref = 2 (9 - i_ref), i_ref = i_src + 2, so x_fsl_ref =
+    # x_fsl_src - 4. The world transform is the identity.
+    ('flipped, shifted', SHAPE, header([2, 2, 2]), SHAPE,
+     header([2, 2, 2], (4, 0, 0)), translation(-4, 0, 0), np.eye(3),
+     [0, 0, 0]),
+    # radiological reference (x_world = 18 - 2 i, x_fsl = 2 i) and
+    # neurological source (x_world = 2 i, x_fsl = 18 - 2 i): the identity
+    # FSL matrix maps i_ref = 9 - i_src, the same world point
+    ('radiological reference', SHAPE, header([-2, 2, 2], (18, 0, 0)),
+     SHAPE, header([2, 2, 2]), np.eye(4), np.eye(3), [0, 0, 0]),
+    # FSL translation (3, -5, 7) between neurological grids is the RAS
+    # translation (-3, -5, 7); inverted and in LPS: offset (-3, -5, -7)
+    ('FSL translation', SHAPE, header([2, 2, 2]), SHAPE, header([2, 2, 2]),
+     translation(3, -5, 7), np.eye(3), [-3, -5, -7]),
+    # source header rotated 30 degrees about z (oblique acquisition), FSL
+    # identity: RAS = A_ref inv(A_src) = R^T, ITK = LPS R LPS = R
+    ('oblique source', SHAPE, header([2, 2, 2]), SHAPE,
+     header([2, 2, 2], rotation=rot_z(30)), np.eye(4), rot_z(30),
+     [0, 0, 0]),
+    # anisotropic voxels: a 1 mm FSL shift in y between grids with 3 mm
+    # slices is a world shift of 1 mm, whatever the voxel size
+    ('anisotropic', SHAPE, header([1.5, 2.5, 3]), SHAPE,
+     header([1.5, 2.5, 3]), translation(0, 1, 0), np.eye(3), [0, 1, 0]),
+]
+
+
+def write_image(fname, shape, affine):
+    nb.Nifti1Image(np.zeros(shape, dtype=np.uint8), affine).to_filename(fname)
+    return fname
+
+
+def c3d_itk(ref, src, fsl_file, out_file):
+    """c3d_affine_tool's conversion, None if it is not installed"""
+    try:
+        subprocess.check_call(['c3d_affine_tool', '-ref', ref, '-src', src,
+                               fsl_file, '-fsl2ras', '-oitk', out_file],
+                              stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return read_itk_affine(out_file)
+
+
+if __name__ == "__main__":
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        print("%-24s %12s %12s %12s" % ('case', 'matrix err', 'offset err',
+                                        'c3d err'))
+        failed = []
+        for i, (name, ref_shape, ref_affine, src_shape, src_affine, fsl,
+                matrix, offset) in enumerate(CASES):
+            ref = write_image(os.path.join(tmp_dir, 'ref%d.nii.gz' % i),
+                              ref_shape, ref_affine)
+            src = write_image(os.path.join(tmp_dir, 'src%d.nii.gz' % i),
+                              src_shape, src_affine)
+            fsl_file = os.path.join(tmp_dir, 'fsl%d.mat' % i)
+            np.savetxt(fsl_file, fsl)
+            out_file = fsl_to_itk(ref, src, fsl_file,
+                                  os.path.join(tmp_dir, 'itk%d.txt' % i),
+                                  cache_dir=os.path.join(tmp_dir, 'cache'))
+            itk_matrix, itk_offset = read_itk_affine(out_file)
+            err_m = np.abs(itk_matrix - matrix).max()
+            err_o = np.abs(itk_offset - np.asarray(offset)).max()
+            c3d = c3d_itk(ref, src, fsl_file,
+                          os.path.join(tmp_dir, 'c3d%d.txt' % i))
+            if c3d is None:
+                err_c3d = '-'
+            else:
+                err_c3d = '%12.2e' % max(np.abs(c3d[0] - itk_matrix).max(),
+                                         np.abs(c3d[1] - itk_offset).max())
+                if float(err_c3d) > 1e-4:
+                    failed.append(name + ' (c3d)')
+            print("%-24s %12.2e %12.2e %12s" % (name, err_m, err_o, err_c3d))
+            if err_m > 1e-6 or err_o > 1e-6:
+                failed.append(name)
+        if err_c3d == '-':
+            print("c3d_affine_tool not found, only the hand derived cases "
+                  "were checked")
+        assert not failed, failed
+    finally:
+        shutil.rmtree(tmp_dir)
@@ -0,0 +1,214 @@
+"""
+Benchmark PBS resource plans
+============================
+
+Runs a preprocessing-shaped nipype workflow (per subject: a realignment
+requested with ppn=3 like preproc.py, a memory hungry CompCor, a MapNode
+over runs and a handful of tiny Function nodes) through nipype's PBS plugin
+and the local scheduler stand-in (pbs_standin.py), which adds a queue
+latency per job and shares --slots processors between the running jobs.
+
+1. history   the workflow runs once in process with nodeprofile.py enabled
+2. global    every node is submitted with the global qsub_args
+             ('-l nodes=1:ppn=3')
+3. planned   pbsplan.py sizes every node from the history and runs the tiny
+             nodes in the submitting process
+
+The planned run must submit fewer jobs, none of them may be killed for
+going over its mem or walltime, and all nodes must finish. A cached
+normalization node with its own plugin_args (sized for the ANTS run of a
+cache miss) only has cache hits in its history: its plan must keep the
+mem and walltime it requests.
+
+    python pbs_plan.py -n 3 --slots 4 --latency 1
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..', 'utils'))
+from nipype import config, logging
+import nipype.pipeline.engine as pe
+import nipype.interfaces.utility as util
+from nodeprofile import enable_profiling, write_profiles
+from pbsplan import load_history, make_plan, apply_plan, print_plan
+import pbs_standin
+
+GLOBAL_ARGS = '-l nodes=1:ppn=3'
+STRUCT_ARGS = '-l nodes=1:ppn=1,mem=4gb,walltime=02:00:00'
+
+
+def realign(subject_id, seconds):
+    import time
+    import numpy as np
+    t0 = time.time()
+    a = np.random.rand(300, 300)
+    while time.time() - t0 < seconds:
+        a = a.dot(a.T) / 300.
+    return subject_id
+
+
+def compcor(subject_id, mb):
+    import time
+    import numpy as np
+    a = np.ones(int(mb * 2 ** 17))
+    time.sleep(1)
+    return float(a.sum())
+
+
+def run_stats(run, seconds):
+    import time
+    t0 = time.time()
+    while time.time() - t0 < seconds:
+        sum(range(10000))
+    return run
+
+
+def cached_norm(subject_id):
+    # a cache hit: a miss would run ANTS for hours
+    return subject_id
+
+
+def pickfirst(files):
+    return files
+
+
+def tolist(x):
+    return [x]
+
+
+def subject_runs(subject_id):
+    return ['%s_run%d' % (subject_id, i) for i in range(2)]
+
+
+def create_workflow(subjects, base_dir, heavy_mb=300):
+    workflow = pe.Workflow(name='plan_bench', base_dir=base_dir)
+    workflow.config['execution'] = {'poll_sleep_duration': 0.5,
+                                    'job_finished_timeout': 30}
+    infosource = pe.Node(util.IdentityInterface(fields=['subject_id']),
+                         name='subject_names')
+    infosource.iterables = ('subject_id', subjects)
+    preproc = pe.Workflow(name='preproc')
+    align = pe.Node(util.Function(input_names=['subject_id', 'seconds'],
+                                  output_names=['subject_id'],
+                                  function=realign), name='realign')
+    align.inputs.seconds = 6
+    align.plugin_args = {'qsub_args': GLOBAL_ARGS}
+    cc = pe.Node(util.Function(input_names=['subject_id', 'mb'],
+                               output_names=['total'], function=compcor),
+                 name='CompCor')
+    cc.inputs.mb = heavy_mb
+    cc.plugin_args = {'qsub_args': GLOBAL_ARGS}
+    norm = pe.Node(util.Function(input_names=['subject_id'],
+                                 output_names=['subject_id'],
+                                 function=cached_norm), name='struct_norm')
+    norm.plugin_args = {'qsub_args': STRUCT_ARGS, 'overwrite': True}
+    runs = pe.Node(util.Function(input_names=['subject_id'],
+                                 output_names=['runs'],
+                                 function=subject_runs), name='runs')
+    stats = pe.MapNode(util.Function(input_names=['run', 'seconds'],
+                                     output_names=['run'],
+                                     function=run_stats),
+                       iterfield=['run'], name='run_stats')
+    stats.inputs.seconds = 1
+    first = pe.Node(util.Function(input_names=['files'],
+                                  output_names=['files'],
+                                  function=pickfirst), name='pickfirst')
+    listed = pe.Node(util.Function(input_names=['x'], output_names=['x'],
+                                   function=tolist), name='tolist')
+    preproc.connect(align, 'subject_id', cc, 'subject_id')
+    preproc.connect(align, 'subject_id', runs, 'subject_id')
+    preproc.connect(align, 'subject_id', norm, 'subject_id')
+    preproc.connect(runs, 'runs', stats, 'run')
+    preproc.connect(stats, 'run', first, 'files')
+    preproc.connect(first, 'files', listed, 'x')
+    workflow.connect(infosource, 'subject_id', preproc, 'realign.subject_id')
+    return workflow
+
+
+def run_pbs(workflow, spool_dir):
+    t0 = time.time()
+    workflow.run(plugin='PBS', plugin_args={'qsub_args': GLOBAL_ARGS})
+    elapsed = time.time() - t0
+    accounting = pbs_standin.jobs(spool_dir)
+    shutil.rmtree(spool_dir)
+    os.makedirs(spool_dir)
+    return elapsed, accounting
+
+
+def describe(name, elapsed, accounting):
+    killed = [j for j in accounting if j.get('killed')]
+    requested = sum([j['ppn'] * j['run_time'] for j in accounting])
+    used = sum([j['cpu_time'] for j in accounting])
+    wait = sum([j['wait'] for j in accounting])
+    print("%-8s %8.1f %6d %10.1f %14.1f %12.1f %7d" % (
+        name, elapsed, len(accounting), wait, requested, used, len(killed)))
+    return killed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="example: \
+                        python pbs_plan.py -n 3 --slots 4 --latency 1")
+    parser.add_argument('-n', '--subjects', dest='subjects', type=int,
+                        default=3, help='number of subjects')
+    parser.add_argument('--slots', dest='slots', type=int, default=4,
+                        help='processors of the stand-in scheduler')
+    parser.add_argument('--latency', dest='latency', type=float, default=1.,
+                        help='seconds each job waits in the queue')
+    parser.add_argument('--dry_run', dest='dry_run', action='store_true',
+                        help='only print the plan')
+    args = parser.parse_args()
+    config.update_config({'logging': {'workflow_level': 'WARNING'}})
+    logging.update_logging(config)
+
+    tmp_dir = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    # nipype polls qstat with its output written to the current directory
+    os.chdir(tmp_dir)
+    try:
+        subjects = ['sub%03d' % (i + 1) for i in range(args.subjects)]
+        profile_dir = os.path.join(tmp_dir, 'profiles')
+        spool_dir = os.path.join(tmp_dir, 'spool')
+        pbs_standin.install(os.path.join(tmp_dir, 'bin'), spool_dir,
+                            args.latency, args.slots)
+        os.environ['PATH'] = os.path.join(tmp_dir, 'bin') + os.pathsep + \
+            os.environ['PATH']
+        os.environ.setdefault('LOGNAME', 'bench')
+        os.environ['PYTHONPATH'] = os.pathsep.join(
+            [BENCH_DIR, os.path.join(BENCH_DIR, '..', 'utils')] +
+            os.environ.get('PYTHONPATH', '').split(os.pathsep))
+
+        history = create_workflow(subjects, os.path.join(tmp_dir, 'history'))
+        enable_profiling(history, profile_dir, interval=0.2)
+        history.run()
+        write_profiles(profile_dir)
+
+        planned = create_workflow(subjects, os.path.join(tmp_dir, 'planned'))
+        plan = make_plan(planned, load_history(profile_dir), GLOBAL_ARGS,
+                         min_walltime=60.)
+        print_plan(plan)
+        norm = [p for p in plan if p['node'].endswith('.struct_norm')][0]
+        assert norm['action'] == 'submit', norm
+        assert norm['mem'] >= 4096 and norm['walltime'] >= 7200, norm
+        if args.dry_run:
+            sys.exit(0)
+        apply_plan(planned, plan)
+
+        print("")
+        print("%-8s %8s %6s %10s %14s %12s %7s" % (
+            'run', 'time (s)', 'jobs', 'wait (s)', 'ppn x run (s)',
+            'cpu (s)', 'killed'))
+        killed = describe('global', *run_pbs(
+            create_workflow(subjects, os.path.join(tmp_dir, 'global')),
+            spool_dir))
+        t_planned, accounting = run_pbs(planned, spool_dir)
+        killed += describe('planned', t_planned, accounting)
+        batched = len([p for p in plan if p['action'] == 'batch'])
+        assert not killed, killed
+        assert batched > 0
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(tmp_dir)
@@ -0,0 +1,253 @@
+"""
+Local PBS stand-in
+==================
+
+qsub and qstat replacements that run the batch jobs on this machine, so
+nipype's PBS plugin and the resource plans of utils/pbsplan.py can be tried
+without a cluster:
+
+qsub   parses -l nodes=1:ppn=N,mem=M(kb|mb|gb),walltime=HH:MM:SS, -N, -o
+       and -e (other options are accepted and ignored), queues the job and
+       prints its id. A detached runner waits `latency` seconds (the queue
+       overhead of a real scheduler) and for `slots` free processors, then
+       runs the script. A job whose process tree goes over its mem, or that
+       runs longer than its walltime, is killed.
+qstat  'job_state = Q' or 'R' while the job is queued or running and
+       'Unknown Job Id' once it finished, like a server that does not keep
+       completed jobs.
+
+Every job leaves its accounting in spool_dir/<id>.json: requested
+resources, queue wait, run time, CPU time, peak resident memory, exit
+status and why it was killed. install(bin_dir, spool_dir) writes the qsub
+and qstat executables; put bin_dir first on the PATH.
+"""
+import json
+import os
+import re
+import resource
+import signal
+import subprocess
+import sys
+import time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'utils'))
+from structcache import acquire, release
+
+SPOOL_ENV = 'PBS_STANDIN_SPOOL'
+LATENCY_ENV = 'PBS_STANDIN_LATENCY'
+SLOTS_ENV = 'PBS_STANDIN_SLOTS'
+MEM_UNITS = {'kb': 1. / 1024, 'mb': 1., 'gb': 1024.}
+POLL = 0.1
+
+
+def _spool():
+    return os.environ[SPOOL_ENV]
+
+
+def _job_file(jobid):
+    return os.path.join(_spool(), '%s.json' % jobid)
+
+
+def _load(jobid):
+    return json.load(open(_job_file(jobid)))
+
+
+def _save(job):
+    tmp = _job_file(job['id']) + '.tmp'
+    json.dump(job, open(tmp, 'w'), indent=1, sort_keys=True)
+    os.rename(tmp, _job_file(job['id']))
+
+
+def parse_resources(spec, resources):
+    """Update resources with a -l resource list"""
+    for item in re.split(',', spec):
+        key, _, value = item.partition('=')
+        if key == 'nodes':
+            match = re.search(r'ppn=(\d+)', value)
+            if match:
+                resources['ppn'] = int(match.group(1))
+        elif key == 'mem':
+            match = re.match(r'(\d+)([kmg]b)?$', value.lower())
+            resources['mem'] = int(match.group(1)) * \
+                MEM_UNITS[match.group(2) or 'mb']
+        elif key == 'walltime':
+            seconds = 0
+            for part in value.split(':'):
+                seconds = seconds * 60 + int(part)
+            resources['walltime'] = seconds
+    return resources
+
+
+def _next_id():
+    lock = acquire(os.path.join(_spool(), 'jobid'), timeout=60, poll=POLL)
+    try:
+        counter = os.path.join(_spool(), 'jobid')
+        jobid = int(open(counter).read()) + 1 if os.path.exists(counter) \
+            else 1
+        open(counter, 'w').write('%d' % jobid)
+    finally:
+        release(lock)
+    return jobid
+
+
+def qsub(argv):
+    job = {'ppn': 1, 'mem': None, 'walltime': None, 'name': None,
+           'out': None, 'err': None, 'state': 'Q', 'args': argv,
+           'submitted': time.time(), 'cwd': os.getcwd()}
+    i = 0
+    while i < len(argv) - 1:
+        opt = argv[i]
+        if opt == '-l':
+            parse_resources(argv[i + 1], job)
+        elif opt in ('-N', '-o', '-e'):
+            job[{'-N': 'name', '-o': 'out', '-e': 'err'}[opt]] = argv[i + 1]
+        elif opt in ('-q', '-A', '-W', '-M', '-m', '-j', '-S'):
+            pass
+        else:
+            i -= 1
+        i += 2
+    job['script'] = os.path.abspath(argv[-1])
+    job['name'] = job['name'] or os.path.basename(job['script'])
+    job['id'] = '%d.standin' % _next_id()
+    _save(job)
+    devnull = open(os.devnull, 'w')
+    subprocess.Popen([sys.executable, os.path.abspath(__file__), '_run',
+                      job['id']], stdout=devnull, stderr=devnull,
+                     preexec_fn=os.setsid)
+    print(job['id'])
+
+
+def _output(path, name, jobid, suffix):
+    if path is None:
+        path = os.getcwd()
+    if os.path.isdir(path):
+        path = os.path.join(path, '%s.%s%s' % (name, suffix,
+                                               jobid.split('.')[0]))
+    return open(path, 'w')
+
+
+def _start(job, slots):
+    """Wait for the job's processors, then mark it running"""
+    while True:
+        lock = acquire(os.path.join(_spool(), 'slots'), timeout=60,
+                       poll=POLL)
+        try:
+            running = [json.load(open(os.path.join(_spool(), f)))
+                       for f in os.listdir(_spool())
+                       if f.endswith('.json')]
+            used = sum([j['ppn'] for j in running if j['state'] == 'R'])
+            if not used or used + job['ppn'] <= slots:
+                job['state'] = 'R'
+                job['started'] = time.time()
+                _save(job)
+                return
+        finally:
+            release(lock)
+        time.sleep(POLL)
+
+
+def _run(jobid):
+    job = _load(jobid)
+    try:
+        _execute(job)
+    except Exception as e:
+        job.update({'state': 'C', 'exit_status': -1,
+                    'killed': 'error: %s' % e})
+        _save(job)
+        raise
+
+
+def _execute(job):
+    from nodeprofile import tree_rss
+    jobid = job['id']
+    time.sleep(float(os.environ.get(LATENCY_ENV, 0)))
+    _start(job, int(os.environ.get(SLOTS_ENV, 1)))
+    out = _output(job['out'], job['name'], jobid, 'o')
+    err = _output(job['err'], job['name'], jobid, 'e')
+    env = dict(os.environ, PBS_JOBID=jobid, PBS_NUM_PPN=str(job['ppn']))
+    proc = subprocess.Popen(['sh', job['script']], stdout=out, stderr=err,
+                            cwd=job['cwd'], env=env, preexec_fn=os.setpgrp)
+    peak, killed = 0., None
+    while proc.poll() is None:
+        peak = max(peak, tree_rss(proc.pid))
+        elapsed = time.time() - job['started']
+        if job['mem'] and peak > job['mem']:
+            killed = 'mem'
+        elif job['walltime'] and elapsed > job['walltime']:
+            killed = 'walltime'
+        if killed:
+            try:
+                os.killpg(proc.pid, signal.SIGKILL)
+            except OSError:
+                pass
+            proc.wait()
+            break
+        time.sleep(POLL)
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    # ru_maxrss is in bytes on OS X and in kilobytes on Linux
+    unit = 2. ** 20 if sys.platform == 'darwin' else 1024.
+    job.update({'state': 'C', 'finished': time.time(),
+                'exit_status': proc.returncode, 'killed': killed,
+                'wait': job['started'] - job['submitted'],
+                'run_time': time.time() - job['started'],
+                'cpu_time': usage.ru_utime + usage.ru_stime,
+                'peak_rss': max(peak, usage.ru_maxrss / unit)})
+    _save(job)
+
+
+def qstat(argv):
+    ids = [a for a in argv if not a.startswith('-')]
+    status = 0
+    for jobid in ids:
+        if '.' not in jobid:
+            jobid += '.standin'
+        try:
+            job = _load(jobid)
+        except (IOError, OSError, ValueError):
+            job = {'state': 'C'}
+        if job['state'] == 'C':
+            sys.stderr.write('qstat: Unknown Job Id %s\n' % jobid)
+            status = 153
+        else:
+            print('Job Id: %s\n    Job_Name = %s\n    job_state = %s' % (
+                jobid, job['name'], job['state']))
+    sys.exit(status)
+
+
+def jobs(spool_dir):
+    """Accounting of every job of spool_dir"""
+    return [json.load(open(os.path.join(spool_dir, f)))
+            for f in sorted(os.listdir(spool_dir)) if f.endswith('.json')]
+
+
+def install(bin_dir, spool_dir, latency=0., slots=1, python=None):
+    """Write qsub and qstat into bin_dir
+
+    Parameters
+    ----------
+    bin_dir : directory put first on the PATH
+    spool_dir : job files and accounting
+    latency : seconds every job waits in the queue. Default = 0
+    slots : processors shared by the running jobs. Default = 1
+    python : command that runs this script. Default = this interpreter
+    """
+    for path in [bin_dir, spool_dir]:
+        if not os.path.exists(path):
+            os.makedirs(path)
+    if python is None:
+        python = '"%s"' % sys.executable
+    for tool in ['qsub', 'qstat']:
+        filename = os.path.join(bin_dir, tool)
+        fp = open(filename, 'w')
+        fp.write('#!/bin/sh\n%s="%s" %s="%s" %s="%d" exec %s "%s" %s "$@"\n' % (
+            SPOOL_ENV, os.path.abspath(spool_dir), LATENCY_ENV, latency,
+            SLOTS_ENV, slots, python, os.path.abspath(__file__), tool))
+        fp.close()
+        os.chmod(filename, 0o755)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] not in ('qsub', 'qstat', '_run'):
+        sys.exit('usage: pbs_standin.py {qsub,qstat} args')
+    globals()[sys.argv[1]](sys.argv[2:] if sys.argv[1] != '_run'
+                           else sys.argv[2])
@@ -0,0 +1,418 @@
+"""
+End-to-end pipeline benchmark suite
+===================================
+
+Generates synthetic subjects (synthetic.py), puts the FSL / FreeSurfer
+stand-ins (standins.py) first on the PATH and runs the steps of the
+pipelines on every subject, one stage at a time:
+
+generate     synthetic subject
+preproc      mcflirt, mean, bet, masking, smoothing (fmri/task/preproc.py,
+             resting_preproc.py), tsdiff metrics and art outliers
+register     mri_convert of orig / aparc+aseg, bbregister and the FSL to
+             ITK conversion (normalize/utils.convert_affine)
+first_level  film_gls with the block design, cluster labeling, summaries
+             and anatomical locations (first_level.py,
+             report_first_level.py)
+normalize    composite warp and native resampling
+             (normalize_full_resting.py)
+resting      aparc+aseg in functional space, ROI timecourses and precuneus
+             seed correlations (resting_preproc.py)
+qa           tSNR, per-ROI TSNR table, overlays, tsdiff plot and the PDF
+             report (QA_fmri.py)
+
+Every stage of every subject runs in a fresh process, which reports its wall
+time, peak resident memory (of the stage and of the largest tool it ran)
+and the bytes it read and wrote (including the tools it ran). The truth of
+the synthetic data is checked along the way (outliers found by art, peak of
+the activation cluster).
+
+    python pipelines.py -n 2 --runs 2 -t 120 --json results.json
+    python pipelines.py -n 2 --baseline results.json --tolerance 0.25
+
+With --baseline, stages that got slower, bigger or did more I/O than the
+tolerance allows are listed and the exit status is 1.
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..', 'utils'))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..', 'utils', 'reportsink'))
+import numpy as np
+import nibabel as nb
+import synthetic
+import standins
+
+STAGES = ['generate', 'preproc', 'register', 'first_level', 'normalize',
+          'resting', 'qa']
+METRICS = ['time', 'peak_rss', 'read', 'written']
+FWHM = 6.
+
+
+def run(*cmd):
+    """Run a (stand-in) tool found on the PATH"""
+    cmd = [str(c) for c in cmd]
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT)
+    output = proc.communicate()[0]
+    if proc.returncode != 0:
+        raise RuntimeError('%s failed:\n%s' % (' '.join(cmd), output))
+
+
+def run_name(bold):
+    return os.path.split(bold)[1].split('.')[0]
+
+
+# Stages ---------------------------------------------------------------------
+
+def generate(files, work_dir, options):
+    synthetic.make_subject(options['root'], files['subject_id'],
+                           options['runs'], options['frames'],
+                           tuple(options['shape']), options['anat_zoom'],
+                           seed=options['seed'])
+    return {}
+
+
+def preproc(files, work_dir, options):
+    from nipype.algorithms.rapidart import ArtifactDetect
+    from tsdiff import time_slice_diffs, save_metrics
+    truth = json.load(open(files['truth']))
+    found = 0
+    for bold in files['bold']:
+        name = os.path.join(work_dir, run_name(bold))
+        run('mcflirt', '-in', bold, '-out', name + '_mcf', '-plots',
+            '-refvol', 0)
+        run('fslmaths', name + '_mcf.nii.gz', '-Tmean', name + '_mean')
+        run('bet', name + '_mean.nii.gz', name + '_brain', '-m', '-f', 0.3)
+        run('fslmaths', name + '_mcf.nii.gz', '-mas',
+            name + '_brain_mask.nii.gz', name + '_masked')
+        run('fslmaths', name + '_masked.nii.gz', '-s', FWHM / 2.3548,
+            name + '_smooth')
+        save_metrics(time_slice_diffs(name + '_masked.nii.gz'),
+                     name + '_tsdiff.npz')
+        cwd = os.getcwd()
+        os.chdir(work_dir)
+        try:
+            art = ArtifactDetect(realigned_files=name + '_masked.nii.gz',
+                                 realignment_parameters=name + '_mcf.par',
+                                 parameter_source='FSL', norm_threshold=1,
+                                 zintensity_threshold=3, mask_type='file',
+                                 mask_file=name + '_brain_mask.nii.gz',
+                                 use_differences=[True, False])
+            outliers = art.run().outputs.outlier_files
+        finally:
+            os.chdir(cwd)
+        detected = np.atleast_1d(np.loadtxt(outliers)).astype(int).tolist()
+        np.savetxt(name + '_outliers.txt', detected, fmt='%d')
+        run_truth = truth['runs'][files['bold'].index(bold)]
+        found += len(set(detected) & set(run_truth['outliers']))
+    expected = sum([len(r['outliers']) for r in truth['runs']])
+    return {'outliers found': '%d/%d' % (found, expected)}
+
+
+def register(files, work_dir, options):
+    from fslaffine import fsl_to_itk
+    from imagemeta import prime
+    run('mri_convert', files['brainmask'],
+        os.path.join(work_dir, 'brain.nii.gz'))
+    run('mri_convert', files['aparc+aseg'],
+        os.path.join(work_dir, 'aparc_aseg.nii.gz'))
+    mean = os.path.join(work_dir, run_name(files['bold'][0]) +
+                        '_mean.nii.gz')
+    run('bbregister', '--s', files['subject_id'], '--mov', mean, '--reg',
+        os.path.join(work_dir, 'register.dat'), '--fslmat',
+        os.path.join(work_dir, 'func2anat.mat'), '--init-fsl', '--bold',
+        '--sd', os.path.join(options['root'], 'surfaces'))
+    fsl_to_itk(os.path.join(work_dir, 'brain.nii.gz'), mean,
+               os.path.join(work_dir, 'func2anat.mat'),
+               os.path.join(work_dir, 'fsl2antsAffine.txt'))
+    prime([os.path.join(work_dir, f) for f in os.listdir(work_dir)
+           if f.endswith('.nii.gz')])
+    return {}
+
+
+def first_level(files, work_dir, options):
+    from clusters import label_clusters, cluster_summary, locate_clusters
+    truth = json.load(open(files['truth']))
+    distances = []
+    for i, bold in enumerate(files['bold']):
+        name = os.path.join(work_dir, run_name(bold))
+        run_truth = truth['runs'][i]
+        frames = len(run_truth['motion'])
+        regressor = synthetic.hrf_regressor(run_truth['onsets'],
+                                            run_truth['block'], frames)
+        # task regressor and one regressor per art outlier, as create_design
+        outliers = np.atleast_1d(np.loadtxt(name + '_outliers.txt')
+                                 ).astype(int)
+        X = np.zeros((frames, 1 + len(outliers)))
+        X[:, 0] = regressor - regressor.mean()
+        X[outliers, 1 + np.arange(len(outliers))] = 1
+        design = name + '_design.mat'
+        fp = open(design, 'w')
+        fp.write('/NumWaves\t%d\n/NumPoints\t%d\n/Matrix\n' % X.shape[::-1])
+        np.savetxt(fp, X, fmt='%.6f', delimiter='\t')
+        fp.close()
+        run('film_gls', '--in=%s_smooth.nii.gz' % name, '--pd=%s' % design,
+            '--rn=%s_stats' % name, '--thr=1000')
+        zstat = nb.load(name + '_stats/zstat1.nii.gz')
+        data = zstat.get_data()
+        labels = label_clusters(data, 2.3, 10)
+        summary = cluster_summary(labels, data)
+        locate_clusters(summary['voxels'], zstat.get_affine(),
+                        files['aparc+aseg'], files['lut'])
+        if len(summary['ids']):
+            top = np.argmax([data[tuple(p)] for p in summary['peaks']])
+            peak = zstat.get_affine().dot(
+                list(summary['peaks'][top]) + [1])[:3]
+            distances.append(np.sqrt(((peak - np.array(
+                run_truth['activation_center'])) ** 2).sum()))
+    return {'peak distance (mm)': '%.1f' % max(distances)
+            if distances else 'no clusters'}
+
+
+def normalize(files, work_dir, options):
+    from compositewarp import compose_warp, apply_composite_warp
+    field = compose_warp(files['template'],
+                         [files['warp'], files['affine'],
+                          os.path.join(work_dir, 'fsl2antsAffine.txt')],
+                         os.path.join(work_dir, 'composite_warp.nii.gz'),
+                         cache_dir=os.path.join(work_dir, 'cache'))
+    for bold in files['bold']:
+        name = os.path.join(work_dir, run_name(bold))
+        apply_composite_warp(name + '_smooth.nii.gz', field,
+                             name + '_smooth_wtsimt.nii.gz')
+    return {}
+
+
+def resting(files, work_dir, options):
+    from labelstats import label_stats
+    from seedcorr import SeedConnectivity
+    seeds = [1025, 2025]  # precuneus
+    for bold in files['bold']:
+        name = os.path.join(work_dir, run_name(bold))
+        aparc = name + '_aparc.nii.gz'
+        run('flirt', '-in', os.path.join(work_dir, 'aparc_aseg.nii.gz'),
+            '-ref', name + '_mean.nii.gz', '-out', aparc, '-applyxfm',
+            '-interp', 'nearestneighbour')
+        labels = nb.load(aparc).get_data().astype(int).ravel()
+        data = nb.load(name + '_masked.nii.gz').get_data()
+        data = np.asarray(data).reshape(-1, data.shape[3])
+        inside = labels > 0
+        conn = SeedConnectivity(data[inside], labels[inside])
+        table = conn.region_table(conn.region_correlations(seeds),
+                                  np.unique(labels[inside]))
+        label_stats(aparc, name + '_masked.nii.gz')
+        np.savetxt(name + '_seed_table.txt', table, fmt='%.4f')
+    return {}
+
+
+def qa(files, work_dir, options):
+    from labelstats import label_stats
+    from render import render_views
+    from tsdiff import load_metrics, plot_tsdiffs
+    from write_report import report
+    rep = report(os.path.join(work_dir, 'QA_report.pdf'),
+                 'QA report %s' % files['subject_id'])
+    for bold in files['bold']:
+        name = os.path.join(work_dir, run_name(bold))
+        run('fslmaths', name + '_masked.nii.gz', '-Tstd', name + '_std')
+        run('fslmaths', name + '_mean.nii.gz', '-div', name + '_std.nii.gz',
+            '-mas', name + '_brain_mask.nii.gz', name + '_tsnr')
+        stats = label_stats(name + '_aparc.nii.gz', name + '_tsnr.nii.gz',
+                            exclude=[0])[0]
+        table = [['ROI', 'TSNR', 'Voxels']] + [
+            [int(l), '%.2f' % m, int(c)] for l, m, c in
+            zip(stats['labels'], stats['means'][:, 0], stats['counts'])]
+        out_dir = name + '_overlay'
+        if not os.path.exists(out_dir):
+            os.makedirs(out_dir)
+        images = render_views(name + '_tsnr.nii.gz', name + '_mean.nii.gz',
+                              20, out_dir=out_dir)
+        plot = plot_tsdiffs(load_metrics(name + '_tsdiff.npz'),
+                            name + '_tsdiff.png', dpi=100)
+        rep.add_text('<b>%s</b>' % run_name(bold))
+        for image in list(images) + [plot]:
+            rep.add_image(image, scale=0.9)
+        rep.add_table(table)
+        rep.add_pagebreak()
+    rep.write()
+    return {}
+
+
+# Measurement ----------------------------------------------------------------
+
+def _proc_io():
+    """Bytes read and written by this process and its reaped children"""
+    try:
+        fields = dict([line.split(':') for line in open('/proc/self/io')])
+        return int(fields['rchar']), int(fields['wchar'])
+    except (IOError, OSError, KeyError, ValueError):
+        return None, None
+
+
+def _peak_rss():
+    """Peak resident memory (MB) of this process and of its largest child"""
+    import resource
+    # ru_maxrss is in bytes on OS X and in kilobytes on Linux
+    unit = 2. ** 20 if sys.platform == 'darwin' else 1024.
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+               ) / unit
+
+
+def _measure(stage, files, work_dir, options, queue):
+    import traceback
+    try:
+        read0, written0 = _proc_io()
+        t0 = time.time()
+        info = globals()[stage](files, work_dir, options)
+        elapsed = time.time() - t0
+        read1, written1 = _proc_io()
+        result = {'time': elapsed, 'peak_rss': _peak_rss(), 'info': info}
+        if read0 is not None:
+            result['read'] = (read1 - read0) / 2. ** 20
+            result['written'] = (written1 - written0) / 2. ** 20
+        queue.put(result)
+    except Exception:
+        queue.put({'error': traceback.format_exc()})
+
+
+def run_stage(stage, files, work_dir, options):
+    from multiprocessing import Process, Queue
+    queue = Queue()
+    proc = Process(target=_measure, args=(stage, files, work_dir, options,
+                                          queue))
+    proc.start()
+    result = queue.get()
+    proc.join()
+    return result
+
+
+def summarize(results):
+    """Totals per stage over subjects (peak memory is the maximum)"""
+    summary = {}
+    for stage in STAGES:
+        rows = [r[stage] for r in results.values()
+                if stage in r and 'error' not in r[stage]]
+        if not rows:
+            continue
+        summary[stage] = {}
+        for metric in METRICS:
+            values = [r[metric] for r in rows if metric in r]
+            if values:
+                summary[stage][metric] = max(values) if metric == \
+                    'peak_rss' else sum(values)
+    return summary
+
+
+def compare(summary, baseline, tolerance):
+    """Stage metrics that exceed the baseline by more than tolerance"""
+    regressions = []
+    for stage, metrics in summary.items():
+        for metric, value in metrics.items():
+            old = baseline.get(stage, {}).get(metric)
+            if old and value > old * (1 + tolerance):
+                regressions.append((stage, metric, old, value))
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="example: \
+            python pipelines.py -n 2 --runs 2 -t 120 --json results.json")
+    parser.add_argument('-n', '--subjects', dest='subjects', type=int,
+                        default=2, help='number of synthetic subjects')
+    parser.add_argument('--runs', dest='runs', type=int, default=2,
+                        help='BOLD runs per subject')
+    parser.add_argument('-t', '--frames', dest='frames', type=int,
+                        default=120, help='volumes per run')
+    parser.add_argument('--shape', dest='shape', type=int, nargs=3,
+                        default=[64, 64, 32], help='functional matrix')
+    parser.add_argument('--anat_zoom', dest='anat_zoom', type=float,
+                        default=2., help='anatomical voxel size (mm)')
+    parser.add_argument('--stages', dest='stages', nargs='+',
+                        default=STAGES, choices=STAGES,
+                        help='stages to run (generate is always run)')
+    parser.add_argument('--python', dest='python', default=None,
+                        help='command that runs the tool stand-ins')
+    parser.add_argument('--work_dir', dest='work_dir', default=None,
+                        help='keep data and outputs here')
+    parser.add_argument('--json', dest='json', default=None,
+                        help='write per subject and total results')
+    parser.add_argument('--baseline', dest='baseline', default=None,
+                        help='results of an earlier --json run')
+    parser.add_argument('--tolerance', dest='tolerance', type=float,
+                        default=0.25, help='allowed relative increase')
+    args = parser.parse_args()
+
+    root = args.work_dir or tempfile.mkdtemp()
+    stages = ['generate'] + [s for s in STAGES[1:] if s in args.stages]
+    os.environ['PATH'] = standins.install(os.path.join(root, 'bin'),
+                                          args.python) + os.pathsep + \
+        os.environ.get('PATH', '')
+    os.environ['SUBJECTS_DIR'] = os.path.join(root, 'surfaces')
+    os.environ['BIPS_IMAGEMETA_DIR'] = os.path.join(root, 'cache')
+    results = {}
+    failed = False
+    try:
+        for i in range(args.subjects):
+            subject_id = 'sub%03d' % (i + 1)
+            options = dict(root=root, runs=args.runs, frames=args.frames,
+                           shape=args.shape, anat_zoom=args.anat_zoom,
+                           seed=i)
+            work_dir = os.path.join(root, 'work', subject_id)
+            if not os.path.exists(work_dir):
+                os.makedirs(work_dir)
+            files = {'subject_id': subject_id}
+            results[subject_id] = {}
+            for stage in stages:
+                if stage != 'generate' and 'bold' not in files:
+                    files = json.load(open(os.path.join(
+                        root, 'data', subject_id, 'files.json')))
+                result = run_stage(stage, files, work_dir, options)
+                results[subject_id][stage] = result
+                if 'error' in result:
+                    print("%s %s failed:\n%s" % (subject_id, stage,
+                                                 result['error']))
+                    failed = True
+                    break
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(root)
+
+    summary = summarize(results)
+    print("%d subjects x %d runs x %d volumes of %s" % (
+        args.subjects, args.runs, args.frames,
+        'x'.join([str(s) for s in args.shape])))
+    print("%-12s %10s %12s %12s %12s" % ('stage', 'time (s)', 'peak (MB)',
+                                         'read (MB)', 'written (MB)'))
+    for stage in stages:
+        if stage not in summary:
+            continue
+        row = summary[stage]
+        print("%-12s %10.2f %12.1f %12s %12s" % (
+            stage, row['time'], row['peak_rss'],
+            '%.1f' % row['read'] if 'read' in row else '-',
+            '%.1f' % row['written'] if 'written' in row else '-'))
+    for subject_id in sorted(results):
+        for stage in stages:
+            info = results[subject_id].get(stage, {}).get('info')
+            if info:
+                print("%s %s: %s" % (subject_id, stage, ', '.join(
+                    ['%s %s' % item for item in sorted(info.items())])))
+    if args.json:
+        json.dump({'subjects': results, 'summary': summary},
+                  open(args.json, 'w'), indent=1)
+    if args.baseline:
+        baseline = json.load(open(args.baseline))['summary']
+        regressions = compare(summary, baseline, args.tolerance)
+        for stage, metric, old, new in regressions:
+            print("REGRESSION %s %s: %.2f -> %.2f" % (stage, metric, old,
+                                                      new))
+        failed = failed or bool(regressions)
+    sys.exit(1 if failed else 0)
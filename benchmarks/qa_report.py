@@ -0,0 +1,135 @@
+"""
+Benchmark QA report time per subject
+====================================
+
+Builds synthetic subjects (anatomical, 4D functional, tSNR map, motion and
+art norm files) and times the QA steps that QA_fmri.py runs for each of
+them: overlay rendering, tsdiffana, art norm and motion plots and the PDF
+report. Overlay rendering is timed once with a single worker and once with
+the thread pool.
+
+    python qa_report.py -n 5 --dpi 100
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'utils'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'fmri', 'qa'))
+import numpy as np
+import nibabel as nb
+from render import render_views
+from QA_utils import tsdiff_metrics, tsdiff_plot, plot_ADnorm, plot_motion
+from reportsink.write_report import report
+
+
+def make_subject(out_dir, shape=(64, 64, 32), frames=120, seed=0):
+    """Write synthetic inputs for one subject, return their filenames"""
+    rng = np.random.RandomState(seed)
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    affine = np.diag([3., 3., 4., 1.])
+    anat_affine = np.diag([1., 1., 1., 1.])
+    anat_shape = (shape[0] * 3, shape[1] * 3, shape[2] * 4)
+    grid = np.indices(anat_shape).astype(np.float32)
+    center = np.array(anat_shape, dtype=np.float32)[:, None, None, None] / 2
+    radius = np.sqrt((((grid - center) / center) ** 2).sum(axis=0))
+    anat = (radius < 0.8) * (800 + 100 * rng.rand(*anat_shape))
+    files = dict(anat=os.path.join(out_dir, 'orig.nii.gz'),
+                 func=os.path.join(out_dir, 'func.nii.gz'),
+                 tsnr=os.path.join(out_dir, 'func_tsnr.nii.gz'),
+                 motion=os.path.join(out_dir, 'func_mcf.par'),
+                 norm=os.path.join(out_dir, 'norm.func.txt'))
+    nb.Nifti1Image(anat.astype(np.float32), anat_affine).to_filename(
+        files['anat'])
+    func = 1000 + 20 * rng.randn(*(shape + (frames,)))
+    nb.Nifti1Image(func.astype(np.float32), affine).to_filename(files['func'])
+    tsnr = func.mean(axis=3) / func.std(axis=3)
+    nb.Nifti1Image(tsnr.astype(np.float32), affine).to_filename(
+        files['tsnr'])
+    np.savetxt(files['motion'], np.cumsum(rng.randn(frames, 6) * 0.01,
+                                          axis=0))
+    np.savetxt(files['norm'], np.abs(rng.randn(frames)) * 0.3)
+    return files
+
+
+def timed(func, *args, **kwargs):
+    t0 = time.time()
+    out = func(*args, **kwargs)
+    return out, time.time() - t0
+
+
+def run_subject(files, work_dir, dpi, workers, TR=2.0):
+    """Run the QA steps for one subject in work_dir, return step timings"""
+    cwd = os.getcwd()
+    if not os.path.exists(work_dir):
+        os.makedirs(work_dir)
+    os.chdir(work_dir)
+    try:
+        times = {}
+        images = []
+        for key, invert in [('overlay_tsnr', False), ('overlay_mask', True)]:
+            out, times[key] = timed(render_views, files['tsnr'],
+                                    files['anat'], 20 if not invert else 0,
+                                    invert_background=invert, dpi=dpi,
+                                    workers=workers)
+            images.extend(out)
+        metrics, times['tsdiff_metrics'] = timed(tsdiff_metrics,
+                                                 files['func'])
+        out, times['tsdiff_plot'] = timed(tsdiff_plot, metrics)
+        images.extend(out)
+        out, times['ADnorm'] = timed(plot_ADnorm, files['norm'], TR)
+        images.append(out)
+        out, times['motion'] = timed(plot_motion, files['motion'])
+        images.extend(out if isinstance(out, list) else [out])
+        t0 = time.time()
+        rep = report(os.path.join(work_dir, 'Preprocessing_Report.pdf'),
+                     'Preprocessing_Report')
+        for image in images:
+            rep.add_text(os.path.split(image)[1])
+            rep.add_image(image)
+        rep.write()
+        times['report'] = time.time() - t0
+        return times
+    finally:
+        os.chdir(cwd)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="example: \
+                        python qa_report.py -n 5 --dpi 100")
+    parser.add_argument('-n', '--num_subjects', dest='num_subjects',
+                        type=int, default=3, help='number of subjects')
+    parser.add_argument('--dpi', dest='dpi', type=int, default=100,
+                        help='resolution of the QA images')
+    parser.add_argument('-w', '--workers', dest='workers', type=int,
+                        default=4, help='render threads per subject')
+    parser.add_argument('-t', '--frames', dest='frames', type=int,
+                        default=120, help='volumes per functional run')
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        subjects = [make_subject(os.path.join(tmp_dir, 'sub%02d' % i),
+                                 frames=args.frames, seed=i)
+                    for i in range(args.num_subjects)]
+        for workers in [1, args.workers]:
+            totals = []
+            steps = {}
+            for i, files in enumerate(subjects):
+                times = run_subject(files, os.path.join(
+                    tmp_dir, 'qa_w%d_%02d' % (workers, i)), args.dpi,
+                    workers)
+                totals.append(sum(times.values()))
+                for key, value in times.items():
+                    steps.setdefault(key, []).append(value)
+            print("render workers: %d" % workers)
+            for key in sorted(steps):
+                print("  %-16s %.2f s" % (key, np.mean(steps[key])))
+            print("  %-16s %.2f s per subject" % ('total', np.mean(totals)))
+    finally:
+        shutil.rmtree(tmp_dir)
@@ -0,0 +1,111 @@
+"""
+Benchmark report writers
+========================
+
+Writes the same report (many QA images and large per-ROI TSNR tables) with
+the reportlab writer (write_report.report) and the HTML backend, each in a
+fresh process, and prints the wall time and peak resident memory of each.
+
+    python report_writer.py -n 200 --rois 180
+
+The PDF writer embeds the images, so its memory grows with the compressed
+size of the document, which reportlab keeps until it is saved.
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'utils', 'reportsink'))
+import numpy as np
+
+WRITERS = ['report', 'html_report']
+
+
+def make_images(out_dir, num_images, size=(2400, 1800)):
+    """Write num_images PNG line plots, like the QA motion and tsdiff plots"""
+    from PIL import Image, ImageDraw
+    rng = np.random.RandomState(0)
+    images = []
+    x = np.linspace(0, size[0] - 1, 400)
+    for i in range(num_images):
+        im = Image.new('RGB', size, (255, 255, 255))
+        draw = ImageDraw.Draw(im)
+        for color in [(0, 0, 255), (0, 128, 0), (255, 0, 0)]:
+            y = size[1] / 2. + np.cumsum(rng.randn(len(x))) * size[1] / 60.
+            draw.line(list(zip(x, np.clip(y, 0, size[1] - 1))), fill=color,
+                      width=3)
+        fname = os.path.join(out_dir, 'image%03d.png' % i)
+        im.save(fname)
+        images.append(fname)
+    return images
+
+
+def roi_table(num_rois, seed=0):
+    """TSNR table with the layout of QA_utils.combine_table"""
+    rng = np.random.RandomState(seed)
+    table = [['ROI', 'TSNR', 'Mean', 'Standard Deviation']]
+    for i in range(num_rois):
+        std = rng.uniform(5, 20)
+        tsnr = rng.uniform(20, 150)
+        table.append(['ctx-lh-region%03d' % i, tsnr, tsnr * std, std])
+    return table
+
+
+def write(writer, out_file, images, tables, queue):
+    import resource
+    import write_report
+    import html_report
+    cls = getattr(write_report, writer, None) or getattr(html_report,
+                                                         writer)
+    t0 = time.time()
+    rep = cls(out_file, 'Benchmark')
+    for i, image in enumerate(images):
+        rep.add_text('<b>Section %d</b>' % i)
+        rep.add_text(os.path.split(image)[1])
+        rep.add_image(image)
+        if i < len(tables):
+            rep.add_table(tables[i])
+    rep.write()
+    queue.put((time.time() - t0,
+               resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.))
+
+
+if __name__ == "__main__":
+    from multiprocessing import Process, Queue
+    parser = argparse.ArgumentParser(description="example: \
+                        python report_writer.py -n 200 --rois 180")
+    parser.add_argument('-n', '--num_images', dest='num_images', type=int,
+                        default=200, help='number of images')
+    parser.add_argument('--rois', dest='rois', type=int, default=180,
+                        help='rows of each ROI table')
+    parser.add_argument('--tables', dest='tables', type=int, default=10,
+                        help='number of ROI tables')
+    parser.add_argument('--width', dest='width', type=int, default=2400,
+                        help='image width in pixels')
+    parser.add_argument('--height', dest='height', type=int, default=1800,
+                        help='image height in pixels')
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        images = make_images(tmp_dir, args.num_images,
+                             (args.width, args.height))
+        tables = [roi_table(args.rois, i) for i in range(args.tables)]
+        print("%d images of %dx%d, %d tables of %d rows" % (
+            len(images), args.width, args.height, len(tables), args.rois))
+        print("%-14s %10s %14s" % ('writer', 'time', 'peak memory'))
+        for writer in WRITERS:
+            ext = '.html' if writer == 'html_report' else '.pdf'
+            queue = Queue()
+            proc = Process(target=write, args=(
+                writer, os.path.join(tmp_dir, writer + ext), images, tables,
+                queue))
+            proc.start()
+            elapsed, peak = queue.get()
+            proc.join()
+            print("%-14s %9.2fs %11.1f MB" % (writer, elapsed, peak))
+    finally:
+        shutil.rmtree(tmp_dir)
@@ -0,0 +1,206 @@
+"""
+Benchmark the stacked first level GLM
+=====================================
+
+Writes a synthetic block design cohort the way first_level.py finds it in
+the sink (FEAT design and contrast files under _generate_model<k>/,
+highpassed runs under _highpass<k>/): every run shares the task regressors
+but has its own motion, noise and outlier regressors, and a run specific
+effect size so that mixing up runs shows. utils/stackedglm.py fits the
+cohort once with the default chunk size and once with chunks smaller than a
+run, and both are checked against a separate least squares fit of every run
+with its full design. The runs must be fit in groups of more than one, and
+the z statistic of a voxel with a t far above 40 must stay finite.
+
+    python stacked_glm.py -n 4 --runs 11 --shape 16 16 8
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'utils'))
+import numpy as np
+import nibabel as nb
+from scipy import stats
+from stackedglm import stacked_glm
+
+CONDITIONS = ['Faces', 'Scenes']
+
+
+def task_regressors(n_vols, block=10):
+    """Two alternating block conditions, smoothed like an HRF"""
+    T = np.zeros((n_vols, len(CONDITIONS)))
+    for i in range(n_vols // block):
+        if i % 3 < 2:
+            T[i * block:(i + 1) * block, i % 3] = 1
+    kernel = stats.gamma.pdf(np.arange(12), 6)
+    T = np.array([np.convolve(t, kernel)[:n_vols] for t in T.T]).T
+    return T - T.mean(axis=0)
+
+
+def nuisance_regressors(n_vols, rng):
+    """Motion, noise components and outlier indicators of one run"""
+    motion = np.cumsum(rng.randn(n_vols, 6) * 0.05, axis=0)
+    noise = rng.randn(n_vols, 3)
+    outliers = rng.choice(n_vols, rng.randint(0, 3), replace=False)
+    indicators = np.zeros((n_vols, len(outliers)))
+    indicators[outliers, np.arange(len(outliers))] = 1
+    N = np.hstack([motion, noise, indicators])
+    return N - N.mean(axis=0)
+
+
+def write_fsl(fname, matrix, names=None):
+    fp = open(fname, 'w')
+    for i, name in enumerate(names or []):
+        fp.write('/ContrastName%d\t%s\n' % (i + 1, name))
+    fp.write('/NumWaves\t%d\n' % matrix.shape[1])
+    if names:
+        fp.write('/NumContrasts\t%d\n' % matrix.shape[0])
+    else:
+        fp.write('/NumPoints\t%d\n' % matrix.shape[0])
+    fp.write('/Matrix\n')
+    for row in matrix:
+        fp.write(' '.join(['%.8e' % x for x in row]) + '\n')
+    fp.close()
+
+
+def make_cohort(base_dir, n_subjects, n_runs, shape, n_vols, seed=0):
+    """Write the cohort, return the stacked_glm inputs and the truth"""
+    rng = np.random.RandomState(seed)
+    T = task_regressors(n_vols)
+    subjects = ['sub%02d' % (i + 1) for i in range(n_subjects)]
+    designs, cons, funcs, truth = [], [], [], {}
+    for subject in subjects:
+        designs.append([])
+        cons.append([])
+        funcs.append([])
+        for k in range(n_runs):
+            X = np.hstack([T, nuisance_regressors(n_vols, rng)])
+            model_dir = os.path.join(base_dir, subject,
+                                     '_generate_model%d' % k)
+            func_dir = os.path.join(base_dir, subject, '_highpass%d' % k)
+            for path in [model_dir, func_dir]:
+                os.makedirs(path)
+            write_fsl(os.path.join(model_dir, 'run%d.mat' % k), X)
+            C = np.zeros((2, X.shape[1]))
+            C[0, :2] = [1, -1]
+            C[1, 0] = 1
+            write_fsl(os.path.join(model_dir, 'run%d.con' % k), C,
+                      ['Faces-Scenes', 'Faces'])
+            n_voxels = int(np.prod(shape))
+            beta = rng.randn(X.shape[1], n_voxels)
+            # run specific effect: a run fit with another run's data shows
+            beta[0] += 2 * k
+            Y = X.dot(beta) + rng.randn(n_vols, n_voxels)
+            Y[:, -1] = X.dot(beta[:, -1]) * 100 + rng.randn(n_vols) * 0.01
+            data = (Y.T + 10000).reshape(shape + (n_vols,)).astype(np.float32)
+            # voxels outside the brain
+            data[:, :, 0] = 10
+            fname = os.path.join(func_dir, '%s_run%d_hpf.nii.gz' % (subject,
+                                                                   n_runs - k))
+            nb.Nifti1Image(data, np.eye(4)).to_filename(fname)
+            designs[-1].append(os.path.join(model_dir, 'run%d.mat' % k))
+            cons[-1].append(os.path.join(model_dir, 'run%d.con' % k))
+            funcs[-1].append(fname)
+            truth[(subject, k)] = (X, C, data)
+    # in the order of a glob
+    return (subjects, [sorted(d) for d in designs], [sorted(c) for c in cons],
+            [sorted(f) for f in funcs], truth)
+
+
+def reference_fit(X, C, data, threshold):
+    mask = data.mean(axis=3) > threshold
+    Y = data[mask].T.astype(np.float64)
+    Y -= Y.mean(axis=0)
+    B = np.linalg.lstsq(X, Y, rcond=None)[0]
+    dof = X.shape[0] - np.linalg.matrix_rank(X)
+    s2 = ((Y - X.dot(B)) ** 2).sum(axis=0) / dof
+    XtXi = np.linalg.inv(X.T.dot(X))
+    t = C.dot(B) / np.sqrt(np.diag(C.dot(XtXi).dot(C.T))[:, None] * s2)
+    return mask, B, t
+
+
+def check(out_dir, truth, threshold):
+    worst = 0.
+    for (subject, k), (X, C, data) in sorted(truth.items()):
+        mask, B, t = reference_fit(X, C, data, threshold)
+        run_dir = os.path.join(out_dir, '_subject_%s' % subject, '_run%d' % k)
+        for i in range(B.shape[0]):
+            if i < len(CONDITIONS):
+                pe = 'pe%02d_%s.nii.gz' % (i + 1, CONDITIONS[i])
+            else:
+                pe = 'pe%02d.nii.gz' % (i + 1)
+            pe = nb.load(os.path.join(run_dir, pe))
+            pe = np.asarray(pe.dataobj)[mask]
+            worst = max(worst, np.max(np.abs(pe - B[i]) /
+                                      (np.abs(B[i]) + 1.)))
+        for i, label in enumerate(['01_Faces-Scenes', '02_Faces']):
+            tstat = nb.load(os.path.join(run_dir, 'tstat%s.nii.gz' % label))
+            tstat = np.asarray(tstat.dataobj)[mask]
+            worst = max(worst, np.max(np.abs(tstat - t[i]) /
+                                      (np.abs(t[i]) + 1.)))
+            zstat = nb.load(os.path.join(run_dir, 'zstat%s.nii.gz' % label))
+            zstat = np.asarray(zstat.dataobj)[mask]
+            assert np.all(np.isfinite(zstat)), (subject, k, label)
+            assert np.all(np.sign(zstat) == np.sign(tstat))
+    return worst
+
+
+def fit(inputs, threshold, chunk_size):
+    subjects, designs, cons, funcs = inputs
+    cwd = os.getcwd()
+    out_dir = tempfile.mkdtemp()
+    os.chdir(out_dir)
+    try:
+        t0 = time.time()
+        out_files, groups = stacked_glm(subjects, designs, cons, funcs,
+                                        threshold, [len(CONDITIONS)] *
+                                        len(subjects), chunk_size,
+                                        [CONDITIONS] * len(subjects))
+        elapsed = time.time() - t0
+    finally:
+        os.chdir(cwd)
+    return out_dir, groups, elapsed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="example: \
+                        python stacked_glm.py -n 4 --runs 11")
+    parser.add_argument('-n', '--subjects', dest='subjects', type=int,
+                        default=4, help='number of subjects')
+    parser.add_argument('--runs', dest='runs', type=int, default=11,
+                        help='runs per subject')
+    parser.add_argument('--shape', dest='shape', type=int, nargs=3,
+                        default=[16, 16, 8], help='volume shape')
+    parser.add_argument('--vols', dest='vols', type=int, default=120,
+                        help='volumes per run')
+    args = parser.parse_args()
+
+    threshold = 1000
+    base_dir = tempfile.mkdtemp()
+    try:
+        cohort = make_cohort(base_dir, args.subjects, args.runs,
+                             tuple(args.shape), args.vols)
+        inputs, truth = cohort[:4], cohort[4]
+        n_voxels = int(np.prod(args.shape[:2]) * (args.shape[2] - 1))
+        print("%d subjects x %d runs, %d voxels per run" % (
+            args.subjects, args.runs, n_voxels))
+        print("%-28s %8s %10s %10s" % ('chunk size', 'groups', 'largest',
+                                       'time (s)'))
+        for chunk_size in [200000, n_voxels // 3]:
+            out_dir, groups, elapsed = fit(inputs, threshold, chunk_size)
+            try:
+                worst = check(out_dir, truth, threshold)
+            finally:
+                shutil.rmtree(out_dir)
+            largest = max([len(g) for g in groups])
+            print("%-28d %8d %10d %10.2f" % (chunk_size, len(groups),
+                                             largest, elapsed))
+            assert largest > 1
+            assert sum([len(g) for g in groups]) == len(truth)
+            assert worst < 1e-4, worst
+    finally:
+        shutil.rmtree(base_dir)
@@ -0,0 +1,318 @@
+"""
+Tool stand-ins
+==============
+
+Lightweight Python replacements for the FSL and FreeSurfer commands the
+pipelines call. Each one takes the tool's command line, reads the same
+inputs and writes outputs with the names, shapes and formats the real tool
+would, doing a cheap approximation of the work:
+
+mcflirt      center of mass realignment to -refvol (translations only)
+bet          intensity threshold brain mask
+fslmaths     -Tmean -Tstd -s -mas -div -thr -bin
+flirt        world space (header) registration, resampling with -applyxfm
+bbregister   header registration; register.dat, FSL matrix and .mincost
+mri_convert  format conversion
+film_gls     ordinary least squares GLM with the FSL design.mat; pe, res4d,
+             sigmasquareds and the zstat of the first regressor
+
+install(bin_dir) writes an executable wrapper per tool into bin_dir; put
+bin_dir first on the PATH and the pipelines (or nipype) run the stand-ins.
+
+    python standins.py fslmaths in.nii.gz -Tmean mean.nii.gz
+"""
+import os
+import stat
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'utils'))
+import numpy as np
+import nibabel as nb
+from scipy import ndimage
+
+TOOLS = ['mcflirt', 'bet', 'fslmaths', 'flirt', 'bbregister', 'mri_convert',
+         'film_gls']
+
+
+def _image_name(name, default_ext='.nii.gz'):
+    if name.endswith('.nii') or name.endswith('.nii.gz') or \
+            name.endswith('.mgz') or name.endswith('.mgh'):
+        return name
+    return name + default_ext
+
+
+def _strip(name):
+    for ext in ['.nii.gz', '.nii', '.mgz', '.mgh']:
+        if name.endswith(ext):
+            return name[:-len(ext)]
+    return name
+
+
+def _save(data, like, filename, dtype=np.float32):
+    filename = _image_name(filename)
+    if filename.endswith('.mgz') or filename.endswith('.mgh'):
+        if dtype not in (np.uint8, np.int32, np.float32):
+            dtype = np.float32
+        img = nb.MGHImage(np.asarray(data, dtype), like.get_affine())
+    else:
+        img = nb.Nifti1Image(np.asarray(data, dtype), like.get_affine())
+        zooms = tuple(like.get_header().get_zooms())
+        img.get_header().set_zooms((zooms + (1.,) * 4)[:data.ndim])
+    img.to_filename(filename)
+    return filename
+
+
+def _options(argv, flags=()):
+    """-opt value / --opt=value / --opt value pairs and positionals"""
+    opts, args = {}, []
+    i = 0
+    while i < len(argv):
+        arg = argv[i]
+        if arg.startswith('-') and len(arg) > 1 and not _number(arg):
+            key = arg.lstrip('-')
+            if '=' in key:
+                key, value = key.split('=', 1)
+                opts[key] = value
+            elif key in flags or i + 1 == len(argv) or \
+                    (argv[i + 1].startswith('-') and
+                     not _number(argv[i + 1])):
+                opts[key] = True
+            else:
+                opts[key] = argv[i + 1]
+                i += 1
+        else:
+            args.append(arg)
+        i += 1
+    return opts, args
+
+
+def _number(text):
+    try:
+        float(text)
+        return True
+    except ValueError:
+        return False
+
+
+def mcflirt(argv):
+    opts, _ = _options(argv, flags=('plots', 'mats', 'rmsabs', 'rmsrel',
+                                    'stats', 'stages'))
+    img = nb.load(opts['in'])
+    data = img.get_data()
+    out = opts.get('out', _strip(opts['in']) + '_mcf')
+    zooms = np.array(img.get_header().get_zooms()[:3])
+    ref = int(opts.get('refvol', data.shape[3] // 2))
+    mask = data[..., ref] > np.percentile(data[..., ref], 50)
+    ref_com = np.array(ndimage.center_of_mass(data[..., ref] * mask))
+    params = np.zeros((data.shape[3], 6))
+    out_data = np.zeros(data.shape, np.float32)
+    for t in range(data.shape[3]):
+        vol = np.asarray(data[..., t], dtype=np.float32)
+        shift = ref_com - np.array(ndimage.center_of_mass(vol * mask))
+        params[t, 3:] = -shift * zooms
+        out_data[..., t] = ndimage.shift(vol, shift, order=1)
+    _save(out_data, img, out)
+    if opts.get('plots'):
+        np.savetxt(_strip(out) + '.par', params, fmt='%.6f')
+
+
+def bet(argv):
+    opts, args = _options(argv, flags=('m', 'n', 'R', 'F'))
+    img = nb.load(args[0])
+    data = np.asarray(img.get_data(), dtype=np.float32)
+    vol = data.mean(axis=3) if data.ndim == 4 else data
+    frac = float(opts.get('f', 0.5))
+    robust = np.percentile(vol, 98)
+    mask = ndimage.binary_fill_holes(ndimage.binary_opening(
+        vol > 0.2 * frac * robust, iterations=1))
+    out = _image_name(args[1])
+    if not opts.get('n'):
+        _save(data * (mask[..., None] if data.ndim == 4 else mask), img, out)
+    if opts.get('m'):
+        _save(mask, img, _strip(out) + '_mask', np.uint8)
+
+
+def fslmaths(argv):
+    img = nb.load(argv[0])
+    data = np.asarray(img.get_data(), dtype=np.float32)
+    i = 1
+    while i < len(argv) - 1:
+        op = argv[i]
+        if op == '-Tmean':
+            data = data.mean(axis=3)
+        elif op == '-Tstd':
+            data = data.std(axis=3)
+        elif op == '-bin':
+            data = (data != 0).astype(np.float32)
+        elif op in ('-s', '-thr', '-mas', '-div', '-mul', '-add', '-sub'):
+            i += 1
+            value = argv[i]
+            if op == '-s':
+                sigma = float(value) / np.array(
+                    img.get_header().get_zooms()[:3])
+                sigma = tuple(sigma) + (0,) * (data.ndim - 3)
+                data = ndimage.gaussian_filter(data, sigma)
+            elif op == '-thr':
+                data = np.where(data < float(value), 0, data)
+            else:
+                other = float(value) if _number(value) else np.asarray(
+                    nb.load(value).get_data(), dtype=np.float32)
+                if not np.isscalar(other) and other.ndim < data.ndim:
+                    other = other[..., None]
+                if op == '-mas':
+                    data = data * (other != 0)
+                elif op == '-div':
+                    data = data / np.where(other == 0, 1, other)
+                elif op == '-mul':
+                    data = data * other
+                elif op == '-add':
+                    data = data + other
+                else:
+                    data = data - other
+        else:
+            raise ValueError('fslmaths stand-in: unsupported %s' % op)
+        i += 1
+    _save(data, img, argv[-1])
+
+
+def _resample(img, ref, ras, order=1):
+    """Resample img onto the grid of ref; ras maps img world to ref world"""
+    ref_shape = ref.get_shape()[:3]
+    ijk = np.indices(ref_shape).reshape(3, -1)
+    vox = np.linalg.inv(img.get_affine()).dot(np.linalg.inv(ras)).dot(
+        ref.get_affine()).dot(np.vstack((ijk, np.ones((1, ijk.shape[1])))))
+    data = img.get_data()
+    frames = data.shape[3] if data.ndim == 4 else 1
+    data = np.asarray(data, dtype=np.float32).reshape(data.shape[:3] +
+                                                      (frames,))
+    out = np.zeros(ref_shape + (frames,), np.float32)
+    for t in range(frames):
+        out[..., t] = ndimage.map_coordinates(
+            data[..., t], vox[:3], order=order).reshape(ref_shape)
+    return out if frames > 1 else out[..., 0]
+
+
+def _fsl_matrix(src, ref):
+    """FSL matrix of the header (world space) registration of src to ref"""
+    from fslaffine import vox2fsl
+    src_shape, ref_shape = src.get_shape()[:3], ref.get_shape()[:3]
+    return vox2fsl(ref_shape, ref.get_affine()).dot(
+        np.linalg.inv(ref.get_affine())).dot(src.get_affine()).dot(
+        np.linalg.inv(vox2fsl(src_shape, src.get_affine())))
+
+
+def flirt(argv):
+    from fslaffine import fsl2ras
+    opts, _ = _options(argv, flags=('applyxfm', 'nosearch', 'usesqform',
+                                    'noresample'))
+    img, ref = nb.load(opts['in']), nb.load(opts['ref'])
+    if opts.get('init'):
+        mat = np.loadtxt(opts['init'])
+    else:
+        mat = _fsl_matrix(img, ref)
+    if opts.get('omat'):
+        np.savetxt(opts['omat'], mat, fmt='%.6f')
+    if opts.get('out'):
+        ras = fsl2ras(mat, ref.get_shape()[:3], ref.get_affine(),
+                      img.get_shape()[:3], img.get_affine())
+        order = 0 if opts.get('interp') == 'nearestneighbour' else 1
+        _save(_resample(img, ref, ras, order), ref, opts['out'])
+
+
+def bbregister(argv):
+    opts, _ = _options(argv, flags=('init-fsl', 'init-header', 'bold',
+                                    't1', 't2'))
+    subjects_dir = opts.get('sd', os.environ.get('SUBJECTS_DIR', '.'))
+    orig = nb.load(os.path.join(subjects_dir, opts['s'], 'mri', 'orig.mgz'))
+    orig.get_data()
+    mov = nb.load(opts['mov'])
+    zooms = mov.get_header().get_zooms()
+    fp = open(opts['reg'], 'w')
+    try:
+        fp.write('%s\n%f\n%f\n0.150000\n' % (opts['s'], zooms[0], zooms[2]))
+        for row in np.eye(4):
+            fp.write(' '.join(['%.6f' % v for v in row]) + '\n')
+        fp.write('round\n')
+    finally:
+        fp.close()
+    fp = open(opts['reg'] + '.mincost', 'w')
+    fp.write('0.4500 72.1 61.3 16.2\n')
+    fp.close()
+    if opts.get('fslmat'):
+        np.savetxt(opts['fslmat'], _fsl_matrix(mov, orig), fmt='%.6f')
+
+
+def mri_convert(argv):
+    opts, args = _options(argv)
+    img = nb.load(args[0])
+    data = img.get_data()
+    _save(data, img, args[1], data.dtype.type)
+
+
+def _read_design(filename):
+    rows, started = [], False
+    for line in open(filename):
+        if started and line.strip():
+            rows.append([float(v) for v in line.split()])
+        if line.startswith('/Matrix'):
+            started = True
+    return np.array(rows)
+
+
+def film_gls(argv):
+    from scipy import stats
+    opts, _ = _options(argv, flags=('sa', 'ms', 'epith', 'noest'))
+    img = nb.load(opts['in'])
+    X = _read_design(opts['pd'])
+    out_dir = opts.get('rn', 'results')
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    data = np.asarray(img.get_data(), dtype=np.float64)
+    shape = data.shape[:3]
+    Y = data.reshape(-1, data.shape[3]).T
+    Y = Y - Y.mean(axis=0)
+    pinv = np.linalg.pinv(X)
+    betas = pinv.dot(Y)
+    res = Y - X.dot(betas)
+    dof = X.shape[0] - np.linalg.matrix_rank(X)
+    sigma2 = (res ** 2).sum(axis=0) / dof
+    for i in range(X.shape[1]):
+        _save(betas[i].reshape(shape), img, os.path.join(out_dir,
+                                                         'pe%d' % (i + 1)))
+    _save(sigma2.reshape(shape), img, os.path.join(out_dir, 'sigmasquareds'))
+    _save(res.T.reshape(data.shape), img, os.path.join(out_dir, 'res4d'))
+    var = sigma2 * pinv.dot(pinv.T)[0, 0]
+    t = betas[0] / np.sqrt(np.where(var > 0, var, np.inf))
+    z = stats.norm.isf(stats.t.sf(t, dof))
+    _save(np.clip(z, -20, 20).reshape(shape), img,
+          os.path.join(out_dir, 'zstat1'))
+
+
+def install(bin_dir, python=None):
+    """Write an executable wrapper for every stand-in into bin_dir
+
+    python is the command that runs the stand-ins. Default = this
+    interpreter
+    """
+    if python is None:
+        python = sys.executable
+    if not os.path.exists(bin_dir):
+        os.makedirs(bin_dir)
+    script = os.path.abspath(__file__)
+    if script.endswith('.pyc'):
+        script = script[:-1]
+    for tool in TOOLS:
+        fname = os.path.join(bin_dir, tool)
+        fp = open(fname, 'w')
+        fp.write('#!/bin/sh\nexec %s "%s" %s "$@"\n' % (python, script,
+                                                       tool))
+        fp.close()
+        os.chmod(fname, os.stat(fname).st_mode | stat.S_IXUSR |
+                 stat.S_IXGRP | stat.S_IXOTH)
+    return bin_dir
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] not in TOOLS:
+        sys.exit('usage: standins.py {%s} args' % ','.join(TOOLS))
+    globals()[sys.argv[1]](sys.argv[2:])
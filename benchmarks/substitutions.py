@@ -0,0 +1,88 @@
+"""
+Benchmark DataSink path substitution
+====================================
+
+Sinks a synthetic set of preprocessing outputs with nipype's DataSink and
+with SubstitutionDataSink, using the substitutions the resting and task
+pipelines generate, checks that both produce the same files and reports the
+time each took.
+
+    python substitutions.py -n 5000
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'fmri'))
+import nipype.interfaces.io as nio
+from utils import (get_substitutions, get_regexp_substitutions,
+                   SubstitutionDataSink)
+
+
+def make_outputs(src_dir, subject_id, num_files):
+    """Create empty files laid out like nipype iterable/MapNode outputs"""
+    prefixes = ['_bandpass_filter', '_scale_median', '_create_nuisance_filter',
+                '_tsnr', '_z_score']
+    files = []
+    for i in range(num_files):
+        run = i % 20
+        prefix = prefixes[(i // 20) % len(prefixes)]
+        folder = os.path.join(src_dir, '_subject_id_%s' % subject_id,
+                              '_fwhm_%d' % (5 * (i % 2)), '%s%d' % (prefix, run))
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        fname = os.path.join(folder, 'corr_%s_%05d_filt.nii.gz' % (subject_id,
+                                                                   i))
+        open(fname, 'w').close()
+        files.append(fname)
+    return files
+
+
+def run_sink(sink, out_dir, subject_id, files):
+    sink.inputs.base_directory = out_dir
+    sink.inputs.container = subject_id
+    sink.inputs.substitutions = get_substitutions(subject_id, True)
+    sink.inputs.regexp_substitutions = get_regexp_substitutions(subject_id,
+                                                                True)
+    setattr(sink.inputs, 'preproc.output', files)
+    t0 = time.time()
+    sink.run()
+    return time.time() - t0
+
+
+def list_tree(root):
+    found = []
+    for path, _, fnames in os.walk(root):
+        for fname in fnames:
+            found.append(os.path.relpath(os.path.join(path, fname), root))
+    return sorted(found)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="example: \
+                        python substitutions.py -n 5000")
+    parser.add_argument('-n', '--num_files', dest='num_files', type=int,
+                        default=5000, help='number of files to sink')
+    parser.add_argument('-s', '--subject', dest='subject', default='SAD_024',
+                        help='subject id used to build substitutions')
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        files = make_outputs(os.path.join(tmp_dir, 'src'), args.subject,
+                             args.num_files)
+        plain = run_sink(nio.DataSink(), os.path.join(tmp_dir, 'plain'),
+                         args.subject, files)
+        fast = run_sink(SubstitutionDataSink(), os.path.join(tmp_dir, 'fast'),
+                        args.subject, files)
+        same = (list_tree(os.path.join(tmp_dir, 'plain')) ==
+                list_tree(os.path.join(tmp_dir, 'fast')))
+        print("files sunk: %d" % len(files))
+        print("DataSink: %.2f s" % plain)
+        print("SubstitutionDataSink: %.2f s" % fast)
+        print("identical outputs: %s" % same)
+    finally:
+        shutil.rmtree(tmp_dir)
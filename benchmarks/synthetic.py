@@ -0,0 +1,310 @@
+"""
+Synthetic subjects
+==================
+
+Writes subjects that look enough like the lab's data for the pipelines'
+Python steps and the tool stand-ins (see standins.py) to run on:
+
+<root>/data/<subject>/BOLD/run<NN>.nii.gz  4D BOLD with known rigid motion,
+                                          spike outliers and a block design
+                                          activation
+<root>/data/<subject>/onsets.txt          FSL 3 column onsets of the blocks
+<root>/data/<subject>/truth.json          motion, outliers, activation
+<root>/surfaces/<subject>/mri/            orig.mgz, brainmask.mgz and
+                                          aparc+aseg.mgz (ellipsoid brain
+                                          with cortical parcels, white
+                                          matter and ventricles)
+<root>/surfaces/<subject>/reg/            func2anat.mat (FSL), register.dat
+                                          (tkregister), ants_Affine.txt and
+                                          ants_Warp.nii.gz to the template
+<root>/template.nii.gz                    2mm template
+<root>/FreeSurferColorLUT.txt             color table of the labels used
+
+    python synthetic.py -o /tmp/bips_synthetic -n 2 --runs 2 -t 120
+"""
+import argparse
+import json
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'utils'))
+import numpy as np
+import nibabel as nb
+from scipy import ndimage
+from fslaffine import vox2fsl, write_itk_affine
+
+TR = 2.
+FUNC_ZOOMS = (3., 3., 4.)
+# left / right ids of the aseg structures and of the aparc parcels
+ASEG = {'Cerebral-White-Matter': (2, 41), 'Cerebral-Cortex': (3, 42),
+        'Lateral-Ventricle': (4, 43)}
+PARCELS = ['bankssts', 'caudalanteriorcingulate', 'caudalmiddlefrontal',
+           'cuneus', 'entorhinal', 'fusiform', 'inferiorparietal',
+           'inferiortemporal', 'isthmuscingulate', 'lateraloccipital',
+           'lateralorbitofrontal', 'lingual', 'medialorbitofrontal',
+           'middletemporal', 'parahippocampal', 'paracentral',
+           'parsopercularis', 'parsorbitalis', 'parstriangularis',
+           'pericalcarine', 'postcentral', 'posteriorcingulate',
+           'precentral', 'precuneus', 'rostralanteriorcingulate',
+           'rostralmiddlefrontal', 'superiorfrontal', 'superiorparietal',
+           'superiortemporal', 'supramarginal', 'frontalpole',
+           'temporalpole', 'transversetemporal', 'insula']
+
+
+def write_lut(filename):
+    fp = open(filename, 'w')
+    try:
+        fp.write('#No. Label Name:                R   G   B   A\n')
+        fp.write('0   Unknown                     0   0   0   0\n')
+        for name, (left, right) in sorted(ASEG.items()):
+            fp.write('%d  Left-%s  120 120 120 0\n' % (left, name))
+            fp.write('%d  Right-%s  120 120 120 0\n' % (right, name))
+        for i, name in enumerate(PARCELS):
+            fp.write('%d  ctx-lh-%s  100 100 100 0\n' % (1001 + i, name))
+            fp.write('%d  ctx-rh-%s  100 100 100 0\n' % (2001 + i, name))
+    finally:
+        fp.close()
+    return filename
+
+
+def centered_affine(shape, zooms):
+    """LAS affine with the world origin at the center of the grid"""
+    affine = np.diag([-zooms[0], zooms[1], zooms[2], 1.])
+    affine[:3, 3] = -affine[:3, :3].dot((np.array(shape) - 1) / 2.)
+    return affine
+
+
+def _radius(shape, affine, radii, center=(0, 0, 0)):
+    """Ellipsoidal radius (1 on the surface) of every voxel, in world mm"""
+    ijk = np.indices(shape).reshape(3, -1)
+    xyz = affine[:3, :3].dot(ijk) + affine[:3, 3:]
+    xyz = (xyz - np.array(center)[:, None]) / np.array(radii)[:, None]
+    return np.sqrt((xyz ** 2).sum(axis=0)).reshape(shape), xyz
+
+
+def make_anatomy(shape, affine, seed=0):
+    """orig, brainmask and aparc+aseg volumes on the anatomical grid"""
+    rng = np.random.RandomState(seed)
+    radii = (70., 85., 65.)
+    radius, xyz = _radius(shape, affine, radii)
+    seg = np.zeros(shape, np.int32)
+    left = (xyz[0] < 0).reshape(shape)
+    wm = radius < 0.8
+    seg[wm & left], seg[wm & ~left] = ASEG['Cerebral-White-Matter']
+    # cortex: parcels by angle around the center
+    cortex = (radius >= 0.8) & (radius < 1)
+    azimuth = np.arctan2(xyz[1], np.abs(xyz[0])).reshape(shape)
+    elevation = np.arctan2(xyz[2], np.sqrt(xyz[0] ** 2 + xyz[1] ** 2)
+                           ).reshape(shape)
+    n_az, n_el = 7, 5
+    parcel = (np.clip(((azimuth + np.pi / 2) / np.pi * n_az).astype(int), 0,
+                      n_az - 1) * n_el +
+              np.clip(((elevation + np.pi / 2) / np.pi * n_el).astype(int), 0,
+                      n_el - 1)) % len(PARCELS)
+    seg[cortex & left] = 1001 + parcel[cortex & left]
+    seg[cortex & ~left] = 2001 + parcel[cortex & ~left]
+    for side, x in [(0, -12.), (1, 12.)]:
+        vent, _ = _radius(shape, affine, (6., 25., 10.), (x, 0., 5.))
+        seg[vent < 1] = ASEG['Lateral-Ventricle'][side]
+    intensity = np.zeros(shape, np.float32)
+    intensity[seg > 0] = 80
+    intensity[wm] = 110
+    intensity[(seg == 4) | (seg == 43)] = 30
+    orig = intensity + 5 * rng.randn(*shape).astype(np.float32)
+    orig = np.clip(ndimage.gaussian_filter(orig, 0.7) + 10 * (radius < 1.15),
+                   0, 255)
+    mask = seg > 0
+    return orig.astype(np.uint8), (orig * mask).astype(np.uint8), seg
+
+
+def rigid_matrix(params):
+    """4x4 matrix of mcflirt parameters (rx, ry, rz radians, tx, ty, tz mm)"""
+    rx, ry, rz = params[:3]
+    cx, cy, cz, sx, sy, sz = (np.cos(rx), np.cos(ry), np.cos(rz),
+                              np.sin(rx), np.sin(ry), np.sin(rz))
+    rot = np.array([[1, 0, 0], [0, cx, -sx], [0, sx, cx]]).dot(
+        np.array([[cy, 0, sy], [0, 1, 0], [-sy, 0, cy]])).dot(
+        np.array([[cz, -sz, 0], [sz, cz, 0], [0, 0, 1]]))
+    mat = np.eye(4)
+    mat[:3, :3] = rot
+    mat[:3, 3] = params[3:]
+    return mat
+
+
+def hrf_regressor(onsets, duration, frames, tr=TR):
+    """Block design convolved with a gamma difference HRF"""
+    from scipy.stats import gamma
+    dt = 0.1
+    t = np.arange(0, 30, dt)
+    hrf = gamma.pdf(t, 6) - gamma.pdf(t, 16) / 6.
+    box = np.zeros(int(frames * tr / dt))
+    for onset in onsets:
+        box[int(onset / dt):int((onset + duration) / dt)] = 1
+    reg = np.convolve(box, hrf)[:len(box)][::int(round(tr / dt))]
+    return reg / reg.max()
+
+
+def make_run(shape, affine, anat, anat_affine, frames, seed, block=20.,
+             activation=(-30., -50., 20.), amplitude=0.03, spikes=3,
+             motion=0.5):
+    """One BOLD run and the truth it was generated from"""
+    rng = np.random.RandomState(seed)
+    # anatomical contrast resampled to the functional grid
+    ijk = np.indices(shape).reshape(3, -1)
+    coords = np.linalg.inv(anat_affine).dot(affine).dot(
+        np.vstack((ijk, np.ones((1, ijk.shape[1])))))[:3]
+    base = ndimage.map_coordinates(anat.astype(np.float32), coords,
+                                   order=1).reshape(shape)
+    base = ndimage.gaussian_filter(1000. * base / max(base.max(), 1), 1)
+    onsets = np.arange(block, frames * TR - block, 2 * block)
+    regressor = hrf_regressor(onsets, block, frames)
+    blob, _ = _radius(shape, affine, (9., 9., 9.), activation)
+    signal = np.exp(-blob ** 2) * amplitude
+    # smooth drifting motion, mcflirt parameter order
+    params = np.cumsum(rng.randn(frames, 6), axis=0)
+    params = ndimage.gaussian_filter1d(params, 3, axis=0)
+    params -= params[0]
+    scale = np.abs(params).max(axis=0)
+    scale[scale == 0] = 1
+    params *= np.array([0.01, 0.01, 0.01, motion, motion, motion]) / scale
+    outliers = sorted(rng.choice(np.arange(5, frames - 5), spikes,
+                                 replace=False).tolist())
+    data = np.zeros(shape + (frames,), np.float32)
+    vox2world = np.vstack((ijk, np.ones((1, ijk.shape[1]))))
+    for t in range(frames):
+        vol = base * (1 + signal * regressor[t]) + \
+            10 * rng.randn(*shape)
+        # sample the moved head: world -> moved world -> voxel
+        moved = np.linalg.inv(affine).dot(rigid_matrix(params[t])).dot(
+            affine).dot(vox2world)[:3]
+        vol = ndimage.map_coordinates(vol, moved, order=1).reshape(shape)
+        if t in outliers:
+            vol *= 1.15
+        data[..., t] = vol
+    truth = {'motion': params.tolist(), 'outliers': outliers,
+             'onsets': onsets.tolist(), 'block': block,
+             'activation_center': list(activation),
+             'activation_amplitude': amplitude}
+    return data, truth
+
+
+def register_dat(filename, subject_id, zooms, tkr_matrix):
+    fp = open(filename, 'w')
+    try:
+        fp.write('%s\n%f\n%f\n0.150000\n' % (subject_id, zooms[0],
+                                             zooms[2]))
+        for row in tkr_matrix:
+            fp.write(' '.join(['%.6f' % v for v in row]) + '\n')
+        fp.write('round\n')
+    finally:
+        fp.close()
+    return filename
+
+
+def make_template(root, shape=(91, 109, 91)):
+    fname = os.path.join(root, 'template.nii.gz')
+    if not os.path.exists(fname):
+        affine = centered_affine(shape, (2., 2., 2.))
+        radius, _ = _radius(shape, affine, (72., 88., 68.))
+        data = (radius < 1) * (100 - 30 * (radius > 0.8))
+        nb.Nifti1Image(data.astype(np.float32), affine).to_filename(fname)
+    return fname
+
+
+def make_subject(root, subject_id, runs=2, frames=120,
+                 shape=(64, 64, 32), anat_zoom=2., seed=0):
+    """Write one synthetic subject under root, return its files"""
+    data_dir = os.path.join(root, 'data', subject_id)
+    mri_dir = os.path.join(root, 'surfaces', subject_id, 'mri')
+    reg_dir = os.path.join(root, 'surfaces', subject_id, 'reg')
+    for d in [os.path.join(data_dir, 'BOLD'), mri_dir, reg_dir]:
+        if not os.path.exists(d):
+            os.makedirs(d)
+    lut = os.path.join(root, 'FreeSurferColorLUT.txt')
+    if not os.path.exists(lut):
+        write_lut(lut)
+    template = make_template(root)
+
+    anat_shape = tuple([int(256 / anat_zoom)] * 3)
+    anat_affine = centered_affine(anat_shape, (anat_zoom,) * 3)
+    orig, brain, seg = make_anatomy(anat_shape, anat_affine, seed)
+    files = {'subject_id': subject_id, 'lut': lut, 'template': template}
+    for name, data in [('orig', orig), ('brainmask', brain),
+                       ('aparc+aseg', seg)]:
+        files[name] = os.path.join(mri_dir, name + '.mgz')
+        nb.MGHImage(data, anat_affine).to_filename(files[name])
+
+    affine = centered_affine(shape, FUNC_ZOOMS)
+    truth = {'runs': []}
+    files['bold'] = []
+    for r in range(runs):
+        data, run_truth = make_run(shape, affine, brain, anat_affine, frames,
+                                   seed * 100 + r)
+        fname = os.path.join(data_dir, 'BOLD', 'run%02d.nii.gz' % (r + 1))
+        img = nb.Nifti1Image(data, affine)
+        img.get_header().set_zooms(FUNC_ZOOMS + (TR,))
+        img.get_header().set_xyzt_units('mm', 'sec')
+        img.to_filename(fname)
+        files['bold'].append(fname)
+        truth['runs'].append(run_truth)
+    files['onsets'] = os.path.join(data_dir, 'onsets.txt')
+    np.savetxt(files['onsets'], [[o, truth['runs'][0]['block'], 1]
+                                 for o in truth['runs'][0]['onsets']],
+               fmt='%g')
+    files['truth'] = os.path.join(data_dir, 'truth.json')
+    json.dump(truth, open(files['truth'], 'w'), indent=1)
+
+    # func and anat share world space, so registrations are the identity
+    files['fsl_mat'] = os.path.join(reg_dir, 'func2anat.mat')
+    np.savetxt(files['fsl_mat'], vox2fsl(anat_shape, anat_affine).dot(
+        np.linalg.inv(anat_affine)).dot(affine).dot(
+        np.linalg.inv(vox2fsl(shape, affine))), fmt='%.6f')
+    files['register_dat'] = register_dat(os.path.join(reg_dir,
+                                                      'register.dat'),
+                                         subject_id, FUNC_ZOOMS, np.eye(4))
+    # anat -> template: mild scaling and a smooth warp
+    files['affine'] = write_itk_affine(os.path.join(reg_dir,
+                                                    'ants_Affine.txt'),
+                                       np.eye(3) * 1.02, [1., -2., 0.5])
+    t_img = nb.load(template)
+    rng = np.random.RandomState(seed + 7)
+    field = np.concatenate([ndimage.gaussian_filter(
+        rng.randn(*t_img.get_shape()), 6)[..., None, None]
+        for _ in range(3)], axis=-1)
+    field *= 2. / np.abs(field).max()
+    warp = nb.Nifti1Image(field.astype(np.float32), t_img.get_affine())
+    warp.get_header().set_intent('vector', (), '')
+    files['warp'] = os.path.join(reg_dir, 'ants_Warp.nii.gz')
+    warp.to_filename(files['warp'])
+    json.dump(files, open(os.path.join(data_dir, 'files.json'), 'w'),
+              indent=1)
+    return files
+
+
+def make_dataset(root, subjects=2, runs=2, frames=120, shape=(64, 64, 32),
+                 anat_zoom=2.):
+    """Write subjects sub001 ... under root, return a list of their files"""
+    return [make_subject(root, 'sub%03d' % (i + 1), runs, frames, shape,
+                         anat_zoom, seed=i) for i in range(subjects)]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="example: \
+            python synthetic.py -o /tmp/bips_synthetic -n 2 --runs 2 -t 120")
+    parser.add_argument('-o', '--out_dir', dest='out_dir', required=True,
+                        help='dataset root')
+    parser.add_argument('-n', '--subjects', dest='subjects', type=int,
+                        default=2, help='number of subjects')
+    parser.add_argument('--runs', dest='runs', type=int, default=2,
+                        help='BOLD runs per subject')
+    parser.add_argument('-t', '--frames', dest='frames', type=int,
+                        default=120, help='volumes per run')
+    parser.add_argument('--shape', dest='shape', type=int, nargs=3,
+                        default=[64, 64, 32], help='functional matrix')
+    parser.add_argument('--anat_zoom', dest='anat_zoom', type=float,
+                        default=2., help='anatomical voxel size (mm)')
+    args = parser.parse_args()
+    for files in make_dataset(args.out_dir, args.subjects, args.runs,
+                              args.frames, tuple(args.shape),
+                              args.anat_zoom):
+        print("%s: %d runs" % (files['subject_id'], len(files['bold'])))
@@ -0,0 +1,216 @@
+"""
+Benchmark and check tensor fitting
+==================================
+
+Simulates diffusion signals of random tensors (random orientations,
+eigenvalues of white matter to CSF) for a b=1000 acquisition and checks
+utils/tensorfit.py:
+
+* noise free signals : FA, MD, eigenvalues and principal directions must
+                       match the simulated tensors
+* rician noise : FA and MD errors of OLS and weighted least squares
+* throughput : voxels per second of a per-voxel weighted least squares loop
+               against the batched fit, and of fit_image on a 4D image
+
+If dtifit is on the PATH, its FA is compared with fit_image's as well.
+
+    python tensorfit.py -n 200000 --dirs 64 --snr 30
+"""
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'utils'))
+import numpy as np
+import nibabel as nb
+from tensorfit import (design_matrix, fit_tensors, tensor_matrices,
+                       tensor_maps, fit_image, TENSOR_ELEMENTS)
+
+
+def acquisition(dirs, b0s=6, bval=1000., seed=0):
+    rng = np.random.RandomState(seed)
+    g = rng.randn(dirs, 3)
+    g /= np.sqrt((g ** 2).sum(axis=1))[:, None]
+    bvecs = np.concatenate([np.zeros((b0s, 3)), g])
+    bvals = np.concatenate([np.zeros(b0s), np.ones(dirs) * bval])
+    return bvals, bvecs
+
+
+def random_tensors(n, seed=1):
+    """Parameters (as fit_tensors returns them) and eigen decompositions"""
+    rng = np.random.RandomState(seed)
+    evals = np.sort(rng.uniform(0.1e-3, 3e-3, (n, 3)), axis=1)[:, ::-1]
+    # a third of the voxels strongly anisotropic, like white matter
+    wm = rng.rand(n) < 1 / 3.
+    evals[wm, 1:] = evals[wm, 0:1] * rng.uniform(0.1, 0.3, (wm.sum(), 2))
+    evals = np.sort(evals, axis=1)[:, ::-1]
+    q = rotations(rng, n)
+    D = np.einsum('vij,vj,vkj->vik', q, evals, q)
+    params = np.empty((n, 7))
+    for col, (i, j) in enumerate(TENSOR_ELEMENTS):
+        params[:, col] = D[:, i, j]
+    params[:, 6] = np.log(1000.)
+    return params, evals, q
+
+
+def rotations(rng, n):
+    """n random rotation matrices, from random unit quaternions"""
+    a, b, c, d = rng.randn(4, n)
+    norm = np.sqrt(a ** 2 + b ** 2 + c ** 2 + d ** 2)
+    a, b, c, d = a / norm, b / norm, c / norm, d / norm
+    return np.array([
+        [a * a + b * b - c * c - d * d, 2 * (b * c - a * d),
+         2 * (b * d + a * c)],
+        [2 * (b * c + a * d), a * a - b * b + c * c - d * d,
+         2 * (c * d - a * b)],
+        [2 * (b * d - a * c), 2 * (c * d + a * b),
+         a * a - b * b - c * c + d * d]]).transpose(2, 0, 1)
+
+
+def simulate(params, design, snr=None, seed=2):
+    signal = np.exp(params.dot(design.T))
+    if snr:
+        rng = np.random.RandomState(seed)
+        sigma = 1000. / snr
+        signal = np.sqrt((signal + sigma * rng.randn(*signal.shape)) ** 2 +
+                         (sigma * rng.randn(*signal.shape)) ** 2)
+    return signal
+
+
+def fa_md(evals):
+    md = evals.mean(axis=1)
+    fa = np.sqrt(1.5) * np.sqrt(((evals - md[:, None]) ** 2).sum(axis=1)) / \
+        np.sqrt((evals ** 2).sum(axis=1))
+    return fa, md
+
+
+def loop_fit(signal, design):
+    """Per-voxel OLS then weighted least squares, one lstsq per voxel"""
+    params = np.empty((len(signal), 7))
+    for v, s in enumerate(signal):
+        y = np.log(np.maximum(s, 1.))
+        beta = np.linalg.lstsq(design, y, rcond=-1)[0]
+        w = np.exp(design.dot(beta))
+        params[v] = np.linalg.lstsq(design * w[:, None], y * w,
+                                    rcond=-1)[0]
+    return params
+
+
+def check_accuracy(design, n):
+    params, evals, evecs = random_tensors(n)
+    fa, md = fa_md(evals)
+    result = tensor_maps(fit_tensors(simulate(params, design), design))
+    dots = np.abs((result['V'][:, :, 0] * evecs[:, :, 0]).sum(axis=1))
+    errors = {'FA': np.abs(result['FA'] - fa).max(),
+              'MD': np.abs(result['MD'] - md).max() / md.max(),
+              'L': np.abs(result['L'] - evals).max() / evals.max(),
+              'V1': 1 - dots[fa > 0.2].min(),
+              'D': np.abs(tensor_matrices(fit_tensors(
+                  simulate(params, design), design)) -
+                  tensor_matrices(params)).max() / evals.max()}
+    print("noise free, %d tensors (max errors):" % n)
+    for name in ['FA', 'MD', 'L', 'V1', 'D']:
+        print("  %-3s %.3g" % (name, errors[name]))
+        assert errors[name] < 1e-6, name
+    return params, fa, md
+
+
+def check_noise(design, params, fa, md, snr):
+    signal = simulate(params, design, snr)
+    print("rician noise, snr %g (rms errors):" % snr)
+    for iterations in [0, 1, 2]:
+        result = tensor_maps(fit_tensors(signal, design, iterations))
+        print("  %s FA %.4f  MD %.3g" % (
+            'OLS  ' if iterations == 0 else 'WLS %d' % iterations,
+            np.sqrt(((result['FA'] - fa) ** 2).mean()),
+            np.sqrt(((result['MD'] - md) ** 2).mean())))
+    sub = signal[:2000]
+    batched = fit_tensors(sub, design)
+    looped = loop_fit(sub, design)
+    diff = np.abs(tensor_matrices(batched) - tensor_matrices(looped)).max()
+    print("  batched vs per-voxel WLS, max tensor difference: %.3g" % diff)
+    assert diff < 1e-9
+
+
+def throughput(design, n, loop_voxels):
+    params, _, _ = random_tensors(n)
+    signal = simulate(params, design, 30)
+    t0 = time.time()
+    loop_fit(signal[:loop_voxels], design)
+    t_loop = (time.time() - t0) / loop_voxels
+    t0 = time.time()
+    for start in range(0, n, 20000):
+        tensor_maps(fit_tensors(signal[start:start + 20000], design))
+    t_batched = (time.time() - t0) / n
+    print("per-voxel loop %10.0f voxels/s" % (1 / t_loop))
+    print("batched        %10.0f voxels/s (%.0fx)" % (1 / t_batched,
+                                                     t_loop / t_batched))
+
+
+def image_throughput(design, bvals, bvecs, tmp_dir, shape=(96, 96, 60)):
+    nvox = int(np.prod(shape))
+    params, _, _ = random_tensors(nvox)
+    signal = simulate(params, design, 30).astype(np.float32)
+    affine = np.diag([2., 2., 2., 1.])
+    dwi = os.path.join(tmp_dir, 'dwi.nii')
+    nb.Nifti1Image(signal.reshape(shape + (-1,)), affine).to_filename(dwi)
+    center = np.array(shape)[:, None, None, None] / 2.
+    radius = np.sqrt((((np.indices(shape) - center) / center) ** 2).sum(0))
+    mask = os.path.join(tmp_dir, 'mask.nii')
+    nb.Nifti1Image((radius < 0.9).astype(np.uint8), affine).to_filename(mask)
+    np.savetxt(os.path.join(tmp_dir, 'bvals'), bvals[None], fmt='%g')
+    np.savetxt(os.path.join(tmp_dir, 'bvecs'), bvecs.T, fmt='%.6f')
+    t0 = time.time()
+    out_files = fit_image(dwi, os.path.join(tmp_dir, 'bvals'),
+                          os.path.join(tmp_dir, 'bvecs'), mask, 'native',
+                          out_dir=tmp_dir)
+    elapsed = time.time() - t0
+    inmask = int((radius < 0.9).sum())
+    print("fit_image %s x %d: %.2f s, %.0f in-mask voxels/s" % (
+        'x'.join([str(s) for s in shape]), len(bvals), elapsed,
+        inmask / elapsed))
+
+    paths = os.environ.get('PATH', '').split(os.pathsep)
+    if not any([os.path.exists(os.path.join(p, 'dtifit')) for p in paths]):
+        print("dtifit not found, skipping FSL comparison")
+        return
+    t0 = time.time()
+    subprocess.call(['dtifit', '-k', dwi, '-o',
+                     os.path.join(tmp_dir, 'fsl'), '-m', mask, '-r',
+                     os.path.join(tmp_dir, 'bvecs'), '-b',
+                     os.path.join(tmp_dir, 'bvals'), '--wls'])
+    elapsed = time.time() - t0
+    fsl_fa = [f for f in os.listdir(tmp_dir) if f.startswith('fsl_FA')][0]
+    a = nb.load(os.path.join(tmp_dir, fsl_fa)).get_data()[radius < 0.9]
+    b = nb.load(out_files['FA']).get_data()[radius < 0.9]
+    print("dtifit --wls: %.2f s, max FA difference %.3g" % (
+        elapsed, np.abs(a - b).max()))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="example: \
+                        python tensorfit.py -n 200000 --dirs 64 --snr 30")
+    parser.add_argument('-n', '--voxels', dest='voxels', type=int,
+                        default=200000, help='voxels for the throughput test')
+    parser.add_argument('--dirs', dest='dirs', type=int, default=64,
+                        help='gradient directions')
+    parser.add_argument('--snr', dest='snr', type=float, default=30,
+                        help='b0 signal to noise ratio')
+    parser.add_argument('--loop', dest='loop', type=int, default=5000,
+                        help='voxels timed with the per-voxel loop')
+    args = parser.parse_args()
+
+    bvals, bvecs = acquisition(args.dirs)
+    design = design_matrix(bvals, bvecs)
+    params, fa, md = check_accuracy(design, 20000)
+    check_noise(design, params, fa, md, args.snr)
+    throughput(design, args.voxels, args.loop)
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        image_throughput(design, bvals, bvecs, tmp_dir)
+    finally:
+        shutil.rmtree(tmp_dir)
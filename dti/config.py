@@ -8,13 +8,42 @@ import os                                    # system functions
 
 dataDir = '/mindhive/gablab/sad/PY_STUDY_DIR/Block/data'
 workingdir = '/mindhive/gablab/sad/PY_STUDY_DIR/Block/scripts/l1output/workflows/dti'
+sink_dir = os.path.join(workingdir, 'sink')
 subjects = ['SAD_018']
 
+# True to run with plugin (e.g. on the grid), False to run serially
+run_on_grid = False
+plugin = 'MultiProc'
+plugin_args = {'n_procs': 4}
+
 skeleton_thresh = 0.2
 
 # bet options
 frac = 0.34
 
+# eddy correction: 'nipype' (create_eddy_correct_pipeline) or 'parallel'
+# (volumes registered concurrently by eddy_workers flirt processes;
+# opt-in until compared with create_eddy_correct_pipeline on real data: it
+# does not resample the reference volume and writes float32). The
+# eddy_workers flirt processes run inside a single MultiProc slot, so with
+# n_procs = 4 the machine runs up to 4 * eddy_workers processes; lower
+# n_procs or eddy_workers to match its cores.
+eddy_mode = 'nipype'
+eddy_workers = 4
+
+# tensor fitting: 'dtifit' (fsl) or 'wls' (native weighted least squares,
+# opt-in; its FA/MD differ from dtifit's ordinary least squares fit)
+tensor_fit = 'dtifit'
+wls_iterations = 1
+
+# directory of the per-node resource profiles (utils/nodeprofile.py), None
+# to disable
+profile_dir = None
+
+# True to size the PBS request of every node from its profiles in
+# profile_dir (utils/pbsplan.py), 'dry_run' to only print the plan
+resource_plan = False
+
 def get_datasource():
 
     datasource = pe.Node(interface=nio.DataGrabber(infields=['subject_id'],
@@ -4,13 +4,15 @@
 # imports --------------------------------------------------------------------
 import sys
 sys.path.insert(0,'/mindhive/gablab/users/keshavan/lib/python/nipype') # use Anisha's nipype
+sys.path.insert(0,'../utils')
 from nipype.workflows.dmri.fsl.dti import create_eddy_correct_pipeline
 from nipype.workflows.dmri.fsl.tbss import create_tbss_non_FA, create_tbss_all
-import nipype.interfaces.io as nio           # Data i/o
 import nipype.interfaces.fsl as fsl          # fsl
 import nipype.interfaces.utility as util     # utility
 import nipype.pipeline.engine as pe          # pypeline engine
 import os                                    # system functions
+from sinkmanifest import ManifestDataGrabber, ManifestDataSink
+from pbsplan import run_workflow
 from config import *                         # config file
 fsl.FSLCommand.set_default_output_type('NIFTI')
 from nipype.utils.config import config
@@ -18,34 +20,84 @@ config.enable_debug_mode()
 
 # Utils ----------------------------------------------------------------------
 
-# tolist has to be made into a function node, otherwise Nipype complains. :(
+# the datagrabber returns a single file (not a list) for a single subject
 
 def tolist(x):
-    x = [x]
+    if not isinstance(x, list):
+        x = [x]
     return x
 
+def eddy_correct_volumes(in_file, ref_num, workers):
+    # registers the volumes concurrently, assembles them in memory
+    import os
+    from eddycorrect import eddy_correct
+    out_file = os.path.abspath(os.path.split(in_file)[1].split('.')[0] +
+                               '_edc.nii')
+    out_file, ref_file, _, _ = eddy_correct(in_file, out_file, ref_num,
+                                            workers,
+                                            work_dir=os.path.abspath('volumes'))
+    return out_file, ref_file
+
+def fit_tensors(dwi, bvecs, bvals, mask, base_name, iterations):
+    # weighted least squares replacement for fsl.DTIFit
+    from tensorfit import fit_image
+    out_files = fit_image(dwi, bvals, bvecs, mask, base_name,
+                          iterations=iterations)
+    return out_files['FA'], out_files['MD'], out_files['V1']
+
 # Workflow -------------------------------------------------------------------
-def create_prep(subj):
-        
-    inputspec = pe.Node(interface=util.IdentityInterface(fields=['dwi','bvec','bval']),
+def create_prep(subj=None):
+    """
+    FA and MD of one subject. If subj is None, the output names come from
+    inputspec.subject_id
+    """
+    inputspec = pe.Node(interface=util.IdentityInterface(fields=['subject_id','dwi',
+                                                                 'bvec','bval']),
                         name='inputspec')
     
     gen_fa = pe.Workflow(name="gen_fa")
     gen_fa.base_dir = os.path.join(os.path.abspath(workingdir), 'l1')
 
-    eddy_correct = create_eddy_correct_pipeline()
-    eddy_correct.inputs.inputnode.ref_num = 0
-    gen_fa.connect(inputspec, 'dwi', eddy_correct, 'inputnode.in_file')
+    if eddy_mode == 'parallel':
+        eddy_correct = pe.Node(interface=util.Function(input_names=['in_file','ref_num',
+                                                                    'workers'],
+                                                       output_names=['eddy_corrected',
+                                                                     'ref_file'],
+                                                       function=eddy_correct_volumes),
+                               name='eddy_correct')
+        eddy_correct.inputs.ref_num = 0
+        eddy_correct.inputs.workers = eddy_workers
+        gen_fa.connect(inputspec, 'dwi', eddy_correct, 'in_file')
+        eddy_ref = 'ref_file'
+        eddy_out = 'eddy_corrected'
+    else:
+        eddy_correct = create_eddy_correct_pipeline()
+        eddy_correct.inputs.inputnode.ref_num = 0
+        gen_fa.connect(inputspec, 'dwi', eddy_correct, 'inputnode.in_file')
+        eddy_ref = 'pick_ref.out'
+        eddy_out = 'outputnode.eddy_corrected'
 
     bet = pe.Node(interface=fsl.BET(), name='bet')
     bet.inputs.mask = True
     bet.inputs.frac = frac
-    gen_fa.connect(eddy_correct, 'pick_ref.out', bet, 'in_file')
-
-    dtifit = pe.Node(interface=fsl.DTIFit(), name='dtifit')
-    gen_fa.connect(eddy_correct, 'outputnode.eddy_corrected', dtifit, 'dwi')
+    gen_fa.connect(eddy_correct, eddy_ref, bet, 'in_file')
+
+    if tensor_fit == 'wls':
+        dtifit = pe.Node(interface=util.Function(input_names=['dwi','bvecs','bvals',
+                                                              'mask','base_name',
+                                                              'iterations'],
+                                                 output_names=['FA','MD','V1'],
+                                                 function=fit_tensors),
+                         name='dtifit')
+        dtifit.inputs.iterations = wls_iterations
+    else:
+        dtifit = pe.Node(interface=fsl.DTIFit(), name='dtifit')
+    gen_fa.connect(eddy_correct, eddy_out, dtifit, 'dwi')
     
-    dtifit.inputs.base_name = subj
+    if subj is None:
+        gen_fa.connect(inputspec, 'subject_id', dtifit, 'base_name')
+    else:
+        dtifit.inputs.base_name = subj
     
     gen_fa.connect(bet, 'mask_file', dtifit, 'mask')
     gen_fa.connect(inputspec, 'bvec', dtifit, 'bvecs')
@@ -89,35 +141,75 @@ def create_tbss():
                 ])
     return tbssproc
 
-def combine_prep(subj):
-    
-    modelflow = pe.Workflow(name='preproc')
-    
+def create_subjects(subjects):
+    """
+    FA and MD of every subject, run in parallel as iterables over subject_id
+    and sunk to sink_dir/<subject>/dti. The working directory is shared by
+    all subjects, so adding subjects only runs the new ones.
+    """
+    subjflow = pe.Workflow(name='dti_subjects')
+    subjflow.base_dir = os.path.join(os.path.abspath(workingdir), 'l1')
+
+    infosource = pe.Node(util.IdentityInterface(fields=['subject_id']),
+                         name='subject_names')
+    infosource.iterables = ('subject_id', subjects)
+
     datasource = get_datasource()
-    datasource.inputs.subject_id = subj
-    
-    prep = create_prep(subj)
+    prep = create_prep()
+
+    sinkd = pe.Node(ManifestDataSink(), name='sinkd')
+    sinkd.inputs.base_directory = os.path.abspath(sink_dir)
+    # drop the iterable's folder so the files land in <subject>/dti/
+    sinkd.inputs.substitutions = [('_subject_id_%s/' % subj, '')
+                                  for subj in subjects]
+
+    subjflow.connect(infosource,   'subject_id',       datasource, 'subject_id')
+    subjflow.connect(infosource,   'subject_id',       prep,   'inputspec.subject_id')
+    subjflow.connect(datasource,   'dwi',              prep,   'inputspec.dwi')
+    subjflow.connect(datasource,   'bvec',             prep,   'inputspec.bvec')
+    subjflow.connect(datasource,   'bval',             prep,   'inputspec.bval')
+    subjflow.connect(infosource,   'subject_id',       sinkd,  'container')
+    subjflow.connect(prep,         'outputspec.FA',    sinkd,  'dti.@FA')
+    subjflow.connect(prep,         'outputspec.MD',    sinkd,  'dti.@MD')
+    return subjflow
+
+def create_group(subjects):
+    """
+    TBSS of the whole cohort, from the per-subject FA and MD in sink_dir
+    """
+    groupflow = pe.Workflow(name='dti_group')
+    groupflow.base_dir = os.path.join(os.path.abspath(workingdir), 'l2')
+
+    datasource = pe.Node(interface=ManifestDataGrabber(infields=['subject_id'],
+                                                       outfields=['FA','MD']),
+                         name='cohort_datasource')
+    datasource.inputs.base_directory = os.path.abspath(sink_dir)
+    datasource.inputs.template = '*'
+    datasource.inputs.field_template = dict(FA='%s/dti/%s_FA.*',
+                                            MD='%s/dti/%s_MD.*')
+    datasource.inputs.template_args = dict(FA=[['subject_id','subject_id']],
+                                           MD=[['subject_id','subject_id']])
+    datasource.inputs.subject_id = list(subjects)
+
     tbss = create_tbss()
-    
-    lister1 = pe.Node(util.Function(input_names = ['x'],output_names = ['x'],function=tolist),name='to_list1')
-    lister2 = pe.Node(util.Function(input_names = ['x'],output_names = ['x'],function=tolist),name='to_list2')
-    
-    modelflow.connect(datasource,   'dwi',              prep,   'inputspec.dwi')
-    modelflow.connect(datasource,   'bvec',             prep,   'inputspec.bvec')
-    modelflow.connect(datasource,   'bval',             prep,   'inputspec.bval')
-    
-    modelflow.connect(prep,         'outputspec.FA',    lister1,   'x')
-    modelflow.connect(lister1,         'x',    tbss,   'inputspec.fa_list')
-    modelflow.connect(prep,         'outputspec.MD',    lister2,   'x')
-    modelflow.connect(lister2,         'x',    tbss,   'inputspec.md_list')
-    
-    modelflow.base_dir = os.path.join(workingdir,'work_dir',subj)
-    return modelflow
-    
+
+    groupflow.connect(datasource, ('FA', tolist), tbss, 'inputspec.fa_list')
+    groupflow.connect(datasource, ('MD', tolist), tbss, 'inputspec.md_list')
+    return groupflow
+
+def run_cohort(subjects):
+    """
+    Per-subject FA/MD generation followed by one TBSS stage over all subjects
+    """
+    # the settings star-imported above, as the config object run_workflow
+    # reads
+    c = sys.modules['config']
+    subjflow = create_subjects(subjects)
+    if len(subjects) == 1:
+        subjflow.write_graph()
+    run_workflow(subjflow, c)
+    run_workflow(create_group(subjects), c)
     
 
 if __name__ == '__main__':
-    workflow = combine_prep(subjects[0])
-    workflow.write_graph()
-    workflow.run()
-
+    run_cohort(subjects)
@@ -669,6 +669,7 @@ def create_first(name='modelfit'):
     outputspec.design_image :
     outputspec.design_file :
     outputspec.design_cov :
+    outputspec.con_file :
     
     Returns
     -------
@@ -722,7 +723,8 @@ def create_first(name='modelfit'):
                                                         'tstats',
                                                         'design_image',
                                                         'design_file',
-                                                        'design_cov']),
+                                                        'design_cov',
+                                                        'con_file']),
                          name='outputspec')
 
     # Utility function
@@ -762,7 +764,77 @@ def create_first(name='modelfit'):
                      outputspec, 'design_file')
     modelfit.connect(modelgen, 'design_cov',
                      outputspec, 'design_cov')
+    modelfit.connect(modelgen, 'con_file',
+                     outputspec, 'con_file')
     return modelfit
+
+
+def create_design(name='design'):
+    """First level design generation without model estimation
+
+    Builds the same FEAT design matrices and contrast files as
+    create_first, for estimation outside of FILMGLS.
+
+    Parameters
+    ----------
+    name : name of workflow. Default = 'design'
+
+    Inputs
+    ------
+    inputspec.session_info :
+    inputspec.interscan_interval :
+    inputspec.contrasts :
+    inputspec.bases :
+    inputspec.model_serial_correlations :
+
+    Outputs
+    -------
+    outputspec.design_image :
+    outputspec.design_file :
+    outputspec.design_cov :
+    outputspec.con_file :
+
+    Returns
+    -------
+    workflow : design workflow
+    """
+    design = pe.Workflow(name=name)
+
+    inputspec = pe.Node(util.IdentityInterface(fields=['session_info',
+                                                       'interscan_interval',
+                                                       'contrasts',
+                                                       'bases',
+                                                       'model_serial_correlations']),
+                        name='inputspec')
+
+    level1design = pe.Node(interface=fsl.Level1Design(),
+                           name="create_level1_design")
+
+    modelgen = pe.MapNode(interface=fsl.FEATModel(),
+                          name='generate_model',
+                          iterfield = ['fsf_file',
+                                       'ev_files'])
+
+    outputspec = pe.Node(util.IdentityInterface(fields=['design_image',
+                                                        'design_file',
+                                                        'design_cov',
+                                                        'con_file']),
+                         name='outputspec')
+
+    design.connect([
+        (inputspec, level1design, [('interscan_interval', 'interscan_interval'),
+                                   ('session_info', 'session_info'),
+                                   ('contrasts', 'contrasts'),
+                                   ('bases', 'bases'),
+                                   ('model_serial_correlations',
+                                    'model_serial_correlations')]),
+        (level1design,modelgen,     [('fsf_files',              'fsf_file'),
+                                     ('ev_files',               'ev_files')]),
+        (modelgen, outputspec,      [('design_image',           'design_image'),
+                                     ('design_file',            'design_file'),
+                                     ('design_cov',             'design_cov'),
+                                     ('con_file',               'con_file')])])
+    return design
     
 #def normalize(name = "normalize"):
     
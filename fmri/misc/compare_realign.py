@@ -11,6 +11,7 @@ import nipype.interfaces.fsl as fsl
 import nipype.interfaces.spm as spm
 import sys
 sys.path.append('../../utils')
+from pbsplan import run_workflow
 from reportsink.io import ReportSink
 import os
 import matplotlib
@@ -156,7 +157,4 @@ if __name__ == "__main__":
     
     compare = compare_workflow()
     compare.base_dir = c.working_dir
-    if c.run_on_grid:
-        compare.run(plugin=c.plugin, plugin_args=c.plugin_args['qsub_args']+'-X')
-    else:
-        compare.run()
+    run_workflow(compare, c, plugin_args=c.plugin_args['qsub_args']+'-X')
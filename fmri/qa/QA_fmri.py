@@ -4,20 +4,21 @@ import os
 import matplotlib.pyplot as plt
 import nipype.pipeline.engine as pe
 import nipype.interfaces.utility as util
-import nipype.interfaces.io as nio
 from time import ctime
 from glob import glob
 from nipype.interfaces.freesurfer import ApplyVolTransform
-from nipype.workflows.smri.freesurfer.utils import create_get_stats_flow
 from nipype.interfaces import freesurfer as fs
 from nipype.interfaces.io import FreeSurferSource
 from nipype.interfaces import fsl
 #from nipype.utils.config import config
 #config.enable_debug_mode()
-from QA_utils import plot_ADnorm, tsdiffana, tsnr_roi, combine_table, art_output, plot_motion
+from QA_utils import plot_ADnorm, tsdiff_metrics, tsdiff_plot, tsnr_roi, combine_table, art_output, plot_motion, qa_metrics
 import sys
 sys.path.insert(0,'../../utils/')
 from reportsink.io import ReportSink
+from sinkmanifest import ManifestDataGrabber, ManifestDataSink
+from pbsplan import run_workflow
+from figcache import set_cache_dir
 import argparse
 
 totable = lambda x: [[x]]
@@ -30,7 +31,7 @@ def get_config_params(subject_id, table):
 
 def preproc_datagrabber(name='preproc_datagrabber'):
     # create a node to obtain the preproc files
-    datasource = pe.Node(interface=nio.DataGrabber(infields=['subject_id','fwhm'],
+    datasource = pe.Node(interface=ManifestDataGrabber(infields=['subject_id','fwhm'],
                                                    outfields=['noise_components',
                                                               'motion_parameters',
                                                                'outlier_files',
@@ -86,99 +87,77 @@ def start_config_table():
         table.append(['lowpass freq',str(c.lowpass_freq)])
     return table
 
-def overlay_dB(stat_image,background_image,threshold,dB):
-    import os.path
-    import pylab as pl
-    from nibabel import load
-    from nipy.labs import viz
-    from pylab import colorbar, gca, axes
+def overlay_dB(stat_image,background_image,threshold,dB,dpi=100):
+    """ Returns z, x and y views of stat_image over background_image
+    
+    Parameters
+    ----------
+    stat_image : File
+    background_image : File
+    threshold : Float
+                overlay values at or below threshold are not shown
+    dB : Boolean
+         True to display values above 1 in decibels
+    dpi : Int
+          resolution of the images. Default = 100
+    
+    Returns
+    -------
+    List : filenames of the z, x and y view images
+    """
+    import os
     import numpy as np
-    # Second example, with a given anatomical image slicing in the Z
-    # direction
-    
-    fnames = [os.path.abspath('z_view.png'),
-             os.path.abspath('x_view.png'),
-             os.path.abspath('y_view.png')]
-            
-    formatter='%.2f'
+    from nibabel import load
+    from figcache import FigureCache
+    from render import PLOT_VERSION, render_views
+    
+    fnames = [os.path.abspath('%s_view.png' % view) for view in 'zxy']
+    cache = FigureCache()
+    key = cache.key('overlay_dB', [stat_image, background_image], threshold, dB, dpi,
+                    PLOT_VERSION)
+    if cache.fetch(key, fnames):
+        return fnames
+    
     img = load(stat_image)
-    data, affine = img.get_data(), img.get_affine()
+    data, affine = np.asarray(img.get_data(), dtype=np.float64), img.get_affine()
     if dB:
         data[data > 1] = 20*np.log10(np.asarray(data[data > 1]))
-
-    anat_img = load(background_image)
-    anat = anat_img.get_data()
-    anat_affine = anat_img.get_affine()
-
-    viz.plot_map(data, affine, anat=anat, anat_affine=anat_affine,
-                 slicer='z', threshold=threshold, cmap=viz.cm._cm.hot)
-    cb = colorbar(gca().get_images()[1], cax=axes([0.3, 0.00, 0.4, 0.07]),
-                         orientation='horizontal', format=formatter)
-    cb.set_ticks([cb._values.min(), cb._values.max()])
-    pl.savefig(fnames[0],bbox_inches='tight')
-
-    viz.plot_map(data, affine, anat=anat, anat_affine=anat_affine,
-                 slicer='x', threshold=threshold, cmap=viz.cm._cm.hot)
-    cb = colorbar(gca().get_images()[1], cax=axes([0.3, -0.06, 0.4, 0.07]), 
-                         orientation='horizontal', format=formatter)
-    cb.set_ticks([cb._values.min(), cb._values.max()])
-    pl.savefig(fnames[1],bbox_inches='tight')
-
-    viz.plot_map(data, affine, anat=anat, anat_affine=anat_affine,
-                 slicer='y', threshold=threshold, cmap=viz.cm._cm.hot)
-    cb = colorbar(gca().get_images()[1], cax=axes([0.3, -0.08, 0.4, 0.07]), 
-                         orientation='horizontal', format=formatter)
-    cb.set_ticks([cb._values.min(), cb._values.max()])
-    pl.savefig(fnames[2],bbox_inches='tight')
-    
+    fnames = render_views((data, affine), background_image, threshold, dpi=dpi)
+    cache.store(key, fnames)
     return fnames
 
 
-def overlay_new(stat_image,background_image,threshold):
-    import os.path
-    import pylab as pl
-    from nibabel import load
-    from nipy.labs import viz
-    from pylab import colorbar, gca, axes
-    import numpy as np
-    # Second example, with a given anatomical image slicing in the Z
-    # direction
-    
-    fnames = [os.path.abspath('z_view.png'),
-             os.path.abspath('x_view.png'),
-             os.path.abspath('y_view.png')]
-            
-    formatter='%.2f'
-    img = load(stat_image)
-    data, affine = img.get_data(), img.get_affine()
-   
-    
-    anat_img = load(background_image)
-    anat = anat_img.get_data()
-    anat_affine = anat_img.get_affine()
-    anat = np.ones(anat.shape) - anat
-    
-    viz.plot_map(data, affine, anat=anat, anat_affine=anat_affine,
-                 slicer='z', threshold=threshold, cmap=viz.cm._cm.hot)
-    cb = colorbar(gca().get_images()[1], cax=axes([0.3, 0.00, 0.4, 0.07]),
-                         orientation='horizontal', format=formatter)
-    cb.set_ticks([cb._values.min(), cb._values.max()])
-    pl.savefig(fnames[0],bbox_inches='tight')
-
-    viz.plot_map(data, affine, anat=anat, anat_affine=anat_affine,
-                 slicer='x', threshold=threshold, cmap=viz.cm._cm.hot)
-    cb = colorbar(gca().get_images()[1], cax=axes([0.3, -0.06, 0.4, 0.07]), 
-                         orientation='horizontal', format=formatter)
-    cb.set_ticks([cb._values.min(), cb._values.max()])
-    pl.savefig(fnames[1],bbox_inches='tight')
-
-    viz.plot_map(data, affine, anat=anat, anat_affine=anat_affine,
-                 slicer='y', threshold=threshold, cmap=viz.cm._cm.hot)
-    cb = colorbar(gca().get_images()[1], cax=axes([0.3, -0.08, 0.4, 0.07]), 
-                         orientation='horizontal', format=formatter)
-    cb.set_ticks([cb._values.min(), cb._values.max()])
-    pl.savefig(fnames[2],bbox_inches='tight')
+def overlay_new(stat_image,background_image,threshold,dpi=100):
+    """ Returns z, x and y views of stat_image over the inverted \
+    background_image
     
+    Parameters
+    ----------
+    stat_image : File
+    background_image : File
+    threshold : Float
+                overlay values at or below threshold are not shown
+    dpi : Int
+          resolution of the images. Default = 100
+    
+    Returns
+    -------
+    List : filenames of the z, x and y view images
+    """
+    import os
+    from figcache import FigureCache
+    from render import PLOT_VERSION, render_views
+    
+    fnames = [os.path.abspath('%s_view.png' % view) for view in 'zxy']
+    cache = FigureCache()
+    key = cache.key('overlay_new', [stat_image, background_image], threshold, dpi,
+                    PLOT_VERSION)
+    if cache.fetch(key, fnames):
+        return fnames
+    
+    fnames = render_views(stat_image, background_image, threshold,
+                          invert_background=True, dpi=dpi)
+    cache.store(key, fnames)
     return fnames
 
 def QA_workflow(name='QA'):
@@ -263,9 +242,20 @@ def QA_workflow(name='QA'):
     workflow.connect(plot_m, 'fname',inputspec,'motion_plots')
     
     tsdiff = pe.MapNode(util.Function(input_names = ['img'], 
-                                      output_names = ['out_file'], 
-                                      function=tsdiffana), 
+                                      output_names = ['metrics_file'], 
+                                      function=tsdiff_metrics), 
                         name='tsdiffana', iterfield=["img"])
+    
+    tsdiffplot = pe.MapNode(util.Function(input_names = ['metrics_file'], 
+                                          output_names = ['out_file'], 
+                                          function=tsdiff_plot), 
+                            name='tsdiffplot', iterfield=["metrics_file"])
+    
+    # keep the metrics so cohort QA does not have to reread the raw data
+    metricsink = pe.Node(ManifestDataSink(), name='metricsink')
+    metricsink.inputs.base_directory = os.path.join(c.sink_dir,'analyses','func')
+    metricsink.inputs.regexp_substitutions = [('_tsdiffana[0-9]+/','')]
+    workflow.connect(infosource,'subject_id',metricsink,'container')
                         
     art_info = pe.MapNode(util.Function(input_names = ['art_file'], 
                                       output_names = ['table'], 
@@ -304,16 +294,18 @@ def QA_workflow(name='QA'):
     
     voltransform = pe.MapNode(interface=ApplyVolTransform(),name='register',iterfield=['source_file'])
     
-    overlaynew = pe.MapNode(util.Function(input_names=['stat_image','background_image','threshold',"dB"],
+    overlaynew = pe.MapNode(util.Function(input_names=['stat_image','background_image','threshold',"dB",'dpi'],
                                           output_names=['fnames'], function=overlay_dB), 
                                           name='overlay_new', iterfield=['stat_image'])
     overlaynew.inputs.dB = False
     overlaynew.inputs.threshold = 20
+    overlaynew.inputs.dpi = getattr(c, 'qa_dpi', 100)
                                  
-    overlaymask = pe.Node(util.Function(input_names=['stat_image','background_image','threshold'],
+    overlaymask = pe.Node(util.Function(input_names=['stat_image','background_image','threshold','dpi'],
                                           output_names=['fnames'], function=overlay_new), 
                                           name='overlay_mask')
     overlaymask.inputs.threshold = 0
+    overlaymask.inputs.dpi = getattr(c, 'qa_dpi', 100)
     
     #overlaymask = pe.Node(interface=fsl.Overlay(),name='fsl_overlaymask')
     #overlaymask.inputs.transparency = True
@@ -342,9 +334,24 @@ def QA_workflow(name='QA'):
     write_rep.inputs.Introduction = "Quality Assurance Report for fMRI preprocessing."
     write_rep.inputs.base_directory = os.path.join(c.sink_dir,'analyses','func')
     write_rep.inputs.report_name = "Preprocessing_Report"
+    write_rep.inputs.report_format = getattr(c, 'report_format', 'pdf')
     write_rep.inputs.json_sink = c.json_sink
     workflow.connect(infosource,'subject_id',write_rep,'container')
     workflow.connect(overlaymask, 'fnames', write_rep, "Brain_Mask_and_Mean_Functional")
+    if getattr(c, 'profile_dir', None):
+        write_rep.inputs.profile_dir = c.profile_dir
+    
+    if getattr(c, 'metrics_db', None):
+        metrics = pe.Node(util.Function(input_names=['art_file','ADnorm','roi_table','reg_file'],
+                                        output_names=['metrics'], function=qa_metrics),
+                          name='qa_metrics')
+        write_rep.inputs.metrics_db = c.metrics_db
+        write_rep.inputs.metrics_db_wal = getattr(c, 'metrics_db_wal', False)
+        workflow.connect(inputspec,'art_file',metrics,'art_file')
+        workflow.connect(inputspec,'ADnorm',metrics,'ADnorm')
+        workflow.connect(tablecombine,'roisnr',metrics,'roi_table')
+        workflow.connect(inputspec,'reg_file',metrics,'reg_file')
+        workflow.connect(metrics,'metrics',write_rep,'metrics')
     #workflow.connect(slicermask,'out_file', write_rep, "Brain_Mask_and_Mean_Functional")
     
     # Define Inputs
@@ -361,7 +368,9 @@ def QA_workflow(name='QA'):
     workflow.connect(art_info,('table',to1table), write_rep,'Art_Detect')
     workflow.connect(inputspec,'motion_plots',write_rep,'motion_plots')
     workflow.connect(inputspec,'in_file',tsdiff,'img')
-    workflow.connect(tsdiff,"out_file",write_rep,"tsdiffana")
+    workflow.connect(tsdiff,'metrics_file',tsdiffplot,'metrics_file')
+    workflow.connect(tsdiff,'metrics_file',metricsink,'qa.tsdiffana')
+    workflow.connect(tsdiffplot,"out_file",write_rep,"tsdiffana")
     workflow.connect(inputspec,('config_params',totable), write_rep,'config_params')
     workflow.connect(inputspec,'reg_file',roidevplot,'inputspec.reg_file')
     workflow.connect(inputspec,'tsnr_stddev',roidevplot,'inputspec.tsnr_file')
@@ -398,14 +407,12 @@ if __name__ == "__main__":
     path, fname = os.path.split(os.path.realpath(args.config))
     sys.path.append(path)
     c = __import__(fname.split('.')[0])
+    set_cache_dir(os.path.join(c.working_dir, 'figure_cache'))
     
     a = QA_workflow()
     a.base_dir = c.working_dir
     a.write_graph()
     a.inputs.inputspec.config_params = start_config_table()
     
-    if c.run_on_grid:
-        a.run(plugin=c.plugin,plugin_args=c.plugin_args)
-    else:
-        a.run()
+    run_workflow(a, c)
     
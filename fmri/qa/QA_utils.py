@@ -1,15 +1,17 @@
 import matplotlib
 matplotlib.use('Agg')
 import os
+import sys
 import matplotlib.pyplot as plt
 import nipype.pipeline.engine as pe
 import nipype.interfaces.utility as util
 import nipype.interfaces.io as nio
 from nipype.interfaces.freesurfer import ApplyVolTransform
-from nipype.workflows.smri.freesurfer.utils import create_get_stats_flow
 from nipype.interfaces import freesurfer as fs
 from nipype.interfaces.io import FreeSurferSource
 from nipype.interfaces import fsl
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             '..', '..', 'utils'))
 
 def art_output(art_file):
     import numpy as np
@@ -36,14 +38,22 @@ def plot_ADnorm(ADnorm,TR):
     File : Filename of plot image
     
     """
+    import os
+    from figcache import FigureCache
+    # part of the cache key: change it whenever the plot below changes
+    PLOT_VERSION = '1'
+    
+    plot = os.path.abspath('plot_'+os.path.split(ADnorm)[1]+'.png')
+    cache = FigureCache()
+    key = cache.key('plot_ADnorm', ADnorm, TR, PLOT_VERSION)
+    if cache.fetch(key, [plot]):
+        return plot
+    
     import matplotlib
     matplotlib.use('Agg')
     import matplotlib.pyplot as plt
-    import os
     import numpy as np
     
-    plot = os.path.abspath('plot_'+os.path.split(ADnorm)[1]+'.png')
-    
     data = np.genfromtxt(ADnorm)
     plt.figure(1,figsize = (8,3))
     X = np.array(range(data.shape[0]))*TR
@@ -52,6 +62,7 @@ def plot_ADnorm(ADnorm,TR):
     plt.ylabel('Composite Norm')
     plt.savefig(plot)
     plt.close()
+    cache.store(key, [plot])
     return plot
     
 def tsnr_roi(roi=[1021],name='roi_flow',plot=False, onsets=False):
@@ -84,7 +95,8 @@ def tsnr_roi(roi=[1021],name='roi_flow',plot=False, onsets=False):
     Outputs
     -------
     outputspec.out_file :
-    
+    outputspec.roi_table : if plot=False, record arrays (id, name, value) \
+                           of the average value per ROI, one per run
     
     """
     preproc = pe.Workflow(name=name)
@@ -104,46 +116,32 @@ def tsnr_roi(roi=[1021],name='roi_flow',plot=False, onsets=False):
     
     preproc.connect(inputspec,'aparc_aseg',voltransform,'target_file')
     
-    statsflow = create_get_stats_flow()
-    preproc.connect(voltransform,'transformed_file',statsflow,'inputspec.label_file')
-    preproc.connect(inputspec,'tsnr_file',statsflow,'inputspec.source_file')
-    
-    statsflow.inputs.segstats.avgwf_txt_file = True
-
-    def strip_ids(subject_id, summary_file, roi_file):
-        import numpy as np
+    def roi_waveforms(subject_id, label_file, in_file):
         import os
-        roi_idx = np.genfromtxt(summary_file)[:,1].astype(int)
-        roi_vals = np.genfromtxt(roi_file)
-        rois2skip = [0, 2, 4, 5, 7, 14, 15, 24, 30, 31, 41, 43, 44, 46,
-                     62, 63, 77, 80, 85, 1000, 2000]
-        ids2remove = []
-        for roi in rois2skip:
-            idx, = np.nonzero(roi_idx==roi)
-            ids2remove.extend(idx)
-        ids2keep = np.setdiff1d(range(roi_idx.shape[0]), ids2remove)
+        from labelstats import label_stats, write_roi_table, ROIS_TO_SKIP
+        stats = label_stats(label_file, in_file, exclude=ROIS_TO_SKIP)[0]
         filename = os.path.join(os.getcwd(), subject_id+'.csv')
-        newvals = np.vstack((roi_idx[ids2keep], roi_vals[:, np.array(ids2keep)])).T
-        np.savetxt(filename, newvals, '%.4f', delimiter=',')
-        return filename
+        return write_roi_table(filename, stats['labels'], stats['means'])
 
-    roistripper = pe.MapNode(util.Function(input_names=['subject_id', 'summary_file', 'roi_file'],
+    roistripper = pe.MapNode(util.Function(input_names=['subject_id', 'label_file', 'in_file'],
                                        output_names=['roi_file'],
-                                       function=strip_ids),
-                          name='roistripper', iterfield=['summary_file','roi_file'])
+                                       function=roi_waveforms),
+                          name='roistripper', iterfield=['label_file','in_file'])
     
     preproc.connect(inputspec,'subject',roistripper,'subject_id')
     
-    preproc.connect(statsflow, 'segstats.avgwf_txt_file', roistripper, 'roi_file')
-    preproc.connect(statsflow, 'segstats.summary_file', roistripper, 'summary_file')
+    preproc.connect(voltransform,'transformed_file',roistripper,'label_file')
+    preproc.connect(inputspec,'tsnr_file',roistripper,'in_file')
 
-    roiplotter = pe.MapNode(util.Function(input_names=['statsfile', 'roi','TR','plot','onsets'],
+    roiplotter = pe.MapNode(util.Function(input_names=['statsfile', 'roi','TR','plot','onsets','as_array'],
                                        output_names=['Fname','AvgRoi'],
                                        function=plot_timeseries),
                           name='roiplotter', iterfield=['statsfile'])
     roiplotter.inputs.roi = roi
     preproc.connect(inputspec,'TR',roiplotter,'TR')
     roiplotter.inputs.plot = plot
+    # tables come out as one record array per run (see combine_table)
+    roiplotter.inputs.as_array = not plot
     if onsets:
         preproc.connect(inputspec,'onsets',roiplotter,'onsets')
     else:
@@ -156,26 +154,50 @@ def tsnr_roi(roi=[1021],name='roi_flow',plot=False, onsets=False):
 
     return preproc
     
-def tsdiffana(img):
-    # Should be a nipype wrapper, but for now a function node.
-    from nipy.algorithms.diagnostics import tsdiffplot as tdp
+def tsdiff_metrics(img):
+    """ Computes tsdiffana metrics of a 4D image, two volumes at a time
+    
+    Parameters
+    ----------
+    img : File
+          4D image
+    
+    Returns
+    -------
+    File : .npz of the metrics (see tsdiff.time_slice_diffs)
+    """
     import os
-    import matplotlib
-    matplotlib.use('Agg')
-    import matplotlib.pyplot as plt
-   
+    from tsdiff import time_slice_diffs, save_metrics
+    metrics_file = os.path.abspath("tsdiffana_"+os.path.split(img)[1]+".npz")
+    return save_metrics(time_slice_diffs(img), metrics_file)
 
-    axes = tdp.plot_tsdiffs_image(img, axes=None, show=False)
-    out_file = []
+def tsdiff_plot(metrics_file):
+    """ Returns the tsdiffana plot of metrics written by tsdiff_metrics
     
-    of = os.path.abspath("tsdiffana_"+os.path.split(img)[1]+".png")
-    x = plt.sca(axes[0])
-    plt.savefig(of,dpi=300)
-    out_file.append(of)
-    plt.close()
-    return out_file
+    Parameters
+    ----------
+    metrics_file : File
+                   .npz output of tsdiff_metrics
+    
+    Returns
+    -------
+    List : filename of plot image
+    """
+    import os
+    from figcache import FigureCache
+    from tsdiff import METRICS, PLOT_VERSION, load_metrics, plot_tsdiffs
+    of = os.path.abspath(os.path.split(metrics_file)[1][:-4]+".png")
+    cache = FigureCache()
+    # keyed on the metric arrays, not on how the npz file was written
+    metrics = load_metrics(metrics_file)
+    key = cache.array_key('tsdiff_plot', [metrics[m] for m in METRICS],
+                          PLOT_VERSION)
+    if not cache.fetch(key, [of]):
+        plot_tsdiffs(metrics, of)
+        cache.store(key, [of])
+    return [of]
 
-def plot_timeseries(roi,statsfile,TR,plot,onsets):
+def plot_timeseries(roi,statsfile,TR,plot,onsets,as_array=False):
     """ Returns a plot of an averaged timeseries across an roi
     
     Parameters
@@ -188,6 +210,9 @@ def plot_timeseries(roi,statsfile,TR,plot,onsets):
          TR of scan
     plot : Boolean
            True to return plot
+    as_array : Boolean
+               True to return the average values of all ROIs as one \
+               record array with fields id, name and value (plot=False)
            
     Returns
     -------
@@ -200,32 +225,38 @@ def plot_timeseries(roi,statsfile,TR,plot,onsets):
     import matplotlib
     matplotlib.use('Agg')
     import matplotlib.pyplot as plt
-    stats = np.recfromcsv(statsfile)     
+    from labelstats import get_lut
+    stats = np.atleast_2d(np.genfromtxt(statsfile, delimiter=','))
     
-    LUT = np.genfromtxt('/software/Freesurfer/current/FreeSurferColorLUT.txt',dtype = str)
-    roinum = LUT[:,0]
-    roiname = LUT[:,1]
+    LUT = get_lut()
+    # index of each roi's row in the stats file
+    rows = dict([(int(r), i) for i, r in enumerate(stats[:,0])])
     Fname = []
     AvgRoi = []
     
     if roi == ['all']:
-        roi = []
-        for i, r in enumerate(stats):
-            roi.append(list(r)[0]) 
+        roi = stats[:,0].astype(int).tolist()
+    
+    if as_array and not plot:
+        found = [R for R in roi if int(R) in rows]
+        for R in roi:
+            if not int(R) in rows:
+                print("roi %s not found!" % R)
+        idx = np.array([rows[int(R)] for R in found], dtype=int)
+        AvgRoi = np.zeros(len(found), dtype=[('id', int), ('name', object),
+                                             ('value', float)])
+        AvgRoi['id'] = found
+        AvgRoi['name'] = [LUT.get(R, str(R)) for R in found]
+        AvgRoi['value'] = stats[idx,1:].mean(axis=1) if len(found) else []
+        return Fname, AvgRoi
     
     for R in roi:
-        temp = False
-        #ghetto for loop: find index of roi in stats list
-        for i, r in enumerate(stats):
-            if list(r)[0] == R:
-                temp = True
-                break    
-        
-        if temp:
+        if int(R) in rows:
+            i = rows[int(R)]
             #find roi name for plot title
-            title = roiname[roinum==str(np.int_(R))][0]
+            title = LUT.get(R, str(R))
             if plot:
-                nums = list(stats[i])[1:]
+                nums = stats[i,1:].tolist()
                 X = np.array(range(len(nums)))*TR
                 plt.figure(1)
                 p1 = plt.plot(X,nums)
@@ -245,46 +276,121 @@ def plot_timeseries(roi,statsfile,TR,plot,onsets):
                 plt.close()
                 Fname.append(fname)
             else:
-                AvgRoi.append([title,np.mean(list(stats[i])[1])])
+                AvgRoi.append([title,np.mean(stats[i,1:])])
         else:
             print "roi %s not found!"%R
     return Fname, AvgRoi
 
 
 def combine_table(roidev,roisnr):
-    if len(roisnr) == len(roidev):
-        for i, roi in enumerate(roisnr):
+    """ Merges the per-ROI standard deviation and TSNR of one run into a
+    table sorted by TSNR
+    
+    Parameters
+    ----------
+    roidev : record array (id, name, value) of the standard deviation per ROI
+    roisnr : record array (id, name, value) of the TSNR per ROI
+    
+    Returns
+    -------
+    List : rows of ROI name, TSNR, mean and standard deviation (mean and \
+           standard deviation only if every ROI has both), with a header row
+    """
+    import numpy as np
+    dev = dict(zip(roidev['id'], roidev['value']))
+    merge = all([R in dev for R in roisnr['id']])
+    table = []
+    for i in np.argsort(roisnr['value'], kind='mergesort'):
+        row = [roisnr['name'][i], float(roisnr['value'][i])]
+        if merge:
+            sd = float(dev[roisnr['id'][i]])
             # merge mean and stddev table
-            roi.append(roidev[i][1]*roisnr[i][1])
-            roi.append(roidev[i][1])
-            
-        roisnr.sort(key=lambda x:x[1])
-        roisnr.insert(0,['ROI','TSNR',
-                         'Mean','Standard Deviation'])
+            row += [sd*row[1], sd]
+        table.append(row)
+    if merge:
+        table.insert(0,['ROI','TSNR',
+                        'Mean','Standard Deviation'])
     else:
-        roisnr.sort(key=lambda x:x[1])
-        roisnr.insert(0,['ROI','TSNR'])     
-    return roisnr
+        table.insert(0,['ROI','TSNR'])
+    return table
     
+def qa_metrics(art_file, ADnorm, roi_table, reg_file):
+    """ Collects the structured QA metrics of one subject for the
+    cohort metrics store
+
+    Parameters
+    ----------
+    art_file : list of art outlier files (one per run)
+    ADnorm : list of art composite norm files (one per run)
+    roi_table : list of combined ROI tables (output of combine_table)
+    reg_file : bbregister registration file; its .mincost file, if present,
+               gives the registration cost
+
+    Returns
+    -------
+    dict with 'runs' (outliers, mean_norm, max_norm, reg_cost per run) and
+    'rois' (tsnr, mean, stddev per ROI and run)
+    """
+    import os
+    import numpy as np
+    if not isinstance(art_file, list):
+        art_file = [art_file]
+    if not isinstance(ADnorm, list):
+        ADnorm = [ADnorm]
+    reg_cost = None
+    if isinstance(reg_file, list):
+        reg_file = reg_file[0]
+    if os.path.exists(str(reg_file) + '.mincost'):
+        reg_cost = float(np.atleast_1d(np.genfromtxt(reg_file + '.mincost'))[0])
+    runs = []
+    for i, outliers in enumerate(art_file):
+        run = {}
+        if os.path.getsize(outliers):
+            run['outliers'] = np.atleast_1d(np.genfromtxt(outliers)).size
+        else:
+            run['outliers'] = 0
+        if i < len(ADnorm):
+            norm = np.atleast_1d(np.genfromtxt(ADnorm[i]))
+            run['mean_norm'] = float(np.mean(norm))
+            run['max_norm'] = float(np.max(norm))
+        if reg_cost is not None:
+            run['reg_cost'] = reg_cost
+        runs.append(run)
+    names = ['tsnr', 'mean', 'stddev']
+    rois = []
+    for table in roi_table:
+        rois.append(dict([(row[0], dict(zip(names, row[1:])))
+                          for row in table[1:]]))
+    return dict(runs=runs, rois=rois)
+
 def plot_motion(motion_parameters):
-    import matplotlib.pyplot as plt
+    import os
+    from figcache import FigureCache
+    # part of the cache key: change it whenever the plots below change
+    PLOT_VERSION = '1'
+    fname_t=os.path.abspath('translations.png')
+    fname_r = os.path.abspath('rotations.png')
+    cache = FigureCache()
+    key = cache.key('plot_motion', motion_parameters, PLOT_VERSION)
+    if cache.fetch(key, [fname_t, fname_r]):
+        return [fname_t, fname_r]
+    
     import matplotlib
     matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
     import numpy as np
-    import os
-    fname_t=os.path.abspath('translations.png')
     plt.figure(1,figsize = (8,3))
     plt.plot(np.genfromtxt(motion_parameters)[:,3:])
     plt.title("Estimated Translations (mm)")
     plt.savefig(fname_t)
     plt.close()
     
-    fname_r = os.path.abspath('rotations.png')
     plt.figure(2,figsize = (8,3))
     plt.plot(np.genfromtxt(motion_parameters)[:,:3])
     plt.title("Estimated Rotations (rad)")
     plt.savefig(fname_r)
     plt.close()
     fname = [fname_t, fname_r]
+    cache.store(key, fname)
     return fname
     
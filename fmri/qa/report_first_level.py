@@ -2,7 +2,6 @@ import matplotlib
 matplotlib.use('Agg')
 import os
 from scipy.ndimage import label
-from nipy.labs import viz
 from nibabel import load
 import pylab
 import matplotlib.pyplot as plt
@@ -18,6 +17,9 @@ sys.path.insert(0,'..')
 from utils import pickfirst
 sys.path.insert(0,'../../utils')
 from reportsink.io import ReportSink
+from pbsplan import run_workflow
+from sinkmanifest import ManifestDataGrabber, ManifestDataSink
+from figcache import set_cache_dir
 from QA_utils import tsnr_roi
 
 
@@ -25,51 +27,30 @@ def get_coords(labels, in_file, subsess, fsdir):
     from nibabel import load
     import numpy as np
     import os 
+    from clusters import cluster_summary, locate_clusters
     
     img = labels[0]
     data1 = in_file
     data,affine = load(data1).get_data(), load(data1).get_affine()
     coords = []
-    labels = np.setdiff1d(np.unique(img.ravel()), [0])
-    cs = []
+    summary = cluster_summary(img, data)
+    labels = summary['ids']
+    cs = summary['sizes'].tolist()
     
     brain_dir = os.path.join(fsdir,subsess,'mri')
     lut_file='/software/Freesurfer/5.1.0/FreeSurferColorLUT.txt'
-    colorfile = np.genfromtxt(lut_file,dtype='string')
+    if not os.path.exists(lut_file):
+        lut_file = None
     seg_file = os.path.join(brain_dir,'aparc+aseg.mgz')
-    data_seg,aff_seg = load(seg_file).get_data(), load(seg_file).get_affine()
-    inv_aff_seg = np.linalg.inv(aff_seg)
-    
-    def make_chart(coords):
-        brain_loc = []
-        
-        for co in coords:
-            realspace = np.dot(affine,np.hstack((co,1)))
-            #segspace = np.dot(inv_aff_seg, np.hstack((co,1)))
-            segspace = np.dot(inv_aff_seg, realspace)
-            colornum = str(data_seg[segspace[0],segspace[1],segspace[2]])
-            brain_loc.append(colorfile[:,1][colorfile[:,0]==colornum][0])
-        
-        percents = []
-
-        for loc in np.unique(brain_loc):
-            #percents.append(np.mean(loc==brain_loc, dtype=np.float64))
-            percents.append(np.mean(loc==np.array(brain_loc), dtype=np.float64))
-        return np.unique(brain_loc), percents
-    
-    for label in labels:
-        cs.append(np.sum(img==label))
+    charts = locate_clusters(summary['voxels'], affine, seg_file, lut_file)
     
     locations = []
     percents = []
     meanval = []
-    for label in labels[np.argsort(cs)[::-1]]:
-        coordinates = np.asarray(np.nonzero(img==label))  
-        print coordinates.shape
-        locs, pers = make_chart(coordinates.T)
-        i =  np.argmax(abs(data[coordinates[0,:],coordinates[1,:],coordinates[2,:]])) 
-        meanval.append(np.mean(data[coordinates[0,:],coordinates[1,:],coordinates[2,:]]))
-        q =  coordinates[:,i]
+    for i in np.argsort(cs)[::-1]:
+        locs, pers = charts[i]
+        meanval.append(summary['means'][i])
+        q =  summary['peaks'][i]
         locations.append(locs)
         percents.append(pers)
         coords.append(np.dot(affine, np.hstack((q,1)))[:3].tolist())  
@@ -79,62 +60,44 @@ def get_coords(labels, in_file, subsess, fsdir):
 
 def get_labels(in_file,thr,csize):
     from nibabel import load
-    from scipy.ndimage import label
-    #from numpy import *
-    min_extent=csize
+    from clusters import label_clusters
     data = load(in_file).get_data()
-    labels, nlabels = label(abs(data)>thr)
-    for idx in range(1, nlabels+1):
-        if sum(sum(sum(labels==idx)))<min_extent:
-            labels[labels==idx] = 0
+    labels = label_clusters(data, thr, min_extent=csize)
     return [labels]
             
 
-def show_slices(image_in, anat_file, coordinates,thr):
-    import matplotlib
-    matplotlib.use('Agg')
-    import matplotlib.pyplot as plt
-    import pylab as pl
-    import numpy as np
-    from nibabel import load
+def show_slices(image_in, anat_file, coordinates, thr, dpi=600):
+    """ Returns one orthogonal view image per cluster coordinate
+    
+    The images are loaded and resampled once; the clusters are rendered
+    in a thread pool.
+    """
     import os
-    from nipy.labs import viz
-    anat = anat_file
-    img = image_in
+    from figcache import FigureCache
+    from render import PLOT_VERSION, SliceRenderer
+    
     coords = coordinates[0]
-    threshold=thr
-    cmap=pl.cm.jet 
-    prefix=None,
-    show_colorbar=True
-    formatter='%.2f'
-    
-    img1 = load(img)
-    data, aff = img1.get_data(), img1.get_affine()
-    anatimg = load(anat) #load('/usr/share/fsl/data/standard/MNI152_T1_1mm_brain.nii.gz')
-    anatdata, anataff = anatimg.get_data(), anatimg.get_affine()
-    anatdata = anatdata.astype(np.float)
-    anatdata[anatdata<10.] = np.nan
-    outfile1 = os.path.split(img)[1][0:-7]
-    outfiles = []
-    for idx,coord in enumerate(coords):
-        outfile = outfile1+'cluster%02d' % idx
-        osl = viz.plot_map(np.asarray(data), aff, anat=anatdata, anat_affine=anataff,
-                           threshold=threshold, cmap=cmap,
-                           black_bg=False, cut_coords=coord)
-        if show_colorbar:
-            cb = plt.colorbar(plt.gca().get_images()[1], cax=plt.axes([0.4, 0.075, 0.2, 0.025]), 
-                     orientation='horizontal', format=formatter)
-            cb.set_ticks([cb._values.min(), cb._values.max()])
-            
-        #osl.frame_axes.figure.savefig(outfile+'.svg', bbox_inches='tight', transparent=True)
-        osl.frame_axes.figure.savefig(os.path.join(os.getcwd(),outfile+'.png'), dpi=600, bbox_inches='tight', transparent=True)
-        #pl.savefig(os.path.join(os.getcwd(),outfile+'.png'), dpi=600, bbox_inches='tight', transparent=True)               
-        outfiles.append(os.path.join(os.getcwd(),outfile+'.png'))
+    outfile1 = os.path.split(image_in)[1][0:-7]
+    outfiles = [os.path.join(os.getcwd(), outfile1+'cluster%02d.png' % idx)
+                for idx in range(len(coords))]
+    cache = FigureCache()
+    key = cache.key('show_slices', [image_in, anat_file],
+                    [list(map(float, coord)) for coord in coords], thr, dpi,
+                    PLOT_VERSION)
+    if cache.fetch(key, outfiles):
+        return outfiles
+    
+    renderer = SliceRenderer(image_in, anat_file, thr, cmap='jet',
+                             background_min=10.)
+    jobs = [(('x', 'y', 'z'), coord, outfile)
+            for coord, outfile in zip(coords, outfiles)]
+    outfiles = renderer.render_many(jobs, dpi=dpi, transparent=True)
+    cache.store(key, outfiles)
     return outfiles
 
 
 
-def img_wkflw(thr, csize, name='slice_image_generator'):
+def img_wkflw(thr, csize, name='slice_image_generator', dpi=600):
     inputspec = pe.Node(util.IdentityInterface(fields=['in_file','mask_file','anat_file','reg_file', 'subject_id','fsdir']),
                         name='inputspec')
     workflow = pe.Workflow(name=name)
@@ -161,9 +124,10 @@ def img_wkflw(thr, csize, name='slice_image_generator'):
     workflow.connect(applymask,'out_file',getcoords,'in_file')  
     
    
-    showslices = pe.MapNode(util.Function(input_names=['image_in','anat_file','coordinates','thr'], output_names = ["outfiles"], function=show_slices), iterfield= ['image_in','coordinates'],
+    showslices = pe.MapNode(util.Function(input_names=['image_in','anat_file','coordinates','thr','dpi'], output_names = ["outfiles"], function=show_slices), iterfield= ['image_in','coordinates'],
                             name='showslices')  
     showslices.inputs.thr = thr
+    showslices.inputs.dpi = dpi
     
     workflow.connect(inputspec,'anat_file',showslices,'anat_file')
     workflow.connect(getcoords,'coordinates',showslices,'coordinates') 
@@ -183,7 +147,7 @@ def img_wkflw(thr, csize, name='slice_image_generator'):
     
 def get_data(name='first_level_datagrab'):
     
-    datasource = pe.Node(nio.DataGrabber(infields=['subject_id', 'fwhm'], outfields=['func','mask','reg','des_mat','des_mat_cov','detrended']), name='datasource')
+    datasource = pe.Node(ManifestDataGrabber(infields=['subject_id', 'fwhm'], outfields=['func','mask','reg','des_mat','des_mat_cov','detrended']), name='datasource')
 
     datasource.inputs.template = '*'
     
@@ -206,7 +170,7 @@ def get_data(name='first_level_datagrab'):
     
 def get_fx_data(name='fixedfx_level_datagrab'):
     
-    datasource = pe.Node(nio.DataGrabber(infields=['subject_id', 'fwhm'], outfields=['func','mask','reg','des_mat','des_mat_cov','detrended']), name='datasource')
+    datasource = pe.Node(ManifestDataGrabber(infields=['subject_id', 'fwhm'], outfields=['func','mask','reg','des_mat','des_mat_cov','detrended']), name='datasource')
 
     datasource.inputs.template = '*'
     
@@ -253,7 +217,7 @@ def combine_report(thr=2.326,csize=30,fx=False):
     workflow.connect(infosource, 'subject_id', fssource, 'subject_id')
     fssource.inputs.subjects_dir = c.surf_dir
     
-    imgflow = img_wkflw(thr=thr,csize=csize)
+    imgflow = img_wkflw(thr=thr,csize=csize,dpi=getattr(c, 'report_dpi', 600))
     
     # adding cluster correction before sending to imgflow
     
@@ -307,15 +271,16 @@ def combine_report(thr=2.326,csize=30,fx=False):
     writereport.inputs.thr = thr
     writereport.inputs.csize = csize
     
-    makesurfaceplots = pe.Node(util.Function(input_names = ['con_image','reg_file','subject_id','thr','sd'], output_names = ['surface_ims', 'surface_mgzs'], function = make_surface_plots), 
+    makesurfaceplots = pe.Node(util.Function(input_names = ['con_image','reg_file','subject_id','thr','sd','workers'], output_names = ['surface_ims', 'surface_mgzs'], function = make_surface_plots), 
                                name = 'make_surface_plots')
     
     workflow.connect(infosource, 'subject_id', makesurfaceplots, 'subject_id')
     
     makesurfaceplots.inputs.thr = thr
     makesurfaceplots.inputs.sd = c.surf_dir
+    makesurfaceplots.inputs.workers = getattr(c, 'surface_workers', 4)
     
-    sinker = pe.Node(nio.DataSink(), name='sinker')
+    sinker = pe.Node(ManifestDataSink(), name='sinker')
     sinker.inputs.base_directory = os.path.join(c.sink_dir,'analyses','func')
     
     workflow.connect(infosource,'subject_id',sinker,'container')
@@ -484,38 +449,37 @@ def write_report(cs,locations,percents,in_files,
     doc.build(elements)
     return report, elements 
 
-def make_surface_plots(con_image,reg_file,subject_id,thr,sd):  
-    import matplotlib
-    matplotlib.use('Agg')
-    #from surfer import Brain
+def make_surface_plots(con_image,reg_file,subject_id,thr,sd,workers=None):  
     import os
-    from glob import glob
-        
-    def make_image(zstat_path,bbreg_path):
-        name_path = os.path.join(os.getcwd(),os.path.split(zstat_path)[1]+'_reg_surface.mgh')
-        systemcommand ='mri_vol2surf --mov %s --reg %s --hemi lh --projfrac-max 0 1 0.1 --o %s --out_type mgh --sd %s'%(zstat_path,bbreg_path,name_path, sd)
-        print systemcommand
-        os.system(systemcommand)
-        return name_path
-        
-    def make_brain(subject_id,image_path):
-        from mayavi import mlab
-        from surfer import Brain
-        hemi = 'lh'
-        surface = 'inflated'
-        overlay = image_path 
-        brain = Brain(subject_id, hemi, surface)
-        brain.add_overlay(image_path,min=thr)
-        outpath = os.path.join(os.getcwd(),os.path.split(image_path)[1]+'_surf.png')
-        brain.save_montage(outpath)
-        return outpath
+    from figcache import FigureCache
+    from surfproj import PLOT_VERSION, project_volumes, SurfaceRenderer
+    cache = FigureCache()
             
     surface_ims = []
     surface_mgzs = []
+    missing = []
     for con in con_image:
-        surf_mgz = make_image(format(con),reg_file)
+        surf_mgz = os.path.join(os.getcwd(),os.path.split(con)[1]+'_reg_surface.mgh')
+        surf_im = os.path.join(os.getcwd(),os.path.split(surf_mgz)[1]+'_surf.png')
+        key = cache.key('make_surface_plots', [con, reg_file], subject_id, thr, sd,
+                        PLOT_VERSION)
+        if not cache.fetch(key, [surf_mgz, surf_im]):
+            missing.append((key, con, surf_mgz, surf_im))
         surface_mgzs.append(surf_mgz)
-        surface_ims.append(make_brain(subject_id,surf_mgz))
+        surface_ims.append(surf_im)
+
+    if missing:
+        # project every contrast at once, then draw them on one surface
+        project_volumes([(con, reg_file, surf_mgz)
+                         for _, con, surf_mgz, _ in missing],
+                        workers=workers, hemi='lh', sd=sd)
+        renderer = SurfaceRenderer(subject_id, 'lh', 'inflated', sd)
+        try:
+            for key, con, surf_mgz, surf_im in missing:
+                renderer.render(surf_mgz, surf_im, thr)
+                cache.store(key, [surf_mgz, surf_im])
+        finally:
+            renderer.close()
                             
     return surface_ims, surface_mgzs   
   
@@ -540,6 +504,7 @@ if __name__ == '__main__':
     path, fname = os.path.split(os.path.realpath(args.config))
     sys.path.append(path)
     c = __import__(fname.split('.')[0])
+    set_cache_dir(os.path.join(c.working_dir, 'figure_cache'))
 
     workflow = combine_report(fx=args.fx)
     workflow.base_dir = c.working_dir
@@ -550,8 +515,5 @@ if __name__ == '__main__':
         print "export SUBJECTS_DIR=%s"%c.surf_dir
         
     else:
-        if c.run_on_grid:
-            workflow.run(plugin=c.plugin, plugin_args=c.plugin_args['qsub_args']+'-X')
-        else:
-            workflow.run()
+        run_workflow(workflow, c, plugin_args=c.plugin_args['qsub_args']+'-X')
         
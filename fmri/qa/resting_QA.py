@@ -5,6 +5,8 @@ import nipype.interfaces.io as nio
 import argparse
 import sys
 from reportsink.io import ReportSink
+from sinkmanifest import ManifestDataGrabber
+from pbsplan import run_workflow
 
 addtitle = lambda x: "Resting_State_Correlations_fwhm%s"%str(x)
 
@@ -36,31 +38,24 @@ def corr_image(resting_image,fwhm):
     import matplotlib.pyplot as plt
     from surfer import Brain, Surface
     import os
+    from seedcorr import SeedConnectivity
     
     img = nb.load(resting_image)
-    corrmat = np.corrcoef(np.squeeze(img.get_data()))
-    corrmat[np.isnan(corrmat)] = 0
     br = Brain('fsaverage5', 'lh', 'smoothwm')
 
-    #br.add_overlay(corrmat[0,:], min=0.2, name=0, visible=True)
     values = nb.freesurfer.read_annot('/software/Freesurfer/5.1.0/subjects/fsaverage5/label/lh.aparc.annot')
-
-    #br.add_overlay(np.mean(corrmat[values[0]==5,:], axis=0), min=0.8, name='mean', visible=True)
-    
+    names = list(values[2])
     
-    data = img.get_data()
-
     data = np.squeeze(img.get_data())
+    conn = SeedConnectivity(data, values[0])
     
-    #
-    precuneus_signal = np.mean(data[values[0]==np.nonzero(np.array(values[2])=='precuneus')[0][0],:], axis=0)
-    precuneus = np.corrcoef(precuneus_signal, data)
-    #precuneus.shape
-    
-    #br.add_overlay(precuneus[0,1:], min=0.3, sign='pos', name='mean', visible=True)
+    # seed timecourses of all regions, correlated with every vertex at once
+    ids = np.arange(len(names))
+    correlations = conn.region_correlations(ids)
+    precuneus = correlations[names.index('precuneus')]
 
-    br.add_overlay(precuneus[0,1:], min=0.2, name='mean', visible=True)
-    plt.hist(precuneus[0,1:], 128)
+    br.add_overlay(precuneus, min=0.2, name='mean', visible=True)
+    plt.hist(precuneus, 128)
     plt.savefig(os.path.abspath("histogram.png"))
     plt.close()
     
@@ -68,31 +63,34 @@ def corr_image(resting_image,fwhm):
     br.save_montage(corr_image)
     ims = br.save_imageset(prefix=os.path.abspath('fwhm_%s'%str(fwhm)),views=['medial','lateral','caudal','rostral','dorsal','ventral'])
     br.close()
-    print ims
-    #precuneus[np.isnan(precuneus)] = 0
-    #plt.hist(precuneus[0,1:])
+    print(ims)
     
+    roi_means = conn.region_table(precuneus, ids)
     roitable = [['Region','Mean Correlation']]
-    for i, roi in enumerate(np.unique(values[2])):
-        roitable.append([roi,np.mean(precuneus[values[0]==np.nonzero(np.array(values[2])==roi)[0][0]])])    
+    for roi in np.unique(names):
+        roitable.append([roi,roi_means[names.index(roi)]])
     
-    #images = [corr_image]+ims+[os.path.abspath("histogram.png"), roitable]
     roitable=[roitable]
     histogram = os.path.abspath("histogram.png")
     
     return corr_image, ims, roitable, histogram
     
-def vol2surf(input_volume,ref_volume,reg_file,trg,hemi):
+def vol2surf(input_volume,ref_volume,reg_file,trg,hemi,workers=None):
+    """Project every run to the target surface in a bounded process pool"""
     import os
-    out_file = os.path.abspath("surface.nii")
-    os.system("mri_vol2surf --mov %s --ref %s --reg %s --trgsubject %s \
-              --hemi %s --out_type nii --out %s --interp trilinear \
-              --projfrac 0.5" % (input_volume, ref_volume, reg_file,
-                                  trg, hemi, out_file))
+    from surfproj import project_volumes
+    if not isinstance(input_volume, list):
+        input_volume = [input_volume]
+    jobs = [(vol, reg_file, os.path.abspath("surface%d.nii" % i))
+            for i, vol in enumerate(input_volume)]
+    out_file, _ = project_volumes(jobs, workers=workers, hemi=hemi,
+                                  ref=ref_volume, trgsubject=trg,
+                                  out_type='nii', projfrac=0.5,
+                                  interp='trilinear')
     return out_file
 
 def resting_datagrab(name="resting_datagrabber"):
-    datasource = pe.Node(interface=nio.DataGrabber(infields=['subject_id',
+    datasource = pe.Node(interface=ManifestDataGrabber(infields=['subject_id',
                                                              'fwhm'],
                                                    outfields=['reg_file',
                                                               'mean_image',
@@ -134,15 +132,17 @@ def resting_QA(name="resting_QA"):
     workflow.inputs.inputspec.subjects_dir = c.surf_dir
     workflow.connect(dataflow,'mean_image', inputspec,'mean_image')
     
-    tosurf = pe.MapNode(util.Function(input_names=['input_volume',
+    tosurf = pe.Node(util.Function(input_names=['input_volume',
                                                 'ref_volume',
                                                 'reg_file',
                                                 'trg',
-                                                'hemi'],
+                                                'hemi',
+                                                'workers'],
                                    output_names=["out_file"],
-                                   function=vol2surf), name='vol2surf',iterfield=["input_volume"])
+                                   function=vol2surf), name='vol2surf')
     tosurf.inputs.hemi = 'lh'
     tosurf.inputs.trg = 'fsaverage5'
+    tosurf.inputs.workers = getattr(c, 'surface_workers', 4)
     
     workflow.connect(inputspec,'in_files',tosurf,'input_volume')
     workflow.connect(inputspec,'reg_file',tosurf,'reg_file')
@@ -159,6 +159,9 @@ def resting_QA(name="resting_QA"):
     sink = pe.Node(ReportSink(orderfields=["Introduction","Subject","Configuration","Correlation_Images","Other_Views","ROI_Table","Histogram"]),name="write_report")
     sink.inputs.base_directory = os.path.join(c.sink_dir,'analyses','func')
     sink.inputs.json_sink = c.json_sink
+    sink.inputs.report_format = getattr(c, 'report_format', 'pdf')
+    if getattr(c, 'profile_dir', None):
+        sink.inputs.profile_dir = c.profile_dir
     sink.inputs.Introduction = "Resting state corellations with seed at precuneus"
     sink.inputs.Configuration = start_config_table()
     #sink.inputs.report_name = "Resting_State_Correlations"
@@ -196,10 +199,7 @@ if __name__== "__main__":
         print "Your SUBJECTS_DIR is incorrect!"
         print "export SUBJECTS_DIR=%s"%c.surf_dir
     else:
-        if c.run_on_grid:
-            a.run(plugin=c.plugin,plugin_args=c.plugin_args)
-        else:
-            a.run()
+        run_workflow(a, c)
     
     
 """    
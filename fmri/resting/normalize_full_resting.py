@@ -2,11 +2,14 @@ import argparse
 import os
 import sys
 sys.path.insert(0, '../../normalize')
+sys.path.insert(0, '../../utils')
 from base import get_full_norm_workflow
+from sinkmanifest import ManifestDataGrabber, ManifestDataSink
+from imagemeta import set_cache_dir
+from pbsplan import run_workflow
 import nipype.pipeline.engine as pe
 import nipype.interfaces.utility as util
 from nipype.interfaces.io import FreeSurferSource
-import nipype.interfaces.io as nio
 
 
 pickfirst = lambda x: x[0]
@@ -14,9 +17,8 @@ pickfirst = lambda x: x[0]
 
 def func_datagrabber(name="resting_output_datagrabber"):
     import nipype.pipeline.engine as pe
-    import nipype.interfaces.io as nio
     # create a node to obtain the functional images
-    datasource = pe.Node(interface=nio.DataGrabber(infields=['subject_id',
+    datasource = pe.Node(interface=ManifestDataGrabber(infields=['subject_id',
                                                              'fwhm'],
                                                    outfields=['output',
                                                               'meanfunc',
@@ -36,7 +38,12 @@ def func_datagrabber(name="resting_output_datagrabber"):
 
 
 def normalize_workflow(name="normalize"):
-    norm = get_full_norm_workflow()
+    norm = get_full_norm_workflow(composite=getattr(c, 'composite_warp',
+                                                    False),
+                                  cache_dir=getattr(c, 'base_norm_dir', None),
+                                  workers=getattr(c, 'composite_workers', 1),
+                                  struct_plugin_args=getattr(
+                                      c, 'struct_norm_plugin_args', None))
     datagrab = func_datagrabber()
 
     fssource = pe.Node(interface=FreeSurferSource(), name='fssource')
@@ -53,6 +60,7 @@ def normalize_workflow(name="normalize"):
     inputspec = norm.get_node('inputspec')
 
     norm.connect(infosource, 'subject_id', fssource, 'subject_id')
+    norm.connect(infosource, 'subject_id', inputspec, 'subject_id')
     norm.connect(fssource, ('aparc_aseg', pickfirst),
                  inputspec, 'segmentation')
     norm.connect(fssource, 'orig', inputspec, 'brain')
@@ -64,7 +72,7 @@ def normalize_workflow(name="normalize"):
 
     norm.inputs.inputspec.template_file = c.norm_template
 
-    sinkd = pe.Node(nio.DataSink(), name='sinkd')
+    sinkd = pe.Node(ManifestDataSink(), name='sinkd')
     sinkd.inputs.base_directory = os.path.join(c.sink_dir, 'analyses', 'func')
 
     outputspec = norm.get_node('outputspec')
@@ -94,13 +102,11 @@ if __name__ == "__main__":
     path, fname = os.path.split(os.path.realpath(args.config))
     sys.path.append(path)
     c = __import__(fname.split('.')[0])
+    set_cache_dir(c.working_dir)
 
     workflow = normalize_workflow()
     workflow.base_dir = c.working_dir
 
     if len(c.subjects) == 1:
         workflow.write_graph()
-    if c.run_on_grid:
-        workflow.run(plugin=c.plugin, plugin_args=c.plugin_args)
-    else:
-        workflow.run()
+    run_workflow(workflow, c)
@@ -8,6 +8,8 @@ import os
 
 from base import create_rest_prep
 from utils import get_datasink, get_substitutions, get_regexp_substitutions
+from imagemeta import set_cache_dir
+from pbsplan import run_workflow
 import argparse
 
 # Preprocessing
@@ -133,6 +135,7 @@ if __name__ == "__main__":
     path, fname = os.path.split(os.path.realpath(args.config))
     sys.path.append(path)
     c = __import__(fname.split('.')[0])
+    set_cache_dir(c.working_dir)
 
     #from nipype import config
     #if c.test_mode:
@@ -147,9 +150,5 @@ if __name__ == "__main__":
     if len(c.subjects) == 1:
         preprocess.write_graph(graph2use='exec',
                                dotfilename='single_subject_exec.dot')
-    if c.run_on_grid:
-        preprocess.run(plugin='PBS', plugin_args = c.plugin_args)
-    else:
-        preprocess.run()
-        #preprocess.run(plugin='MultiProc', plugin_args={'n_procs': 4})
+    run_workflow(preprocess, c, plugin='PBS')
 
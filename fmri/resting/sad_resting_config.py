@@ -38,6 +38,30 @@ field_dir : (Optional) Base directory of field-map data (Should be subject-indep
 surf_dir : Freesurfer subjects directory
 
 crash_dir : Location to store crash files
+
+base_norm_dir : Location of the structural normalization cache. ANTS is \
+                run once per subject and template, stored in \
+                base_norm_dir/<subject>/struct_norm, and reused by every \
+                normalization run. Set to None to recompute it every time
+
+struct_norm_plugin_args : Dict
+                          plugin_args of the cached structural normalization \
+                          node. Its job runs ANTS (single threaded) when the \
+                          cache misses, so it is always submitted, and with \
+                          resource_plan its ppn, mem and walltime are only \
+                          ever raised from its profiles, never lowered.
+
+profile_dir : (Optional) Location of the per-node resource profiles (wall \
+              time, CPU time, peak memory, I/O) written by \
+              utils/nodeprofile.py. Must be reachable from the grid nodes. \
+              Set this value to None to disable profiling.
+
+resource_plan : Boolean or 'dry_run'
+                True to size the PBS request (ppn, mem, walltime) of every \
+                node from its profiles in profile_dir and run tiny utility \
+                nodes without submitting them (utils/pbsplan.py). Nodes \
+                without profiles keep plugin_args. 'dry_run' prints the \
+                plan and exits.
 """
 
 working_dir = '/mindhive/scratch/keshavan/sad/resting'
@@ -56,6 +80,10 @@ base_norm_dir = '/mindhive/xnat/surfaces/sad/ANTS'
 
 json_sink = '/mindhive/xnat/data/TSNR/sad/resting'
 
+profile_dir = None
+
+resource_plan = False
+
 """
 Workflow Inputs:
 ----------------
@@ -121,6 +149,9 @@ plugin = 'PBS'
 
 plugin_args = {'qsub_args': '-q many'}
 
+struct_norm_plugin_args = {'qsub_args': '-q many -l nodes=1:ppn=1,mem=4gb',
+                           'overwrite': True}
+
 test_mode = True
 
 """
@@ -245,10 +276,24 @@ Normalization
 
 norm_template : location of template to normalize to
 
+composite_warp : True to compose the warp, affine and functional \
+                 registration once per subject into a single displacement \
+                 field and resample every run with it (in a thread pool) \
+                 instead of running WarpTimeSeriesImageMultiTransform per \
+                 run. Off until its output has been compared with \
+                 WarpTimeSeriesImageMultiTransform on real data.
+
+composite_workers : resampling threads per run when composite_warp is \
+                    True. Keep it within the ppn requested in plugin_args.
+
 """
 
 norm_template = '/software/fsl/fsl-4.1.6/data/standard/MNI152_T1_1mm_brain.nii.gz'
 
+composite_warp = False
+
+composite_workers = 1
+
 """
 Functions
 ---------
@@ -41,6 +41,18 @@ field_dir : (Optional) Base directory of field-map data (Should be subject-indep
 surf_dir : Freesurfer subjects directory
 
 crash_dir : Location to store crash files
+
+profile_dir : (Optional) Location of the per-node resource profiles (wall \
+              time, CPU time, peak memory, I/O) written by \
+              utils/nodeprofile.py. Must be reachable from the grid nodes. \
+              Set this value to None to disable profiling.
+
+resource_plan : Boolean or 'dry_run'
+                True to size the PBS request (ppn, mem, walltime) of every \
+                node from its profiles in profile_dir and run tiny utility \
+                nodes without submitting them (utils/pbsplan.py). Nodes \
+                without profiles keep plugin_args. 'dry_run' prints the \
+                plan and exits.
 """
 
 working_dir = '/mindhive/scratch/keshavan/sad/task'
@@ -55,6 +67,10 @@ surf_dir = '/mindhive/xnat/surfaces/sad/'
 
 crash_dir = working_dir
 
+profile_dir = None
+
+resource_plan = False
+
 """
 Workflow Inputs:
 ----------------
@@ -223,6 +239,50 @@ overlaythresh : 2-Tuple of Floats
                 up if for their value x the following is true: \
                 overlaythresh[0] < x < overlaythresh[1] or \
                 -1*overlaythresh[0] > x > -1*overlaythresh[0]
+
+is_block_design : Boolean
+                  True if the task is a block design
+
+qa_dpi : Int
+         resolution (dpi) of the QA report slice images. Lower values \
+         give quick previews.
+
+report_dpi : Int
+             resolution (dpi) of the first level report cluster slice \
+             images.
+
+report_format : String
+                'pdf' or 'html'. HTML QA reports reference the images \
+                instead of embedding them and are much faster to write.
+
+metrics_db : String
+             SQLite file that collects the structured QA metrics of every \
+             subject (outliers, composite norm, registration cost, ROI \
+             TSNR) for cohort queries with utils/reportsink/metricsdb.py. \
+             None to disable.
+
+metrics_db_wal : Boolean
+                 True to open metrics_db in SQLite WAL mode. Only on file \
+                 systems with shared memory support: WAL does not work \
+                 over NFS.
+
+surface_workers : Int
+                  number of mri_vol2surf projections run at once by the \
+                  first level report
+
+stacked_glm : Boolean
+              True to fit block designs cohort-wide by ordinary least \
+              squares instead of one FILMGLS job per run: runs with \
+              identical task regressors share the projection of their \
+              stacked voxels, the motion, noise and outlier regressors \
+              are fit per run. There is no FILM prewhitening in this \
+              mode, so temporal autocorrelation is not modeled and the \
+              t and z statistics are inflated compared to FILMGLS. Only \
+              used if is_block_design is True.
+
+stacked_chunk_size : Int
+                     maximum number of voxels fit at once in stacked \
+                     mode, larger runs are split
 """
 
 interscan_interval = 2
@@ -231,8 +291,24 @@ film_threshold = 1000
 
 overlaythresh = (3.09, 10.00)
 
+qa_dpi = 100
+
+report_dpi = 600
+
+surface_workers = 4
+
+report_format = 'pdf'
+
+metrics_db = None
+
+metrics_db_wal = False
+
 is_block_design = True
 
+stacked_glm = False
+
+stacked_chunk_size = 200000
+
 """
 Functions
 ---------
@@ -11,14 +11,18 @@ from nipype.interfaces.base import Bunch
 from textmake import *
 import sys
 sys.path.insert(0,'..')
-from base import create_first
-from utils import pickfirst
+from base import create_first, create_design
+from utils import pickfirst, SubstitutionDataSink
+from sinkmanifest import ManifestDataGrabber
+from stackedglm import stacked_glm
+from imagemeta import set_cache_dir
+from pbsplan import run_workflow
 from preproc import prep_workflow
 import argparse
 
 def preproc_datagrabber(name='preproc_datagrabber'):
     # create a node to obtain the preproc files
-    datasource = pe.Node(interface=nio.DataGrabber(infields=['subject_id','fwhm'],
+    datasource = pe.Node(interface=ManifestDataGrabber(infields=['subject_id','fwhm'],
                                                    outfields=['noise_components',
                                                               'motion_parameters',
                                                                'highpassed_files',
@@ -81,7 +85,7 @@ def noise_mot(subinfo,files,num_noise_components):
 
 # First level modeling
 
-def combine_wkflw(c, name='work_dir'):
+def combine_wkflw(c, name='work_dir', design_only=False):
     
     modelflow = pe.Workflow(name=name)
     modelflow.base_dir = os.path.join(c.working_dir)
@@ -167,9 +171,12 @@ def combine_wkflw(c, name='work_dir'):
                          name='noise_motn')
     
     # generate first level analysis workflow
-    modelfit =                                          create_first()
+    if design_only:
+        modelfit =                                      create_design()
+    else:
+        modelfit =                                      create_first()
+        modelfit.inputs.inputspec.film_threshold =      c.film_threshold
     modelfit.inputs.inputspec.interscan_interval =      c.interscan_interval
-    modelfit.inputs.inputspec.film_threshold =          c.film_threshold
     
     
     contrasts = pe.Node(util.Function(input_names=['subject_id'], output_names=['contrasts'], function=c.getcontrasts), name='getcontrasts')
@@ -183,7 +190,7 @@ def combine_wkflw(c, name='work_dir'):
     noise_motn.inputs.num_noise_components =           c.num_noise_components
     
     # make a data sink
-    sinkd = pe.Node(nio.DataSink(), name='sinkd')
+    sinkd = pe.Node(SubstitutionDataSink(), name='sinkd')
     sinkd.inputs.base_directory = os.path.join(c.sink_dir,'analyses','func')
         
     modelflow.connect(infosource, 'subject_id', sinkd, 'container')
@@ -198,21 +205,106 @@ def combine_wkflw(c, name='work_dir'):
     modelflow.connect(preproc, 'motion_parameters',      trad_motn,  'files')
     modelflow.connect(preproc, 'noise_components',       noise_motn, 'files')
     modelflow.connect(preproc, 'highpassed_files',       s,          'functional_runs')
-    modelflow.connect(preproc, 'highpassed_files',       modelfit,   'inputspec.functional_data')
     modelflow.connect(preproc, 'outlier_files',          s,          'outlier_files')
     modelflow.connect(trad_motn,'subinfo',                          noise_motn, 'subinfo')
     modelflow.connect(noise_motn,'subinfo',                         s,          'subject_info')
     modelflow.connect(s,'session_info',                             modelfit,   'inputspec.session_info')
-    modelflow.connect(modelfit, 'outputspec.parameter_estimates',   sinkd,      'modelfit.estimates')
-    modelflow.connect(modelfit, 'outputspec.dof_file',              sinkd,      'modelfit.dofs')
-    modelflow.connect(modelfit, 'outputspec.copes',                 sinkd,      'modelfit.contrasts.@copes')
-    modelflow.connect(modelfit, 'outputspec.varcopes',              sinkd,      'modelfit.contrasts.@varcopes')
-    modelflow.connect(modelfit, 'outputspec.zstats',                sinkd,      'modelfit.contrasts.@zstats')
-    modelflow.connect(modelfit, 'outputspec.tstats',                sinkd,      'modelfit.contrasts.@tstats')
+    if not design_only:
+        modelflow.connect(preproc, 'highpassed_files',              modelfit,   'inputspec.functional_data')
+        modelflow.connect(modelfit, 'outputspec.parameter_estimates',   sinkd,  'modelfit.estimates')
+        modelflow.connect(modelfit, 'outputspec.dof_file',          sinkd,      'modelfit.dofs')
+        modelflow.connect(modelfit, 'outputspec.copes',             sinkd,      'modelfit.contrasts.@copes')
+        modelflow.connect(modelfit, 'outputspec.varcopes',          sinkd,      'modelfit.contrasts.@varcopes')
+        modelflow.connect(modelfit, 'outputspec.zstats',            sinkd,      'modelfit.contrasts.@zstats')
+        modelflow.connect(modelfit, 'outputspec.tstats',            sinkd,      'modelfit.contrasts.@tstats')
     modelflow.connect(modelfit, 'outputspec.design_image',          sinkd,      'modelfit.design')
     modelflow.connect(modelfit, 'outputspec.design_cov',            sinkd,      'modelfit.design.@cov')
     modelflow.connect(modelfit, 'outputspec.design_file',           sinkd,      'modelfit.design.@matrix')
+    modelflow.connect(modelfit, 'outputspec.con_file',              sinkd,      'modelfit.design.@con')
     return modelflow
+
+
+# Cohort-wide first level modeling for block designs
+
+def stacked_wkflw(c, name='stacked_dir'):
+    """Cohort-wide first level workflow for block designs
+
+    Fits every subject in c.subjects with stacked_glm, using the designs
+    written by combine_wkflw(c, design_only=True). The fit is ordinary
+    least squares: unlike FILMGLS in combine_wkflw there is no
+    prewhitening of the temporal autocorrelation. The results are sunk in
+    the layout and names of combine_wkflw (modelfit/estimates, dofs and
+    contrasts/fwhm_<fwhm>/_estimate_contrast<k>/), so fixedfx.py and
+    report_first_level.py read them unchanged.
+
+    Parameters
+    ----------
+    c : config module
+    name : name of workflow. Default = 'stacked_dir'
+
+    Returns
+    -------
+    workflow : stacked first-level workflow
+    """
+    stackflow = pe.Workflow(name=name)
+    stackflow.base_dir = os.path.join(c.working_dir)
+
+    datasource = pe.Node(interface=ManifestDataGrabber(infields=['subject_id','fwhm'],
+                                                   outfields=['design_file',
+                                                              'con_file',
+                                                              'highpassed_files']),
+                         name = 'stacked_datagrabber')
+    datasource.inputs.base_directory = os.path.join(c.sink_dir,'analyses','func')
+    datasource.inputs.template ='*'
+    datasource.inputs.field_template = dict(design_file='%s/modelfit/design/fwhm_%d/*/run*.mat',
+                                            con_file='%s/modelfit/design/fwhm_%d/*/run*.con',
+                                            highpassed_files='%s/preproc/highpass/fwhm_%d/*/*.nii.gz')
+    datasource.inputs.template_args = dict(design_file=[['subject_id','fwhm']],
+                                           con_file=[['subject_id','fwhm']],
+                                           highpassed_files=[['subject_id','fwhm']])
+    datasource.inputs.subject_id = c.subjects
+    datasource.iterables = ('fwhm', c.fwhm)
+
+    fit = pe.Node(util.Function(input_names=['subjects',
+                                             'design_files',
+                                             'con_files',
+                                             'in_files',
+                                             'threshold',
+                                             'task_regressors',
+                                             'chunk_size',
+                                             'conditions'],
+                                output_names=['out_files', 'groups'],
+                                function=stacked_glm),
+                  name='stacked_fit')
+    fit.inputs.subjects = c.subjects
+    fit.inputs.threshold = c.film_threshold
+    # the condition regressors come first in the design, followed by the
+    # motion, noise and outlier regressors of the run
+    fit.inputs.task_regressors = [[len(info.conditions)
+                                   for info in c.subjectinfo(subject)]
+                                  for subject in c.subjects]
+    fit.inputs.chunk_size = c.stacked_chunk_size
+    # named like the first level sink (getsubs)
+    fit.inputs.conditions = [c.subjectinfo(subject)[0].conditions
+                             for subject in c.subjects]
+
+    sinkd = pe.Node(SubstitutionDataSink(), name='sinkd')
+    sinkd.inputs.base_directory = os.path.join(c.sink_dir,'analyses','func')
+    # the layout of combine_wkflw's sink: the first matching pattern wins
+    run_dir = 'modelfit/stacked/_fwhm_([0-9]+)/_subject_([^/]*)/_run([0-9]+)/'
+    sinkd.inputs.regexp_substitutions = [
+        (run_dir + 'dof$', r'\2/modelfit/dofs/fwhm_\1/_estimate_model\3/dof'),
+        (run_dir + '((?:var)?cope|tstat|zstat)',
+         r'\2/modelfit/contrasts/fwhm_\1/_estimate_contrast\3/\4'),
+        (run_dir + r'(pe[0-9]+\.nii)',
+         r'\2/modelfit/estimates/fwhm_\1/_estimate_model\3/others/\4'),
+        (run_dir, r'\2/modelfit/estimates/fwhm_\1/_estimate_model\3/')]
+
+    stackflow.connect(datasource, 'design_file',        fit,    'design_files')
+    stackflow.connect(datasource, 'con_file',           fit,    'con_files')
+    stackflow.connect(datasource, 'highpassed_files',   fit,    'in_files')
+    stackflow.connect(fit, 'out_files',                 sinkd,  'modelfit.stacked')
+    return stackflow
     
 if __name__ == "__main__":
     
@@ -227,10 +319,13 @@ if __name__ == "__main__":
     path, fname = os.path.split(os.path.realpath(args.config))
     sys.path.append(path)
     c = __import__(fname.split('.')[0])
+    set_cache_dir(c.working_dir)
     
-    first_level = combine_wkflw(c)
-    #first_level.write_graph()
-    if run_on_grid:
-        first_level.run(plugin='PBS', plugin_args = c.plugin_args)
+    if c.is_block_design and getattr(c, 'stacked_glm', False):
+        workflows = [combine_wkflw(c, name='stacked_design', design_only=True),
+                     stacked_wkflw(c)]
     else:
-        first_level.run()
+        workflows = [combine_wkflw(c)]
+    for first_level in workflows:
+        #first_level.write_graph()
+        run_workflow(first_level, c, plugin='PBS')
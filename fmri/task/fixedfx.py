@@ -14,6 +14,8 @@ directory containing tutorial data
 import argparse
 import os                                    # system functions
 import sys
+sys.path.insert(0,'../../utils')
+from pbsplan import run_workflow
 #from nipype.utils.config import config
 #config.enable_debug_mode()
 
@@ -27,6 +29,7 @@ import nipype.interfaces.io as nio           # i/o routines
 import nipype.interfaces.fsl as fsl          # fsl
 import nipype.interfaces.utility as util     # utility
 import nipype.pipeline.engine as pe          # pypeline engine
+from sinkmanifest import ManifestDataGrabber, ManifestDataSink
 import argparse
 fsl.FSLCommand.set_default_output_type('NIFTI_GZ')
 
@@ -73,7 +76,7 @@ def create_overlay_workflow(name='overlay'):
                                                                  'stat_image']),
                         name='inputspec')
     
-    datasource = pe.Node(interface=nio.DataGrabber(infields=['subject_id'],
+    datasource = pe.Node(interface=ManifestDataGrabber(infields=['subject_id'],
                                                    outfields=['meanfunc']),
                          name='datasource')
     
@@ -142,7 +145,7 @@ def create_fixedfx(name='fixedfx'):
     infosource.iterables = [('subject_id', c.subjects),
                             ('fwhm',c.fwhm)]
 
-    datasource = pe.Node(interface=nio.DataGrabber(infields=['subject_id','fwhm'],
+    datasource = pe.Node(interface=ManifestDataGrabber(infields=['subject_id','fwhm'],
                                                    outfields=['copes', 
                                                               'varcopes',
                                                               'dof_files',
@@ -184,7 +187,7 @@ def create_fixedfx(name='fixedfx'):
 
 
 
-    datasink = pe.Node(interface=nio.DataSink(), name="datasink")
+    datasink = pe.Node(interface=ManifestDataSink(), name="datasink")
     datasink.inputs.base_directory = os.path.join(c.sink_dir,'analyses','func')
     # store relevant outputs from various stages of the 1st level analysis
     fixedfxflow.connect([(infosource, datasink,[('subject_id','container'),
@@ -226,10 +229,7 @@ if __name__ == '__main__' or auto_fixedfx:
     fixedfxflow = create_fixedfx()
     fixedfxflow.base_dir = c.working_dir
     
-    if c.run_on_grid:
-        fixedfxflow.run(plugin=c.plugin, plugin_args=c.plugin_args)
-    else:
-        fixedfxflow.run()
+    run_workflow(fixedfxflow, c)
     #fixedfxflow.write_graph(graph2use='flat')
 
 
@@ -21,6 +21,8 @@ from nipype.interfaces.base import Bunch
 from copy import deepcopy
 from time import ctime
 from utils import pickfirst, tolist
+from imagemeta import set_cache_dir
+from pbsplan import run_workflow
 import argparse
 
 # Preprocessing
@@ -135,6 +137,7 @@ if __name__ == "__main__":
     path, fname = os.path.split(os.path.realpath(args.config))
     sys.path.append(path)
     c = __import__(fname.split('.')[0])
+    set_cache_dir(c.working_dir)
 
     preprocess = prep_workflow(c.subjects, c.use_fieldmap)
     realign = preprocess.get_node('preproc.realign')
@@ -143,8 +146,5 @@ if __name__ == "__main__":
     realign.inputs.speedup = 15
     cc = preprocess.get_node('preproc.CompCor')
     cc.plugin_args = {'qsub_args': '-l nodes=1:ppn=3'}
-    if c.run_on_grid:
-        preprocess.run(plugin=c.plugin,plugin_args = c.plugin_args)
-    else:
-        preprocess.run()
+    run_workflow(preprocess, c)
     
@@ -1,12 +1,15 @@
 # Utility Functions ---------------------------------------------------------
 import os
+import sys
 import nipype.pipeline.engine as pe
-import nipype.interfaces.io as nio          # input/output
 import nipype.interfaces.freesurfer as fs
 import nipype.interfaces.utility as util
 from nipype.algorithms.misc import TSNR
 import nipype.interfaces.fsl as fsl
 import nipype.algorithms.rapidart as ra     # rapid artifact detection
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             '..', 'utils'))
+from sinkmanifest import ManifestDataSink
 
 def pickfirst(files):
     """Return first file from a list of files
@@ -58,12 +61,16 @@ def pickvol(filenames, fileidx, which):
     idx: index of first or middle volume
     """
 
-    from nibabel import load
     import numpy as np
+    try:
+        from imagemeta import get_shape
+    except ImportError:
+        from nibabel import load
+        get_shape = lambda filename: load(filename).get_shape()
     if which.lower() == 'first':
         idx = 0
     elif which.lower() == 'middle':
-        idx = int(np.ceil(load(filenames[fileidx]).get_shape()[3] / 2))
+        idx = int(np.ceil(get_shape(filenames[fileidx])[3] / 2))
     else:
         raise Exception('unknown value for volume selection : %s' % which)
     return idx
@@ -353,8 +360,185 @@ def get_regexp_substitutions(subject_id, use_fieldmap):
     return subs
 
 
+def _trie_pattern(keys):
+    """Build a regular expression matching any key, factored as a trie
+
+    Optional groups are greedy, so the longest key at a position wins.
+    """
+    import re
+    trie = {}
+    for key in keys:
+        node = trie
+        for char in key:
+            node = node.setdefault(char, {})
+        node[''] = True
+
+    def build(node):
+        alts = [re.escape(char) + build(child)
+                for char, child in sorted(node.items()) if char != '']
+        if not alts:
+            return ''
+        if len(alts) == 1:
+            body = alts[0]
+        else:
+            body = '(?:%s)' % '|'.join(alts)
+        if '' in node:
+            return '(?:%s)?' % body
+        return body
+
+    return build(trie)
+
+
+class SubstitutionEngine(object):
+    """Applies DataSink substitutions with precompiled matchers
+
+    Gives the same result as applying the ``(old, new)`` pairs one after
+    the other with ``str.replace`` followed by the regexp pairs with
+    ``re.subn``, which is what DataSink does. The literal pairs are
+    compiled into one alternation (longest key first) that finds every key
+    present in a path in a single scan, so only pairs that actually match
+    are replaced instead of trying hundreds of pairs per path. The
+    alternation is factored as a trie so each position is checked once.
+
+    Parameters
+    ----------
+    substitutions : list of (old, new) string pairs
+    regexp_substitutions : list of (pattern, replacement) pairs
+    """
+
+    def __init__(self, substitutions=None, regexp_substitutions=None):
+        import re
+        self.substitutions = [tuple(s) for s in (substitutions or [])]
+        self.regexp_substitutions = [(re.compile(key), val) for key, val
+                                     in (regexp_substitutions or [])]
+        keys = [key for key, _ in self.substitutions]
+        # empty keys match everywhere; keep the plain sequential loop
+        self._sequential = not keys or '' in keys
+        if self._sequential:
+            return
+        self._indices = {}
+        for i, key in enumerate(keys):
+            self._indices.setdefault(key, []).append(i)
+        unique = sorted(self._indices.keys(), key=len, reverse=True)
+        # every key matching at a position is a prefix of the longest one
+        self._prefixes = {}
+        for key in unique:
+            found = []
+            for other in unique:
+                if key.startswith(other):
+                    found.extend(self._indices[other])
+            self._prefixes[key] = sorted(found)
+        # keys overlapping other keys need an overlapping (lookahead) scan;
+        # a key found once is present, so overlapping itself does not matter
+        starts = {}
+        for key in unique:
+            for n in range(1, len(key) + 1):
+                starts.setdefault(key[:n], set()).add(key)
+        overlapping = [key for key in unique
+                       if [n for n in range(1, len(key))
+                           if starts.get(key[n:], set()) - set([key])] or
+                       [k for k in unique if k in key[1:] and k != key]]
+        if overlapping:
+            self._matcher = re.compile('(?=(%s))' % _trie_pattern(unique))
+        else:
+            self._matcher = re.compile(_trie_pattern(unique))
+        # a path only needs rescanning after a replacement whose new text
+        # could form one of the later keys
+        self._rescan = [False] * len(keys)
+        later = []
+        prefixes = set()
+        suffixes = set()
+        for i in range(len(keys) - 1, -1, -1):
+            val = self.substitutions[i][1]
+            self._rescan[i] = bool(later) and (
+                not val or
+                [k for k in later if k in val or val in k] != [] or
+                [n for n in range(1, len(val)) if val[-n:] in prefixes or
+                 val[:n] in suffixes] != [])
+            key = keys[i]
+            later.append(key)
+            prefixes.update([key[:n] for n in range(1, len(key))])
+            suffixes.update([key[-n:] for n in range(1, len(key))])
+
+    def _candidates(self, pathstr, start):
+        """Sorted indices, from start on, of pairs whose key is present"""
+        found = set()
+        for key in set(self._matcher.findall(pathstr)):
+            found.update([i for i in self._prefixes[key] if i >= start])
+        return sorted(found)
+
+    def substitute(self, pathstr):
+        if self._sequential:
+            for key, val in self.substitutions:
+                pathstr = pathstr.replace(key, val)
+        else:
+            candidates = self._candidates(pathstr, 0)
+            k = 0
+            while k < len(candidates):
+                i = candidates[k]
+                k += 1
+                key, val = self.substitutions[i]
+                newpathstr = pathstr.replace(key, val)
+                if newpathstr == pathstr:
+                    continue
+                pathstr = newpathstr
+                if self._rescan[i]:
+                    candidates = self._candidates(pathstr, i + 1)
+                    k = 0
+        for regexp, val in self.regexp_substitutions:
+            pathstr, _ = regexp.subn(val, pathstr)
+        return pathstr
+
+
+_substitution_engines = {}
+
+
+def get_substitution_engine(substitutions, regexp_substitutions=None):
+    """Return a cached SubstitutionEngine for a set of substitutions
+
+    Engines are keyed on a hash of the substitution lists, so each subject
+    and configuration compiles its matcher once per process.
+    """
+    import hashlib
+    key = hashlib.md5(repr(([tuple(s) for s in (substitutions or [])],
+                            [tuple(s) for s in (regexp_substitutions or [])]))
+                      .encode('utf-8')).hexdigest()
+    if key not in _substitution_engines:
+        _substitution_engines[key] = SubstitutionEngine(substitutions,
+                                                        regexp_substitutions)
+    return _substitution_engines[key]
+
+
+class SubstitutionDataSink(ManifestDataSink):
+    """DataSink that applies its substitutions through a SubstitutionEngine
+
+    Output paths are identical to those of DataSink. Written files are
+    recorded in the sink manifest (see ManifestDataSink).
+    """
+
+    def _list_outputs(self):
+        from nipype.interfaces.base import isdefined
+        substitutions = None
+        regexp_substitutions = None
+        if isdefined(self.inputs.substitutions):
+            substitutions = self.inputs.substitutions
+        if isdefined(self.inputs.regexp_substitutions):
+            regexp_substitutions = self.inputs.regexp_substitutions
+        self._engine = get_substitution_engine(substitutions,
+                                               regexp_substitutions)
+        try:
+            return super(SubstitutionDataSink, self)._list_outputs()
+        finally:
+            self._engine = None
+
+    def _substitute(self, pathstr):
+        if getattr(self, '_engine', None) is None:
+            return super(SubstitutionDataSink, self)._substitute(pathstr)
+        return self._record(self._engine.substitute(pathstr))
+
+
 def get_datasink(root_dir, fwhm):
-    sinkd = pe.Node(nio.DataSink(), name='sinkd')
+    sinkd = pe.Node(SubstitutionDataSink(), name='sinkd')
     sinkd.inputs.base_directory = os.path.join(root_dir, 'analyses', 'func')
     return sinkd
 
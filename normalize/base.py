@@ -2,7 +2,8 @@ import nipype.interfaces.freesurfer as fs
 import nipype.interfaces.ants as ants
 import nipype.pipeline.engine as pe
 import nipype.interfaces.utility as util
-from utils import (convert_affine, get_image_dimensions)
+from utils import (convert_affine, get_image_dimensions, compose_transforms,
+                   apply_composite, cached_struct_norm)
 
 
 def get_struct_norm_workflow(name='normalize_struct'):
@@ -92,12 +93,18 @@ def get_struct_norm_workflow(name='normalize_struct'):
     return normalize_struct
 
 
-def get_post_struct_norm_workflow(name='normalize_post_struct'):
+def get_post_struct_norm_workflow(name='normalize_post_struct',
+                                  composite=False, workers=1):
     """ Base post-structural workflow for normalization
 
     Parameters
     ----------
     name : name of workflow. Default = 'normalize_post_struct'
+    composite : True to compose the transforms once into a displacement
+                field and resample the moving images natively instead of
+                with WarpTimeSeriesImageMultiTransform. Default = False
+    workers : resampling threads per moving image in composite mode. Keep
+              it within the processors requested for the node. Default = 1
 
     Inputs
     ------
@@ -139,10 +146,26 @@ def get_post_struct_norm_workflow(name='normalize_post_struct'):
         name='collect_transforms')
 
     #performs series of transformations on moving images
-    warp_images = pe.MapNode(
-        ants.WarpTimeSeriesImageMultiTransform(),
-        name='warp_images',
-        iterfield=['moving_image', 'dimension'])
+    if composite:
+        compose = pe.Node(
+            util.Function(
+                input_names=['template_file', 'transforms'],
+                output_names=['composite_warp'],
+                function=compose_transforms),
+            name='compose_transforms')
+        warp_images = pe.MapNode(
+            util.Function(
+                input_names=['moving_image', 'composite_warp', 'workers'],
+                output_names=['output_image'],
+                function=apply_composite),
+            name='warp_images',
+            iterfield=['moving_image'])
+        warp_images.inputs.workers = workers
+    else:
+        warp_images = pe.MapNode(
+            ants.WarpTimeSeriesImageMultiTransform(),
+            name='warp_images',
+            iterfield=['moving_image', 'dimension'])
 
     #collects workflow outputs
     outputspec = pe.Node(
@@ -160,25 +183,44 @@ def get_post_struct_norm_workflow(name='normalize_post_struct'):
         (inputspec, collect_transforms, [('warp_field', 'in1'),
             ('affine_transformation', 'in2')]),
         (inputspec, warp_images, [('moving_image', 'moving_image')]),
-        (inputspec, warp_images, [(('moving_image', get_image_dimensions),
-                                    'dimension')]),
-        (inputspec, warp_images, [('template_file', 'reference_image')]),
-        (collect_transforms, warp_images, [('out',
-                                    'transformation_series')]),
         (warp_images, outputspec, [('output_image', 'warped_image')])])
 
+    if composite:
+        normalize_post_struct.connect([
+            (inputspec, compose, [('template_file', 'template_file')]),
+            (collect_transforms, compose, [('out', 'transforms')]),
+            (compose, warp_images, [('composite_warp', 'composite_warp')])])
+    else:
+        normalize_post_struct.connect([
+            (inputspec, warp_images, [(('moving_image',
+                                        get_image_dimensions),
+                                       'dimension')]),
+            (inputspec, warp_images, [('template_file', 'reference_image')]),
+            (collect_transforms, warp_images, [('out',
+                                        'transformation_series')])])
+
     return normalize_post_struct
 
 
-def get_full_norm_workflow(name="normalize_struct_and_post"):
+def get_full_norm_workflow(name="normalize_struct_and_post", composite=False,
+                           cache_dir=None, workers=1, struct_plugin_args=None):
     """ Combined tructural and post-structural workflow for normalization
 
     Parameters
     ----------
     name : name of workflow. Default = 'normalize_struct_and_post'
+    composite : see get_post_struct_norm_workflow. Default = False
+    workers : see get_post_struct_norm_workflow. Default = 1
+    cache_dir : directory of the structural normalization cache (see
+                cached_struct_norm). inputspec.subject_id must be set when
+                it is used. Default = None (no cache)
+    struct_plugin_args : plugin_args of the cached structural normalization
+                         node, which runs ANTS in its own job when the cache
+                         misses. Default = None (the workflow's plugin_args)
 
     Inputs
     ------
+    inputspec.subject_id :
     inputspec.template_file :
     inputspec.brain :
     inputspec.segmentation :
@@ -199,13 +241,31 @@ def get_full_norm_workflow(name="normalize_struct_and_post"):
     -------
     workflow : combined structural and post-structural normalization workflow
     """
-    normalize_struct = get_struct_norm_workflow()
-    normalize_post_struct = get_post_struct_norm_workflow()
+    if cache_dir is None:
+        normalize_struct = get_struct_norm_workflow()
+        struct_in = lambda field: 'inputspec.' + field
+        struct_out = lambda field: 'outputspec.' + field
+    else:
+        normalize_struct = pe.Node(
+            util.Function(
+                input_names=['subject_id', 'brain', 'segmentation',
+                             'template_file', 'cache_dir'],
+                output_names=['warp_field', 'affine_transformation',
+                              'inverse_warp', 'unwarped_brain',
+                              'warped_brain'],
+                function=cached_struct_norm),
+            name='normalize_struct')
+        normalize_struct.inputs.cache_dir = cache_dir
+        if struct_plugin_args:
+            normalize_struct.plugin_args = struct_plugin_args
+        struct_in = struct_out = lambda field: field
+    normalize_post_struct = get_post_struct_norm_workflow(composite=composite,
+                                                          workers=workers)
 
     inputspec = pe.Node(
         util.IdentityInterface(
-            fields=['template_file', 'brain', 'segmentation', 'out_fsl_file',
-                'moving_image', 'mean_func']),
+            fields=['subject_id', 'template_file', 'brain', 'segmentation',
+                'out_fsl_file', 'moving_image', 'mean_func']),
         name='inputspec')
 
     outputspec = pe.Node(
@@ -217,19 +277,19 @@ def get_full_norm_workflow(name="normalize_struct_and_post"):
     combined_workflow = pe.Workflow(name=name)
     combined_workflow.connect([
         (inputspec, normalize_struct, [('template_file',
-                                        'inputspec.template_file')]),
-        (inputspec, normalize_struct, [('brain', 'inputspec.brain')]),
+                                        struct_in('template_file'))]),
+        (inputspec, normalize_struct, [('brain', struct_in('brain'))]),
         (inputspec, normalize_struct, [('segmentation',
-                                        'inputspec.segmentation')]),
+                                        struct_in('segmentation'))]),
         (inputspec, normalize_post_struct, [('template_file',
                                         'inputspec.template_file')]),
-        (normalize_struct, normalize_post_struct, [('outputspec.warp_field',
+        (normalize_struct, normalize_post_struct, [(struct_out('warp_field'),
                                         'inputspec.warp_field')]),
         (normalize_struct, normalize_post_struct, [(
-                                        'outputspec.affine_transformation',
+                                        struct_out('affine_transformation'),
                                         'inputspec.affine_transformation')]),
         (normalize_struct, normalize_post_struct, [(
-                                        'outputspec.unwarped_brain',
+                                        struct_out('unwarped_brain'),
                                         'inputspec.unwarped_brain')]),
         (inputspec, normalize_post_struct, [('out_fsl_file',
                                         'inputspec.out_fsl_file')]),
@@ -237,17 +297,21 @@ def get_full_norm_workflow(name="normalize_struct_and_post"):
                                         'inputspec.moving_image')]),
         (inputspec, normalize_post_struct, [('mean_func',
                                         'inputspec.mean_func')]),
-        (normalize_struct, outputspec, [('outputspec.warp_field',
+        (normalize_struct, outputspec, [(struct_out('warp_field'),
                                         'warp_field')]),
-        (normalize_struct, outputspec, [('outputspec.affine_transformation',
+        (normalize_struct, outputspec, [(struct_out('affine_transformation'),
                                         'affine_transformation')]),
-        (normalize_struct, outputspec, [('outputspec.inverse_warp',
+        (normalize_struct, outputspec, [(struct_out('inverse_warp'),
                                         'inverse_warp')]),
-        (normalize_struct, outputspec, [('outputspec.unwarped_brain',
+        (normalize_struct, outputspec, [(struct_out('unwarped_brain'),
                                         'unwarped_brain')]),
-        (normalize_struct, outputspec, [('outputspec.warped_brain',
+        (normalize_struct, outputspec, [(struct_out('warped_brain'),
                                         'warped_brain')]),
         (normalize_post_struct, outputspec, [('outputspec.warped_image',
                                         'warped_image')])])
 
+    if cache_dir is not None:
+        combined_workflow.connect(inputspec, 'subject_id',
+                                  normalize_struct, 'subject_id')
+
     return combined_workflow
@@ -1,3 +1,8 @@
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             '..', 'utils'))
+
 # Utility Functions ---------------------------------------------------------
 
 
@@ -15,10 +20,105 @@ def convert_affine(unwarped_brain, mean_func, out_fsl_file):
     file : returns the filename corresponding to the converted registration
     """
     import os
-    cmd = "c3d_affine_tool -ref %s -src %s %s -fsl2ras \
--oitk fsl2antsAffine.txt" % (unwarped_brain, mean_func, out_fsl_file)
-    os.system(cmd)
-    return os.path.abspath('fsl2antsAffine.txt')
+    from fslaffine import fsl_to_itk
+    # same result as c3d_affine_tool -ref <unwarped_brain> -src <mean_func>
+    # <out_fsl_file> -fsl2ras -oitk, computed from the image headers
+    return fsl_to_itk(unwarped_brain, mean_func, out_fsl_file,
+                      os.path.abspath('fsl2antsAffine.txt'))
+
+
+def cached_struct_norm(subject_id, brain, segmentation, template_file,
+                       cache_dir):
+    """Structural normalization, computed once per subject and template
+
+    Runs the structural normalization workflow (get_struct_norm_workflow)
+    unless its outputs are already cached in
+    <cache_dir>/<subject_id>/struct_norm/<key>, where the key hashes the
+    subject and the contents of brain, segmentation and template_file.
+    Jobs needing the same entry at the same time (e.g. one per fwhm) wait
+    for the first one instead of running ANTS again.
+
+    Parameters
+    ----------
+    subject_id : subject id
+    brain : freesurfer orig.mgz
+    segmentation : freesurfer aparc+aseg.mgz
+    template_file : template to normalize to
+    cache_dir : cache directory (base_norm_dir)
+
+    Returns
+    -------
+    warp_field, affine_transformation, inverse_warp, unwarped_brain,
+    warped_brain : files in the cache
+    """
+    import os
+    from structcache import (cache_key, cache_path, lookup, store, acquire,
+                             release, OUTPUTS)
+    path = cache_path(cache_dir, subject_id,
+                      cache_key(subject_id, brain, segmentation,
+                                template_file))
+    outputs = lookup(path)
+    if outputs is None:
+        lock = acquire(path)
+        try:
+            outputs = lookup(path)
+            if outputs is None:
+                from base import get_struct_norm_workflow
+                normalize_struct = get_struct_norm_workflow()
+                normalize_struct.base_dir = os.getcwd()
+                normalize_struct.inputs.inputspec.template_file = template_file
+                normalize_struct.inputs.inputspec.brain = brain
+                normalize_struct.inputs.inputspec.segmentation = segmentation
+                graph = normalize_struct.run()
+                for node in graph.nodes():
+                    if node.name == 'outputspec':
+                        outputs = store(path, node.result.outputs.get())
+        finally:
+            release(lock)
+    return tuple([outputs[name] for name in OUTPUTS])
+
+
+def compose_transforms(template_file, transforms):
+    """Composes an ANTS transform list into one displacement field
+
+    Parameters
+    ----------
+    template_file : reference (template) image
+    transforms : list of warp fields and itk affines, in
+                 WarpImageMultiTransform order
+
+    Returns
+    -------
+    file : displacement field on the template grid
+    """
+    import os
+    from compositewarp import compose_warp
+    return compose_warp(template_file, transforms,
+                        os.path.abspath('composite_warp.nii.gz'))
+
+
+def apply_composite(moving_image, composite_warp, workers=None):
+    """Resamples a 3D or 4D image through a composed displacement field
+
+    Parameters
+    ----------
+    moving_image : image to normalize
+    composite_warp : displacement field from compose_transforms
+    workers : number of resampling threads. Default = number of cpus
+
+    Returns
+    -------
+    file : normalized image, named like WarpTimeSeriesImageMultiTransform's
+    """
+    import os
+    from compositewarp import apply_composite_warp
+    base = os.path.split(moving_image)[1]
+    for ext in ['.nii.gz', '.nii']:
+        if base.endswith(ext):
+            base = base[:-len(ext)]
+    return apply_composite_warp(moving_image, composite_warp,
+                                os.path.abspath(base + '_wtsimt.nii.gz'),
+                                workers=workers)
 
 
 def get_image_dimensions(images):
@@ -32,12 +132,16 @@ def get_image_dimensions(images):
     -------
     list : returns dimensions of input image list
     """
-    import nibabel as nb
+    try:
+        from imagemeta import get_shape
+    except ImportError:
+        import nibabel as nb
+        get_shape = lambda image: nb.load(image).get_shape()
 
     if isinstance(images, list):
         dims = []
         for image in images:
-            dims.append(len(nb.load(image).get_shape()))
+            dims.append(len(get_shape(image)))
     else:
-        dims = len(nb.load(images).get_shape())
+        dims = len(get_shape(images))
     return dims
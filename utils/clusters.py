@@ -0,0 +1,149 @@
+import os
+import time
+import numpy as np
+from scipy import ndimage
+
+
+def label_clusters(data, thr, min_extent=0):
+    """Label suprathreshold clusters and drop the small ones
+
+    Cluster sizes come from one np.bincount over the label volume; clusters
+    smaller than min_extent are removed through a label lookup table, so
+    the volume is only traversed a constant number of times. Surviving
+    clusters keep their scipy.ndimage.label ids.
+
+    Parameters
+    ----------
+    data : 3D array
+    thr : clusters are formed from voxels with abs(data) > thr
+    min_extent : minimum cluster size in voxels. Default = 0
+
+    Returns
+    -------
+    labels : integer array of data's shape, 0 outside surviving clusters
+    """
+    labels, nlabels = ndimage.label(np.abs(data) > thr)
+    if nlabels == 0:
+        return labels
+    sizes = np.bincount(labels.ravel(), minlength=nlabels + 1)
+    lut = np.arange(nlabels + 1, dtype=labels.dtype)
+    lut[sizes < min_extent] = 0
+    lut[0] = 0
+    return lut[labels]
+
+
+def cluster_summary(labels, data=None):
+    """Sizes, voxel lists, peaks and means of every cluster in one pass
+
+    Parameters
+    ----------
+    labels : integer cluster volume (0 = background)
+    data : optional statistic volume for peaks and means
+
+    Returns
+    -------
+    dict : ids (sorted nonzero labels), sizes, voxels (list of 3 x n
+           voxel index arrays, C order within each cluster) and, if data is
+           given, peaks (voxel index of the largest abs(data)) and means
+    """
+    labels = np.asarray(labels)
+    flat = labels.ravel()
+    sizes = np.bincount(flat)
+    ids = np.nonzero(sizes)[0]
+    ids = ids[ids != 0]
+    # one stable sort groups the voxels of every cluster in C order
+    order = np.argsort(flat, kind='mergesort')
+    bounds = np.cumsum(sizes)
+    voxels = []
+    for idx in ids:
+        members = order[bounds[idx] - sizes[idx]:bounds[idx]]
+        voxels.append(np.asarray(np.unravel_index(members, labels.shape)))
+    result = dict(ids=ids, sizes=sizes[ids], voxels=voxels)
+    if data is not None:
+        data = np.asarray(data, dtype=np.float64)
+        if len(ids):
+            result['peaks'] = [np.asarray(p) for p in
+                               ndimage.maximum_position(np.abs(data), labels,
+                                                        ids)]
+            result['means'] = np.atleast_1d(ndimage.mean(data, labels, ids))
+        else:
+            result['peaks'] = []
+            result['means'] = np.array([])
+    return result
+
+
+_segmentations = {}
+MAX_SEGMENTATIONS = 4
+
+
+def get_segmentation(seg_file):
+    """Label volume and affine of a segmentation, cached per file
+
+    The most recently used MAX_SEGMENTATIONS volumes are kept in memory, so
+    every contrast of a subject shares one load of its aparc+aseg.mgz.
+    """
+    stat = os.stat(seg_file)
+    key = (os.path.abspath(seg_file), stat.st_mtime, stat.st_size)
+    if key not in _segmentations:
+        from nibabel import load
+        img = load(seg_file)
+        if len(_segmentations) >= MAX_SEGMENTATIONS:
+            oldest = min(_segmentations, key=lambda k: _segmentations[k][0])
+            del _segmentations[oldest]
+        _segmentations[key] = [0, np.asarray(img.get_data()).astype(np.int64),
+                               img.get_affine()]
+    entry = _segmentations[key]
+    entry[0] = time.time()
+    return entry[1], entry[2]
+
+
+def locate_clusters(voxels, affine, seg_file, lut=None):
+    """Anatomical labels covered by each cluster
+
+    The voxels of all clusters go through a single voxel to segmentation
+    affine, label ids are gathered with one fancy index and counted with
+    bincount; ids are named through the cached FreeSurfer color table.
+
+    Parameters
+    ----------
+    voxels : list of 3 x n voxel index arrays (see cluster_summary)
+    affine : voxel to world affine of the statistic image
+    seg_file : segmentation in the same world space (e.g. aparc+aseg.mgz)
+    lut : FreeSurferLUT or color table file. Default = labelstats.get_lut()
+
+    Returns
+    -------
+    list of (names, percents) per cluster, names sorted alphabetically and
+    percents the fraction of the cluster's voxels in each label
+    """
+    from labelstats import FreeSurferLUT, get_lut
+    if not isinstance(lut, FreeSurferLUT):
+        lut = get_lut(lut)
+    seg, seg_affine = get_segmentation(seg_file)
+    if not len(voxels):
+        return []
+    sizes = np.array([v.shape[1] for v in voxels])
+    ijk = np.hstack(voxels).astype(np.float64)
+    vox2seg = np.linalg.inv(seg_affine).dot(affine)
+    seg_ijk = (vox2seg[:3, :3].dot(ijk) + vox2seg[:3, 3:]).astype(np.int64)
+    inside = np.all((seg_ijk >= 0) &
+                    (seg_ijk < np.array(seg.shape[:3])[:, None]), axis=0)
+    ids = np.zeros(ijk.shape[1], dtype=np.int64)
+    ids[inside] = seg[seg_ijk[0, inside], seg_ijk[1, inside],
+                      seg_ijk[2, inside]]
+    # one bincount over (cluster, label) pairs tallies every cluster
+    unique_ids, index = np.unique(ids, return_inverse=True)
+    cluster = np.repeat(np.arange(len(voxels)), sizes)
+    counts = np.bincount(cluster * len(unique_ids) + index,
+                         minlength=len(voxels) * len(unique_ids))
+    counts = counts.reshape(len(voxels), len(unique_ids))
+    names = [lut.get(label, str(label)) for label in unique_ids]
+    charts = []
+    for i in range(len(voxels)):
+        tally = {}
+        for j in np.nonzero(counts[i])[0]:
+            tally[names[j]] = tally.get(names[j], 0) + counts[i, j]
+        locs = sorted(tally)
+        charts.append((np.array(locs), [tally[loc] / float(sizes[i])
+                                        for loc in locs]))
+    return charts
@@ -0,0 +1,229 @@
+import gzip
+import hashlib
+import os
+import shutil
+import numpy as np
+from scipy.ndimage import map_coordinates
+from imagemeta import CACHE_ENV
+from fslaffine import read_itk_affine
+from tsdiff import iter_volumes
+
+# RAS <-> LPS (ITK and ANTS transforms work in LPS physical space)
+_FLIP = np.array([-1., -1., 1.])[:, None]
+
+
+def _load(image):
+    import nibabel as nb
+    img = nb.load(image)
+    return img.get_data(), img.get_affine()
+
+
+def _is_image(filename):
+    return filename.endswith('.nii') or filename.endswith('.nii.gz')
+
+
+def grid_points(shape, affine):
+    """RAS world coordinates (3 x N, C order) of every voxel of a grid"""
+    ijk = np.indices(shape[:3]).reshape(3, -1).astype(np.float64)
+    affine = np.asarray(affine, dtype=np.float64)
+    return affine[:3, :3].dot(ijk) + affine[:3, 3:]
+
+
+def _world_to_voxel(points, affine):
+    inv = np.linalg.inv(np.asarray(affine, dtype=np.float64))
+    return inv[:3, :3].dot(points) + inv[:3, 3:]
+
+
+def _sample_field(data, affine, points_lps):
+    """Linearly interpolated displacements of an ITK field at LPS points"""
+    field = data.reshape(data.shape[:3] + (3,))
+    coords = _world_to_voxel(points_lps * _FLIP, affine)
+    return np.array([map_coordinates(np.asarray(field[..., i],
+                                                dtype=np.float64),
+                                     coords, order=1, mode='nearest')
+                     for i in range(3)])
+
+
+def apply_transforms(points_lps, transforms):
+    """Map LPS points through an ANTS transform list
+
+    Transforms are given in WarpImageMultiTransform order: each point of the
+    reference goes through the first transform, then the second, and so on,
+    ending in the moving image. Items are ITK affine text files or
+    displacement fields (.nii / .nii.gz).
+    """
+    points = np.asarray(points_lps, dtype=np.float64)
+    for transform in transforms:
+        if _is_image(transform):
+            data, affine = _load(transform)
+            points = points + _sample_field(data, affine, points)
+        else:
+            matrix, offset = read_itk_affine(transform)
+            points = matrix.dot(points) + offset[:, None]
+    return points
+
+
+def _cache_key(reference, transforms):
+    md5 = hashlib.md5()
+    for filename in [reference] + list(transforms):
+        stat = os.stat(filename)
+        if _is_image(filename):
+            md5.update(('%s:%s:%s' % (os.path.abspath(filename),
+                                      stat.st_mtime,
+                                      stat.st_size)).encode('utf-8'))
+        else:
+            md5.update(open(filename, 'rb').read())
+    return md5.hexdigest()
+
+
+def _cache_dir():
+    if os.environ.get(CACHE_ENV):
+        return os.path.join(os.environ[CACHE_ENV], 'composite_warps')
+    return None
+
+
+def compose_warp(reference, transforms, out_file, cache_dir=None):
+    """Compose an ANTS transform list into one displacement field
+
+    The field is defined on the grid of reference and stored the way ANTS
+    stores warps (LPS displacements, shape X x Y x Z x 1 x 3), so it can
+    replace the whole list in WarpImageMultiTransform. Composed fields are
+    cached (by reference and transforms) in cache_dir, which defaults to
+    <BIPS_IMAGEMETA_DIR>/composite_warps, so every run and fwhm of a
+    subject shares one composition.
+
+    Returns
+    -------
+    out_file
+    """
+    import nibabel as nb
+    if cache_dir is None:
+        cache_dir = _cache_dir()
+    cached = None
+    if cache_dir is not None:
+        cached = os.path.join(cache_dir, _cache_key(reference, transforms) +
+                              '.nii.gz')
+        if os.path.exists(cached):
+            shutil.copyfile(cached, out_file)
+            return out_file
+
+    ref = nb.load(reference)
+    shape = ref.get_shape()[:3]
+    affine = ref.get_affine()
+    points = grid_points(shape, affine) * _FLIP
+    moved = apply_transforms(points, transforms)
+    field = (moved - points).T.reshape(shape + (1, 3)).astype(np.float32)
+    img = nb.Nifti1Image(field, affine)
+    img.get_header().set_intent('vector', (), '')
+    img.to_filename(out_file)
+    if cached is not None:
+        try:
+            if not os.path.exists(cache_dir):
+                os.makedirs(cache_dir)
+            tmp_file = '%s.%d.nii.gz' % (cached[:-7], os.getpid())
+            shutil.copyfile(out_file, tmp_file)
+            os.rename(tmp_file, cached)
+        except (IOError, OSError):
+            pass
+    return out_file
+
+
+def warp_coordinates(field_file, moving_affine):
+    """Voxel coordinates in the moving image of every reference voxel
+
+    Returns
+    -------
+    coords (3 x N), reference shape and reference affine
+    """
+    data, affine = _load(field_file)
+    shape = data.shape[:3]
+    points = grid_points(shape, affine) * _FLIP
+    moved = points + np.asarray(data, dtype=np.float64).reshape(
+        -1, 3).T
+    coords = _world_to_voxel(moved * _FLIP, moving_affine)
+    return coords.astype(np.float32), shape, affine
+
+
+def _nifti_writer(out_file, shape, affine, zooms, frames):
+    import nibabel as nb
+    hdr = nb.Nifti1Header()
+    hdr.set_data_dtype(np.float32)
+    hdr.set_data_shape(tuple(shape) + ((frames,) if frames > 1 else ()))
+    hdr.set_qform(affine, 1)
+    hdr.set_sform(affine, 1)
+    hdr.set_zooms(tuple(zooms[:len(hdr.get_data_shape())]))
+    hdr['vox_offset'] = 352
+    if out_file.endswith('.gz'):
+        fp = gzip.open(out_file, 'wb', compresslevel=1)
+    else:
+        fp = open(out_file, 'wb')
+    fp.write(hdr.binaryblock)
+    fp.write(b'\x00' * 4)
+    return fp, hdr.get_data_dtype()
+
+
+def apply_composite_warp(moving_image, field_file, out_file, order=1,
+                         chunk_size=16, workers=None):
+    """Resample a 3D or 4D image through a composed displacement field
+
+    The moving voxel coordinates of the reference grid are computed once;
+    volumes are then read chunk_size at a time, resampled with
+    scipy.ndimage.map_coordinates in a thread pool and written to out_file
+    as they are done, so neither the input nor the output series is held
+    in memory.
+
+    Parameters
+    ----------
+    moving_image : 3D or 4D image
+    field_file : composed field (see compose_warp)
+    out_file : output image on the reference grid
+    order : spline order of the interpolation. Default = 1 (linear, as
+            ANTS)
+    chunk_size : volumes resampled together. Default = 16
+    workers : resampling threads. Default = number of cpus
+    """
+    import nibabel as nb
+    img = nb.load(moving_image)
+    moving_shape = img.get_shape()
+    frames = int(np.prod(moving_shape[3:])) if len(moving_shape) > 3 else 1
+    zooms = img.get_header().get_zooms()
+    coords, shape, affine = warp_coordinates(field_file, img.get_affine())
+    ref_zooms = tuple(np.sqrt((np.asarray(affine)[:3, :3] ** 2).sum(axis=0)))
+    del img
+
+    if workers is None:
+        from multiprocessing import cpu_count
+        workers = cpu_count()
+    pool = None
+    if workers > 1 and frames > 1:
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(min(workers, chunk_size))
+
+    def resample(vol):
+        out = map_coordinates(vol, coords, order=order, mode='constant',
+                              cval=0., prefilter=order > 1)
+        return out.reshape(shape).astype(np.float32)
+
+    fp, dtype = _nifti_writer(out_file, shape, affine,
+                              ref_zooms + tuple(zooms[3:4]), frames)
+    try:
+        volumes = iter_volumes(moving_image)
+        while True:
+            chunk = [vol for _, vol in zip(range(chunk_size), volumes)]
+            if not chunk:
+                break
+            if pool is not None:
+                warped = pool.map(resample, chunk)
+            else:
+                warped = [resample(vol) for vol in chunk]
+            for vol in warped:
+                vol = np.asarray(vol, dtype=dtype)
+                if hasattr(vol, 'tobytes'):
+                    fp.write(vol.tobytes(order='F'))
+                else:
+                    fp.write(vol.tostring(order='F'))
+    finally:
+        fp.close()
+        if pool is not None:
+            pool.close()
+    return out_file
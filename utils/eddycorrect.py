@@ -0,0 +1,106 @@
+import os
+import subprocess
+import time
+import numpy as np
+
+
+def flirt_register(in_file, ref_file, out_file, out_matrix):
+    """Affine registration of one volume to the reference with flirt
+
+    Same options as the coregistration of nipype's
+    create_eddy_correct_pipeline. out_file must be an uncompressed .nii.
+    """
+    cmd = ['flirt', '-in', in_file, '-ref', ref_file, '-out', out_file,
+           '-omat', out_matrix, '-nosearch', '-paddingsize', '1',
+           '-interp', 'trilinear']
+    # flirt replaces the extension of -out with the one of FSLOUTPUTTYPE
+    # (NIFTI_GZ on most installs), so pin it to the name that is read back
+    env = dict(os.environ, FSLOUTPUTTYPE='NIFTI')
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT, env=env)
+    output = proc.communicate()[0]
+    if proc.returncode != 0:
+        raise RuntimeError('%s failed (%d):\n%s' % (' '.join(cmd),
+                                                    proc.returncode,
+                                                    output))
+    return out_file
+
+
+def _volume_file(img, data, t, out_file):
+    import nibabel as nb
+    vol = nb.Nifti1Image(np.asarray(data[..., t]), img.get_affine())
+    vol.get_header().set_zooms(img.get_header().get_zooms()[:3])
+    vol.to_filename(out_file)
+    return out_file
+
+
+def eddy_correct(in_file, out_file, ref_num=0, workers=4, register=None,
+                 work_dir=None):
+    """Eddy current correction with concurrent per-volume registrations
+
+    The reference volume is extracted once and registered volumes are read
+    back into one array, so there is no fslsplit / fslmerge round trip. The
+    reference itself is not registered to itself. Registrations run in a
+    thread pool (each one is an external process).
+
+    Parameters
+    ----------
+    in_file : 4D diffusion weighted image
+    out_file : corrected 4D image
+    ref_num : index of the reference volume. Default = 0
+    workers : concurrent registrations. Default = 4
+    register : function(in_file, ref_file, out_file, out_matrix) that
+               writes the volume registered to ref_file. Default =
+               flirt_register
+    work_dir : directory of the per-volume files. Default = the directory
+               of out_file
+
+    Returns
+    -------
+    out_file, reference volume file, list of the registration matrices
+    (None for the reference) and the seconds spent per volume
+    """
+    import nibabel as nb
+    if register is None:
+        register = flirt_register
+    if work_dir is None:
+        work_dir = os.path.dirname(os.path.abspath(out_file))
+    if not os.path.exists(work_dir):
+        os.makedirs(work_dir)
+
+    img = nb.load(in_file)
+    data = img.get_data()
+    frames = data.shape[3]
+    ref_file = _volume_file(img, data, ref_num,
+                            os.path.join(work_dir, 'eddy_ref.nii'))
+
+    def correct(t):
+        t0 = time.time()
+        if t == ref_num:
+            return ref_file, None, 0.
+        vol_file = _volume_file(img, data, t, os.path.join(
+            work_dir, 'eddy_vol%04d.nii' % t))
+        reg_file = os.path.join(work_dir, 'eddy_vol%04d_flirt.nii' % t)
+        mat_file = os.path.join(work_dir, 'eddy_vol%04d_flirt.mat' % t)
+        reg_file = register(vol_file, ref_file, reg_file, mat_file)
+        return reg_file, mat_file, time.time() - t0
+
+    if workers > 1:
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(workers)
+        try:
+            results = pool.map(correct, range(frames))
+        finally:
+            pool.close()
+    else:
+        results = [correct(t) for t in range(frames)]
+
+    corrected = np.zeros(data.shape[:3] + (frames,), np.float32)
+    for t, (reg_file, _, _) in enumerate(results):
+        corrected[..., t] = nb.load(reg_file).get_data().reshape(
+            data.shape[:3])
+    out = nb.Nifti1Image(corrected, img.get_affine())
+    out.get_header().set_zooms(img.get_header().get_zooms()[:4])
+    out.to_filename(out_file)
+    return (out_file, ref_file, [mat for _, mat, _ in results],
+            [elapsed for _, _, elapsed in results])
@@ -0,0 +1,184 @@
+import hashlib
+import os
+import shutil
+import tempfile
+
+CACHE_ENV = 'BIPS_FIGURE_CACHE'
+MAX_BYTES_ENV = 'BIPS_FIGURE_CACHE_MB'
+DEFAULT_MAX_MB = 2048
+# the cache directory is walked for eviction once this fraction of
+# max_mb has been stored since the last walk
+EVICT_FRACTION = 0.1
+ADDED_LOG = 'added.log'
+
+
+def _hash_file(md5, filename, blocksize=1 << 20):
+    fp = open(filename, 'rb')
+    try:
+        while True:
+            block = fp.read(blocksize)
+            if not block:
+                break
+            md5.update(block)
+    finally:
+        fp.close()
+
+
+def set_cache_dir(path, max_mb=None):
+    """Share the figure cache in path with child processes
+
+    The location (and size bound, in MB) are passed on through the
+    BIPS_FIGURE_CACHE and BIPS_FIGURE_CACHE_MB environment variables.
+    """
+    os.environ[CACHE_ENV] = os.path.abspath(path)
+    if max_mb is not None:
+        os.environ[MAX_BYTES_ENV] = str(max_mb)
+
+
+class FigureCache(object):
+    """Content addressed store of rendered figures
+
+    Entries are keyed by the md5 of the input files' contents, the name of
+    the plotting function and its parameters, so an unchanged input is never
+    rendered twice. This module does not import matplotlib; QA functions
+    check the cache first and only import it on a miss. The least recently
+    used entries are evicted once the cache grows beyond max_mb; the sizes
+    of stored entries are appended to a log so that the cache is only
+    walked after EVICT_FRACTION of max_mb was added.
+
+    Parameters
+    ----------
+    cache_dir : shared cache directory. Defaults to BIPS_FIGURE_CACHE or
+                <tempdir>/bips_figure_cache
+    max_mb : size bound in MB. Defaults to BIPS_FIGURE_CACHE_MB or 2048
+    """
+
+    def __init__(self, cache_dir=None, max_mb=None):
+        if cache_dir is None:
+            cache_dir = os.environ.get(CACHE_ENV,
+                                       os.path.join(tempfile.gettempdir(),
+                                                    'bips_figure_cache'))
+        if max_mb is None:
+            max_mb = float(os.environ.get(MAX_BYTES_ENV, DEFAULT_MAX_MB))
+        self.cache_dir = cache_dir
+        self.max_bytes = int(max_mb * 1024 * 1024)
+
+    def key(self, name, in_files, *params):
+        """Hash of a plotting function name, its input files and parameters"""
+        md5 = hashlib.md5()
+        md5.update(name.encode('utf-8'))
+        if not isinstance(in_files, (list, tuple)):
+            in_files = [in_files]
+        for in_file in in_files:
+            if isinstance(in_file, (list, tuple)):
+                for item in in_file:
+                    _hash_file(md5, item)
+            else:
+                _hash_file(md5, in_file)
+        md5.update(repr(params).encode('utf-8'))
+        return md5.hexdigest()
+
+    def array_key(self, name, arrays, *params):
+        """Hash of a plotting function name, the contents of its input
+        arrays and parameters (e.g. a version of the plotting code)"""
+        import numpy as np
+        md5 = hashlib.md5()
+        md5.update(name.encode('utf-8'))
+        for array in arrays:
+            array = np.ascontiguousarray(array)
+            md5.update(('%s%s' % (array.dtype.str,
+                                  array.shape)).encode('utf-8'))
+            md5.update(array.tobytes() if hasattr(array, 'tobytes')
+                       else array.tostring())
+        md5.update(repr(params).encode('utf-8'))
+        return md5.hexdigest()
+
+    def _entry(self, key):
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def fetch(self, key, out_files):
+        """Copy a cached entry to out_files; False if it is not cached"""
+        entry = self._entry(key)
+        cached = [os.path.join(entry, '%d_%s' % (i, os.path.basename(f)))
+                  for i, f in enumerate(out_files)]
+        if not all([os.path.exists(f) for f in cached]):
+            return False
+        try:
+            for src, dst in zip(cached, out_files):
+                shutil.copyfile(src, dst)
+            os.utime(entry, None)
+        except (IOError, OSError):
+            return False
+        return True
+
+    def _log_added(self, size):
+        """Append the size of a stored entry, return the bytes added since
+        the last eviction"""
+        log = os.path.join(self.cache_dir, ADDED_LOG)
+        try:
+            fd = os.open(log, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, ('%d\n' % size).encode('ascii'))
+            finally:
+                os.close(fd)
+            return sum([int(line) for line in open(log) if line.strip()])
+        except (IOError, OSError, ValueError):
+            return self.max_bytes
+
+    def store(self, key, out_files):
+        """Add rendered out_files to the cache and evict old entries once
+        enough was added"""
+        entry = self._entry(key)
+        tmp_dir = None
+        size = 0
+        try:
+            if not os.path.exists(os.path.dirname(entry)):
+                os.makedirs(os.path.dirname(entry))
+            tmp_dir = tempfile.mkdtemp(dir=os.path.dirname(entry))
+            for i, f in enumerate(out_files):
+                shutil.copyfile(f, os.path.join(tmp_dir, '%d_%s' % (
+                    i, os.path.basename(f))))
+            if os.path.exists(entry):
+                shutil.rmtree(entry, ignore_errors=True)
+            os.rename(tmp_dir, entry)
+            tmp_dir = None
+            size = sum([os.path.getsize(f) for f in out_files])
+        except (IOError, OSError):
+            pass
+        finally:
+            if tmp_dir is not None:
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+        if size and self._log_added(size) >= self.max_bytes * EVICT_FRACTION:
+            self.evict()
+
+    def evict(self):
+        """Remove least recently used entries beyond max_bytes"""
+        entries = []
+        total = 0
+        if not os.path.exists(self.cache_dir):
+            return 0
+        try:
+            os.remove(os.path.join(self.cache_dir, ADDED_LOG))
+        except OSError:
+            pass
+        for prefix in os.listdir(self.cache_dir):
+            folder = os.path.join(self.cache_dir, prefix)
+            if not os.path.isdir(folder):
+                continue
+            for key in os.listdir(folder):
+                entry = os.path.join(folder, key)
+                try:
+                    size = sum([os.path.getsize(os.path.join(entry, f))
+                                for f in os.listdir(entry)])
+                    entries.append((os.path.getmtime(entry), size, entry))
+                except OSError:
+                    continue
+                total += size
+        removed = 0
+        for _, size, entry in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+            removed += 1
+        return removed
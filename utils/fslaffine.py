@@ -0,0 +1,137 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import numpy as np
+from imagemeta import CACHE_ENV, get_affine, get_shape
+
+ITK_HEADER = ('#Insight Transform File V1.0\n'
+              '# Transform 0\n'
+              'Transform: MatrixOffsetTransformBase_double_3_3\n')
+
+# RAS <-> LPS
+_LPS = np.diag([-1., -1., 1., 1.])
+
+
+def vox2fsl(shape, affine):
+    """Voxel to FSL scaled-voxel matrix
+
+    FSL coordinates are voxel indices times voxel sizes, with the first axis
+    flipped when the voxel to world affine has a positive determinant
+    (neurological storage order).
+    """
+    affine = np.asarray(affine, dtype=np.float64)
+    zooms = np.sqrt((affine[:3, :3] ** 2).sum(axis=0))
+    mat = np.diag(list(zooms) + [1.])
+    if np.linalg.det(affine[:3, :3]) > 0:
+        mat[0, 0] = -zooms[0]
+        mat[0, 3] = zooms[0] * (shape[0] - 1)
+    return mat
+
+
+def fsl2ras(fsl_matrix, ref_shape, ref_affine, src_shape, src_affine):
+    """World (RAS) transform of an FSL matrix
+
+    Returns the 4x4 matrix mapping source world coordinates to reference
+    world coordinates, as c3d_affine_tool -fsl2ras does.
+    """
+    ref_affine = np.asarray(ref_affine, dtype=np.float64)
+    src_affine = np.asarray(src_affine, dtype=np.float64)
+    return ref_affine.dot(np.linalg.inv(vox2fsl(ref_shape, ref_affine))).dot(
+        np.asarray(fsl_matrix, dtype=np.float64)).dot(
+        vox2fsl(src_shape, src_affine)).dot(np.linalg.inv(src_affine))
+
+
+def ras2itk(ras):
+    """ITK (LPS, fixed to moving) matrix and offset of a RAS transform
+
+    ITK transforms map points of the fixed (reference) image to the moving
+    (source) image, so the RAS source to reference transform is inverted.
+    """
+    itk = _LPS.dot(np.linalg.inv(ras)).dot(_LPS)
+    return itk[:3, :3], itk[:3, 3]
+
+
+def write_itk_affine(filename, matrix, offset):
+    """Write a MatrixOffsetTransformBase text transform (center 0 0 0)"""
+    params = list(np.asarray(matrix).ravel()) + list(np.asarray(offset))
+    fp = open(filename, 'w')
+    try:
+        fp.write(ITK_HEADER)
+        fp.write('Parameters: %s\n' % ' '.join(['%.10g' % p
+                                               for p in params]))
+        fp.write('FixedParameters: 0 0 0\n')
+    finally:
+        fp.close()
+    return filename
+
+
+def read_itk_affine(filename):
+    """Matrix and offset of a MatrixOffsetTransformBase text transform"""
+    params = None
+    center = np.zeros(3)
+    for line in open(filename):
+        if line.startswith('Parameters:'):
+            params = np.array([float(p) for p in line.split()[1:]])
+        elif line.startswith('FixedParameters:'):
+            center = np.array([float(p) for p in line.split()[1:]])
+    if params is None or len(params) != 12:
+        raise ValueError('%s is not a 3D affine ITK transform' % filename)
+    matrix = params[:9].reshape(3, 3)
+    # offset = translation + center - matrix * center
+    offset = params[9:] + center - matrix.dot(center)
+    return matrix, offset
+
+
+def _cache_dir():
+    if os.environ.get(CACHE_ENV):
+        return os.path.join(os.environ[CACHE_ENV], 'itk_affines')
+    return os.path.join(tempfile.gettempdir(), 'bips_itk_affines')
+
+
+def fsl_to_itk(ref_image, src_image, fsl_file, out_file, cache_dir=None):
+    """Convert an FSL (flirt) matrix to an ITK affine for ANTS
+
+    Only the image headers are read and no process is launched. Results are
+    cached by the hash of both headers and the matrix, so repeated
+    conversions (e.g. one per fwhm) reuse the first one.
+
+    Parameters
+    ----------
+    ref_image : reference image of the FSL registration
+    src_image : source (input) image of the FSL registration
+    fsl_file : FSL matrix
+    out_file : ITK transform to write
+    cache_dir : cache directory. Default = <BIPS_IMAGEMETA_DIR>/itk_affines
+                or <tempdir>/bips_itk_affines
+
+    Returns
+    -------
+    out_file
+    """
+    fsl_matrix = np.loadtxt(fsl_file)
+    ref_shape, src_shape = get_shape(ref_image)[:3], get_shape(src_image)[:3]
+    ref_affine, src_affine = get_affine(ref_image), get_affine(src_image)
+    md5 = hashlib.md5()
+    for item in [ref_shape, ref_affine, src_shape, src_affine, fsl_matrix]:
+        md5.update(np.asarray(item, dtype=np.float64).tobytes()
+                   if hasattr(np.ndarray, 'tobytes')
+                   else np.asarray(item, dtype=np.float64).tostring())
+    if cache_dir is None:
+        cache_dir = _cache_dir()
+    cached = os.path.join(cache_dir, md5.hexdigest() + '.txt')
+    if os.path.exists(cached):
+        shutil.copyfile(cached, out_file)
+        return out_file
+    matrix, offset = ras2itk(fsl2ras(fsl_matrix, ref_shape, ref_affine,
+                                     src_shape, src_affine))
+    write_itk_affine(out_file, matrix, offset)
+    try:
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        tmp_file = '%s.%d' % (cached, os.getpid())
+        shutil.copyfile(out_file, tmp_file)
+        os.rename(tmp_file, cached)
+    except (IOError, OSError):
+        pass
+    return out_file
@@ -0,0 +1,268 @@
+import gzip
+import json
+import os
+import sqlite3
+import struct
+import numpy as np
+
+try:
+    string_types = basestring
+except NameError:
+    string_types = str
+
+HEADER_SIZE = 352
+CACHE_FILENAME = '.imagemeta.sqlite'
+CACHE_ENV = 'BIPS_IMAGEMETA_DIR'
+
+NIFTI_DTYPES = {2: 'uint8', 4: 'int16', 8: 'int32', 16: 'float32',
+                32: 'complex64', 64: 'float64', 128: 'RGB', 256: 'int8',
+                512: 'uint16', 768: 'uint32', 1024: 'int64', 1280: 'uint64',
+                1536: 'float128', 1792: 'complex128', 2048: 'complex256'}
+
+# seconds per unit of the xyzt_units time code
+TIME_UNITS = {8: 1., 16: 1e-3, 24: 1e-6}
+
+
+def _quaternion_affine(b, c, d, qoffset, pixdim):
+    a = 1.0 - (b * b + c * c + d * d)
+    a = np.sqrt(a) if a > 0 else 0.0
+    R = np.array([[a * a + b * b - c * c - d * d, 2 * (b * c - a * d),
+                   2 * (b * d + a * c)],
+                  [2 * (b * c + a * d), a * a + c * c - b * b - d * d,
+                   2 * (c * d - a * b)],
+                  [2 * (b * d - a * c), 2 * (c * d + a * b),
+                   a * a + d * d - c * c - b * b]])
+    qfac = -1. if pixdim[0] < 0 else 1.
+    zooms = np.array(pixdim[1:4], dtype=np.float64)
+    zooms[2] *= qfac
+    affine = np.eye(4)
+    affine[:3, :3] = R * zooms
+    affine[:3, 3] = qoffset
+    return affine
+
+
+def _base_affine(shape, pixdim):
+    """Voxel-centered affine used when neither sform nor qform is set"""
+    shape = (list(shape) + [1, 1, 1])[:3]
+    zooms = (list(pixdim[1:4]) + [1, 1, 1])[:3]
+    affine = np.diag([-zooms[0], zooms[1], zooms[2], 1.])
+    affine[:3, 3] = [-(s - 1) / 2.0 * z for s, z in
+                     zip(shape, np.diag(affine)[:3])]
+    return affine
+
+
+def read_nifti_header(filename):
+    """Parse shape, affine, dtype and pixdim from a NIfTI-1 header
+
+    Only the first 352 bytes are read, so gzipped images are not
+    decompressed beyond the header.
+
+    Parameters
+    ----------
+    filename : .nii or .nii.gz file
+
+    Returns
+    -------
+    dict : shape, affine (4x4 list), dtype, pixdim, time_unit (seconds
+           per pixdim[4] unit), and the byteorder, vox_offset, scl_slope and
+           scl_inter needed to read the data; None if filename is not a
+           NIfTI-1 image
+    """
+    if filename.endswith('.gz'):
+        fp = gzip.open(filename, 'rb')
+    else:
+        fp = open(filename, 'rb')
+    try:
+        hdr = fp.read(HEADER_SIZE)
+    finally:
+        fp.close()
+    if len(hdr) < 348:
+        return None
+    for endian in '<>':
+        if struct.unpack(endian + 'i', hdr[:4])[0] == 348:
+            break
+    else:
+        return None
+    if hdr[344:347] not in (b'n+1', b'ni1'):
+        return None
+    dim = struct.unpack(endian + '8h', hdr[40:56])
+    datatype = struct.unpack(endian + 'h', hdr[70:72])[0]
+    pixdim = struct.unpack(endian + '8f', hdr[76:108])
+    vox_offset, scl_slope, scl_inter = struct.unpack(endian + '3f',
+                                                     hdr[108:120])
+    xyzt_units = struct.unpack('B', hdr[123:124])[0]
+    qform_code, sform_code = struct.unpack(endian + '2h', hdr[252:256])
+    quatern = struct.unpack(endian + '6f', hdr[256:280])
+    srow = struct.unpack(endian + '12f', hdr[280:328])
+
+    ndim = max(min(dim[0], 7), 0)
+    shape = tuple(dim[1:ndim + 1])
+    if sform_code > 0:
+        affine = np.eye(4)
+        affine[:3, :] = np.array(srow).reshape(3, 4)
+    elif qform_code > 0:
+        affine = _quaternion_affine(quatern[0], quatern[1], quatern[2],
+                                    quatern[3:], pixdim)
+    else:
+        affine = _base_affine(shape, pixdim)
+    return dict(shape=[int(x) for x in shape],
+                affine=affine.tolist(),
+                dtype=NIFTI_DTYPES.get(datatype, str(datatype)),
+                pixdim=[float(x) for x in pixdim],
+                time_unit=TIME_UNITS.get(xyzt_units & 56, 1.),
+                byteorder=endian,
+                vox_offset=int(vox_offset),
+                scl_slope=float(scl_slope),
+                scl_inter=float(scl_inter))
+
+
+def _nibabel_header(filename):
+    """Fallback for formats other than NIfTI-1 (mgz, analyze, ...)"""
+    import nibabel as nb
+    img = nb.load(filename)
+    hdr = img.get_header()
+    zooms = list(hdr.get_zooms())
+    return dict(shape=[int(x) for x in img.get_shape()],
+                affine=np.asarray(img.get_affine()).tolist(),
+                dtype=str(hdr.get_data_dtype()),
+                pixdim=[1.] + [float(x) for x in zooms] + \
+                       [1.] * (7 - len(zooms)),
+                time_unit=1.)
+
+
+def set_cache_dir(path):
+    """Keep the persistent metadata cache in path
+
+    The location is passed on to child processes through the
+    BIPS_IMAGEMETA_DIR environment variable. Without a cache directory
+    metadata is only cached in memory.
+    """
+    os.environ[CACHE_ENV] = os.path.abspath(path)
+
+
+class ImageMetadataStore(object):
+    """Cache of image header metadata keyed by path, mtime and size
+
+    Parameters
+    ----------
+    cache_dir : directory of the persistent SQLite cache. Defaults to the
+                BIPS_IMAGEMETA_DIR environment variable; None keeps the
+                cache in memory only
+    """
+
+    def __init__(self, cache_dir=None):
+        if cache_dir is None:
+            cache_dir = os.environ.get(CACHE_ENV)
+        self.filename = None
+        if cache_dir:
+            self.filename = os.path.join(cache_dir, CACHE_FILENAME)
+        self._memory = {}
+
+    def _connect(self):
+        if not os.path.exists(os.path.dirname(self.filename)):
+            os.makedirs(os.path.dirname(self.filename))
+        conn = sqlite3.connect(self.filename, timeout=60)
+        conn.execute('CREATE TABLE IF NOT EXISTS meta '
+                     '(path TEXT PRIMARY KEY, mtime REAL, size INTEGER, '
+                     'info TEXT)')
+        return conn
+
+    def _key(self, filename):
+        path = os.path.abspath(filename)
+        stat = os.stat(path)
+        return path, stat.st_mtime, stat.st_size
+
+    def _read(self, path):
+        info = None
+        if path.endswith('.nii') or path.endswith('.nii.gz'):
+            info = read_nifti_header(path)
+        if info is None:
+            info = _nibabel_header(path)
+        return info
+
+    def get_many(self, filenames):
+        """Return metadata dicts for a list of images"""
+        keys = [self._key(f) for f in filenames]
+        results = [self._memory.get(key) for key in keys]
+        missing = [i for i, res in enumerate(results) if res is None]
+        if missing and self.filename:
+            conn = self._connect()
+            try:
+                for i in missing:
+                    path, mtime, size = keys[i]
+                    row = conn.execute('SELECT info FROM meta WHERE path = ? '
+                                       'AND mtime = ? AND size = ?',
+                                       (path, mtime, size)).fetchone()
+                    if row is not None:
+                        results[i] = json.loads(row[0])
+            finally:
+                conn.close()
+        new_rows = []
+        for i, key in enumerate(keys):
+            if results[i] is None:
+                results[i] = self._read(key[0])
+                new_rows.append(key + (json.dumps(results[i]),))
+            self._memory[key] = results[i]
+        if new_rows and self.filename:
+            conn = self._connect()
+            try:
+                with conn:
+                    conn.executemany('INSERT OR REPLACE INTO meta '
+                                     'VALUES (?, ?, ?, ?)', new_rows)
+            finally:
+                conn.close()
+        return results
+
+    def get(self, filename):
+        """Return the metadata dict of one image"""
+        return self.get_many([filename])[0]
+
+
+_store = None
+
+
+def get_store():
+    """Process-wide ImageMetadataStore for the current cache directory"""
+    global _store
+    cache_dir = os.environ.get(CACHE_ENV)
+    if _store is None or _store.filename != (cache_dir and os.path.join(
+            cache_dir, CACHE_FILENAME)):
+        _store = ImageMetadataStore(cache_dir)
+    return _store
+
+
+def get_metadata(filename):
+    return get_store().get(filename)
+
+
+def get_shape(filename):
+    """Shape of an image, read from its header"""
+    return tuple(get_metadata(filename)['shape'])
+
+
+def get_affine(filename):
+    """Voxel to world affine of an image, read from its header"""
+    return np.array(get_metadata(filename)['affine'])
+
+
+def get_tr(filename):
+    """Repetition time of a 4D image in seconds"""
+    info = get_metadata(filename)
+    return info['pixdim'][4] * info['time_unit']
+
+
+def prime(filenames):
+    """Cache the metadata of all NIfTI images in a (nested) list of files"""
+    found = []
+    stack = [filenames]
+    while stack:
+        item = stack.pop()
+        if isinstance(item, (list, tuple)):
+            stack.extend(item)
+        elif isinstance(item, string_types) and (item.endswith('.nii') or
+                                        item.endswith('.nii.gz')) and \
+                os.path.isfile(item):
+            found.append(item)
+    if found:
+        get_store().get_many(found)
+    return len(found)
@@ -0,0 +1,181 @@
+import hashlib
+import os
+import tempfile
+import numpy as np
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+DEFAULT_LUT = '/software/Freesurfer/current/FreeSurferColorLUT.txt'
+
+# FreeSurfer labels left out of ROI tables: unknown, white matter,
+# ventricles, CSF, vessels, choroid plexus, hypointensities, optic chiasm
+# and the cortical 'unknown' labels
+ROIS_TO_SKIP = [0, 2, 4, 5, 7, 14, 15, 24, 30, 31, 41, 43, 44, 46,
+                62, 63, 77, 80, 85, 1000, 2000]
+
+
+def _load(image):
+    import nibabel as nb
+    if isinstance(image, np.ndarray):
+        return image
+    return nb.load(image).get_data()
+
+
+def label_stats(label_file, in_files, exclude=None, chunk_size=32):
+    """Per-label voxel counts, means, standard deviations and waveforms
+
+    The label volume is flattened once and every image is reduced with
+    np.bincount over the same label index, so any number of 3D or 4D
+    images in the label volume's space are summarized in a single read.
+    Standard deviations are computed from the deviations to the label means
+    (two passes over each chunk of frames).
+
+    Parameters
+    ----------
+    label_file : segmentation (e.g. aparc+aseg resampled to functional space)
+    in_files : image or list of images with the same spatial shape
+    exclude : list of label ids to leave out. Default = None
+    chunk_size : number of frames reduced per bincount call
+
+    Returns
+    -------
+    list : one dict per image with 'labels' (sorted ids present in the
+           label volume), 'counts' (voxels per label), and 'means' and
+           'stds' (labels x frames; one frame for 3D images). 'means' is the
+           average waveform of each label.
+    """
+    if not isinstance(in_files, list):
+        in_files = [in_files]
+    labels = np.asarray(_load(label_file)).astype(np.int64).ravel()
+    ids, index = np.unique(labels, return_inverse=True)
+    keep = np.ones(ids.shape[0], dtype=bool)
+    if exclude:
+        keep = np.array([i not in exclude for i in ids], dtype=bool)
+    num_ids = ids.shape[0]
+    counts = np.bincount(index, minlength=num_ids).astype(np.float64)
+
+    results = []
+    for in_file in in_files:
+        data = np.asarray(_load(in_file))
+        if int(np.prod(data.shape[:3])) != labels.shape[0]:
+            raise ValueError('%s does not match the shape of the label '
+                             'volume' % in_file)
+        data = data.reshape(labels.shape[0], -1)
+        frames = data.shape[1]
+        means = np.zeros((num_ids, frames))
+        variance = np.zeros((num_ids, frames))
+        for start in range(0, frames, chunk_size):
+            stop = min(start + chunk_size, frames)
+            block = data[:, start:stop].astype(np.float64)
+            # one bincount per chunk: label i, frame t -> bin i * n + t
+            n = stop - start
+            bins = (index[:, None] * n + np.arange(n)).ravel()
+            sums = np.bincount(bins, weights=block.ravel(),
+                               minlength=num_ids * n).reshape(num_ids, n)
+            means[:, start:stop] = sums / counts[:, None]
+            # second pass over the chunk: squared deviations from the label
+            # means, not sum(x**2)/n - mean**2, which cancels for large
+            # intensities with a small spread
+            block -= means[index, start:stop]
+            variance[:, start:stop] = np.bincount(
+                bins, weights=(block ** 2).ravel(),
+                minlength=num_ids * n).reshape(num_ids, n) / counts[:, None]
+        stds = np.sqrt(np.clip(variance, 0, None))
+        results.append(dict(labels=ids[keep], counts=counts[keep],
+                            means=means[keep], stds=stds[keep]))
+    return results
+
+
+def write_roi_table(filename, labels, waveforms):
+    """Write one row per label: label id followed by its waveform
+
+    This is the comma separated format plot_timeseries reads.
+    """
+    waveforms = np.asarray(waveforms)
+    table = np.hstack((np.asarray(labels)[:, None],
+                       waveforms.reshape(waveforms.shape[0], -1)))
+    np.savetxt(filename, table, '%.4f', delimiter=',')
+    return filename
+
+
+class FreeSurferLUT(object):
+    """Label id to name lookup for a FreeSurfer color table
+
+    The table is parsed on first use and the parsed dict is pickled to
+    cache_dir, so later processes skip the text parse as long as the table
+    file is unchanged.
+
+    Parameters
+    ----------
+    filename : color table. Defaults to $FREESURFER_HOME/FreeSurferColorLUT.txt
+               or /software/Freesurfer/current/FreeSurferColorLUT.txt
+    cache_dir : directory of the parsed cache. Default = tempdir
+    """
+
+    def __init__(self, filename=None, cache_dir=None):
+        if filename is None:
+            filename = DEFAULT_LUT
+            if 'FREESURFER_HOME' in os.environ:
+                fs_lut = os.path.join(os.environ['FREESURFER_HOME'],
+                                      'FreeSurferColorLUT.txt')
+                if os.path.exists(fs_lut):
+                    filename = fs_lut
+        self.filename = os.path.abspath(filename)
+        if cache_dir is None:
+            cache_dir = tempfile.gettempdir()
+        digest = hashlib.md5(self.filename.encode('utf-8')).hexdigest()
+        self.cache_file = os.path.join(cache_dir, 'lut_%s.pkl' % digest[:12])
+        self._names = None
+
+    def _parse(self):
+        names = {}
+        for line in open(self.filename):
+            fields = line.split()
+            if len(fields) < 2 or fields[0].startswith('#'):
+                continue
+            try:
+                names[int(fields[0])] = fields[1]
+            except ValueError:
+                continue
+        return names
+
+    @property
+    def names(self):
+        """dict of label id -> label name"""
+        if self._names is None:
+            stat = os.stat(self.filename)
+            key = (self.filename, stat.st_mtime, stat.st_size)
+            try:
+                cached = pickle.load(open(self.cache_file, 'rb'))
+                if cached[0] == key:
+                    self._names = cached[1]
+            except Exception:
+                pass
+            if self._names is None:
+                self._names = self._parse()
+                try:
+                    tmp_file = '%s.%d' % (self.cache_file, os.getpid())
+                    pickle.dump((key, self._names), open(tmp_file, 'wb'),
+                                pickle.HIGHEST_PROTOCOL)
+                    os.rename(tmp_file, self.cache_file)
+                except (IOError, OSError):
+                    pass
+        return self._names
+
+    def __getitem__(self, label):
+        return self.names[int(label)]
+
+    def get(self, label, default=None):
+        return self.names.get(int(label), default)
+
+
+_luts = {}
+
+
+def get_lut(filename=None):
+    """Shared FreeSurferLUT instance for filename"""
+    if filename not in _luts:
+        _luts[filename] = FreeSurferLUT(filename)
+    return _luts[filename]
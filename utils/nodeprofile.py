@@ -0,0 +1,465 @@
+"""
+Per-node resource profiles
+==========================
+
+Records the wall time, CPU time, peak resident memory and bytes read and
+written of every node of a workflow, wherever the node runs (in process,
+MultiProc worker or PBS job)::
+
+    from nodeprofile import enable_profiling, write_profiles
+    enable_profiling(workflow, c.profile_dir)
+    workflow.run(plugin=c.plugin, plugin_args=c.plugin_args)
+    write_profiles(c.profile_dir)
+
+Each node writes one JSON record to
+profile_dir/<subject>/nodes/<node>.json (subject = the subject_id iterable of
+the node, 'cohort' for nodes outside the subject iterables). write_profiles
+collects the records into profile_dir/<subject>/profile.json and the cohort
+table profile_dir/node_profiles.csv (one row per node over all subjects).
+
+CPU time and I/O include the command line tools the node ran. Memory is
+sampled every `interval` seconds over the node process and its children,
+and completed with the exact peak of the children that exited. Nodes that
+run in the workflow controller (Linear plugin, run_without_submitting) are
+marked in_process and record only the memory they added to the controller;
+the cohort table sizes memory from the other runs when there are any. Nodes
+restored from the nipype cache keep their previous record.
+
+Example
+-------
+
+python nodeprofile.py /mnt/gablab/sad/bips/task/profiles
+python nodeprofile.py /mnt/gablab/sad/bips/task/profiles --top 20
+"""
+import csv
+import glob
+import json
+import os
+import re
+import resource
+import socket
+import sys
+import threading
+import time
+import nipype.pipeline.engine as pe
+
+TABLE_FIELDS = ['node', 'interface', 'runs', 'failed', 'time_mean',
+                'time_max', 'cpu_time_mean', 'threads_max', 'peak_rss_mean',
+                'peak_rss_max', 'read_mean', 'written_mean']
+COHORT = 'cohort'
+MB = 2. ** 20
+
+
+def _proc_io():
+    """Bytes read and written by this process and its reaped children"""
+    try:
+        values = {}
+        for line in open('/proc/self/io'):
+            key, value = line.split(':')
+            values[key] = int(value)
+        return values['rchar'], values['wchar']
+    except (IOError, OSError, KeyError, ValueError):
+        return None
+
+
+def _children_peak():
+    """Peak RSS (MB) of the largest reaped child process"""
+    # ru_maxrss is in bytes on OS X and in kilobytes on Linux
+    unit = 2. ** 20 if sys.platform == 'darwin' else 1024.
+    return resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / unit
+
+
+def _cpu_time():
+    return sum([u.ru_utime + u.ru_stime for u in
+                [resource.getrusage(resource.RUSAGE_SELF),
+                 resource.getrusage(resource.RUSAGE_CHILDREN)]])
+
+
+def _stat_rss(pid):
+    """Resident pages of pid, None if it exited"""
+    try:
+        fields = open('/proc/%d/stat' % pid).read().rsplit(')', 1)[1].split()
+        # fields after the command: state ppid ... rss (24th field)
+        return int(fields[21])
+    except (IOError, OSError, IndexError, ValueError):
+        return None
+
+
+def _scan_tree_rss(pid):
+    """Resident pages of pid and its descendants, from every /proc/<pid>"""
+    parents = {}
+    rss = {}
+    for stat in glob.glob('/proc/[0-9]*/stat'):
+        try:
+            fields = open(stat).read().rsplit(')', 1)[1].split()
+        except (IOError, OSError, IndexError):
+            continue
+        child = int(stat.split('/')[2])
+        parents[child] = int(fields[1])
+        rss[child] = int(fields[21])
+    total = 0
+    for child in rss:
+        p = child
+        while p > 1 and p != pid:
+            p = parents.get(p, 0)
+        if p == pid:
+            total += rss[child]
+    return total
+
+
+def tree_rss(pid):
+    """Resident memory (MB) of pid and all its descendants
+
+    Follows /proc/<pid>/task/<tid>/children down the tree, and scans every
+    process only on kernels without it.
+    """
+    if not os.path.exists('/proc/%d/task/%d/children' % (pid, pid)):
+        return _scan_tree_rss(pid) * resource.getpagesize() / MB
+    total = 0
+    todo = [pid]
+    while todo:
+        p = todo.pop()
+        rss = _stat_rss(p)
+        if rss is None:
+            continue
+        total += rss
+        for children in glob.glob('/proc/%d/task/*/children' % p):
+            try:
+                todo += [int(c) for c in open(children).read().split()]
+            except (IOError, OSError, ValueError):
+                continue
+    return total * resource.getpagesize() / MB
+
+
+class _MemoryMonitor(threading.Thread):
+    """Samples the resident memory of this process tree"""
+
+    def __init__(self, interval):
+        super(_MemoryMonitor, self).__init__()
+        self.daemon = True
+        self.interval = interval
+        self.peak = 0.
+        self._done = threading.Event()
+
+    def sample(self):
+        if os.path.isdir('/proc/self'):
+            self.peak = max(self.peak, tree_rss(os.getpid()))
+
+    def run(self):
+        while not self._done.is_set():
+            self.sample()
+            self._done.wait(self.interval)
+
+    def stop(self):
+        self._done.set()
+        self.join()
+        self.sample()
+        return self.peak
+
+
+def _clean(name):
+    return re.sub('[^A-Za-z0-9_.+-]', '_', name)
+
+
+def _identity(parameterization, key):
+    """Subject and remaining parameters of a node parameterization"""
+    subject = COHORT
+    rest = []
+    for param in parameterization or []:
+        match = re.match('^_?%s_(.+)$' % key, param)
+        if match and subject == COHORT:
+            subject = match.group(1)
+        else:
+            rest.append(param.lstrip('_'))
+    return subject, rest
+
+
+def record_file(profile_dir, subject, node, parameters=(), index=None):
+    """Record of one node run"""
+    name = '.'.join([node] + list(parameters))
+    if index is not None:
+        name += '.%d' % index
+    return os.path.join(profile_dir, _clean(subject), 'nodes',
+                        _clean(name) + '.json')
+
+
+def _write_json(filename, data):
+    path = os.path.dirname(filename)
+    if not os.path.exists(path):
+        try:
+            os.makedirs(path)
+        except OSError:
+            if not os.path.isdir(path):
+                raise
+    tmp = '%s.%s.%d' % (filename, socket.gethostname(), os.getpid())
+    fp = open(tmp, 'w')
+    json.dump(data, fp, indent=1, sort_keys=True)
+    fp.close()
+    os.rename(tmp, filename)
+
+
+class ProfiledNode(pe.Node):
+    """Node that records the resources of its run
+
+    Set up by enable_profiling. MapNode iterations are ProfiledNodes that
+    carry the name and parameterization of their MapNode.
+    """
+
+    def run(self, *args, **kwargs):
+        settings = self._profile
+        subject, parameters = _identity(
+            settings.get('parameterization', self.parameterization),
+            settings['key'])
+        index = settings.get('index')
+        record = {'node': settings.get('node', self.fullname),
+                  'interface': self._interface.__class__.__name__,
+                  'subject': subject, 'parameters': parameters,
+                  'index': index, 'host': socket.gethostname(),
+                  'in_process': (socket.gethostname(), os.getpid()) ==
+                  tuple(settings.get('controller', ())),
+                  'start': time.time()}
+        out_file = record_file(settings['dir'], subject, record['node'],
+                               parameters, index)
+        try:
+            result = os.path.join(self.output_dir(),
+                                  'result_%s.pklz' % self.name)
+            cached = os.path.getmtime(result)
+        except (OSError, TypeError):
+            result, cached = None, None
+
+        monitor = _MemoryMonitor(settings['interval'])
+        baseline = 0.
+        if record['in_process'] and os.path.isdir('/proc/self'):
+            # the controller's own memory is not the node's
+            baseline = tree_rss(os.getpid())
+        children_peak = _children_peak()
+        io = _proc_io()
+        cpu = _cpu_time()
+        monitor.start()
+        record['status'] = 'failed'
+        try:
+            out = super(ProfiledNode, self).run(*args, **kwargs)
+            record['status'] = 'ok'
+            return out
+        finally:
+            record['time'] = time.time() - record['start']
+            record['cpu_time'] = _cpu_time() - cpu
+            record['threads'] = record['cpu_time'] / max(record['time'], 1e-3)
+            peak = max(monitor.stop() - baseline, 0.)
+            if _children_peak() > children_peak:
+                # children forked by the controller start with its memory
+                peak = max(peak, _children_peak() - baseline)
+            record['peak_rss'] = peak
+            end_io = _proc_io()
+            if io and end_io:
+                record['read'] = (end_io[0] - io[0]) / MB
+                record['written'] = (end_io[1] - io[1]) / MB
+            else:
+                record['read'] = record['written'] = None
+            reused = (cached is not None and record['status'] == 'ok' and
+                      os.path.exists(result) and
+                      os.path.getmtime(result) == cached)
+            if not (reused and os.path.exists(out_file)):
+                record['cached'] = reused
+                _write_json(out_file, record)
+
+
+class ProfiledMapNode(pe.MapNode):
+    """MapNode whose iterations are ProfiledNodes
+
+    Only the iterations are recorded, the MapNode itself just collects
+    their results.
+    """
+
+    def _make_nodes(self, *args, **kwargs):
+        for i, node in super(ProfiledMapNode, self)._make_nodes(*args,
+                                                                 **kwargs):
+            node.__class__ = ProfiledNode
+            node._profile = dict(self._profile, node=self.fullname,
+                                 parameterization=self.parameterization,
+                                 index=i)
+            yield i, node
+
+
+def enable_profiling(workflow, profile_dir, key='subject_id', interval=1.):
+    """Record the resources of every node of workflow
+
+    Parameters
+    ----------
+    workflow : nipype workflow, before it is run
+    profile_dir : directory of the profiles. Must be reachable from the
+                  nodes that run on other hosts.
+    key : iterable that identifies the subject. Default = 'subject_id'
+    interval : seconds between memory samples. Default = 1
+
+    Returns
+    -------
+    number of nodes profiled
+    """
+    settings = {'dir': os.path.abspath(profile_dir), 'key': key,
+                'interval': interval,
+                'controller': (socket.gethostname(), os.getpid())}
+    count = 0
+    for node in workflow._get_all_nodes():
+        if type(node) is pe.Node:
+            node.__class__ = ProfiledNode
+        elif type(node) is pe.MapNode:
+            node.__class__ = ProfiledMapNode
+        else:
+            continue
+        node._profile = dict(settings)
+        count += 1
+    return count
+
+
+def subject_records(profile_dir, subject):
+    """Node records of subject, slowest first"""
+    records = []
+    for filename in glob.glob(os.path.join(profile_dir, _clean(subject),
+                                           'nodes', '*.json')):
+        try:
+            records.append(json.load(open(filename)))
+        except ValueError:
+            # being written
+            continue
+    records.sort(key=lambda r: -r['time'])
+    return records
+
+
+def _mean(values):
+    values = [v for v in values if v is not None]
+    if not values:
+        return None
+    return sum(values) / float(len(values))
+
+
+def _max(values):
+    values = [v for v in values if v is not None]
+    if not values:
+        return None
+    return max(values)
+
+
+def cohort_table(records):
+    """One row per node (over subjects, parameters and MapNode iterations)
+
+    Records restored from the nipype cache are left out. Memory comes from
+    the runs outside the workflow controller when a node has any, the
+    in_process runs only record what they added to the controller.
+    """
+    nodes = {}
+    for record in records:
+        if not record.get('cached'):
+            nodes.setdefault(record['node'], []).append(record)
+    rows = []
+    for node in sorted(nodes):
+        runs = nodes[node]
+        done = [r for r in runs if r['status'] == 'ok'] or runs
+        sized = [r for r in done if not r.get('in_process')] or done
+        rows.append({'node': node, 'interface': runs[0]['interface'],
+                     'runs': len(runs),
+                     'failed': len(runs) - len([r for r in runs
+                                                if r['status'] == 'ok']),
+                     'time_mean': _mean([r['time'] for r in done]),
+                     'time_max': _max([r['time'] for r in done]),
+                     'cpu_time_mean': _mean([r['cpu_time'] for r in done]),
+                     'threads_max': _max([r['threads'] for r in done]),
+                     'peak_rss_mean': _mean([r['peak_rss'] for r in sized]),
+                     'peak_rss_max': _max([r['peak_rss'] for r in sized]),
+                     'read_mean': _mean([r['read'] for r in done]),
+                     'written_mean': _mean([r['written'] for r in done])})
+    return rows
+
+
+def write_profiles(profile_dir):
+    """Write the per-subject profiles and the cohort table
+
+    Returns
+    -------
+    cohort table file
+    """
+    everything = []
+    for path in sorted(glob.glob(os.path.join(profile_dir, '*', 'nodes'))):
+        subject = os.path.basename(os.path.dirname(path))
+        records = subject_records(profile_dir, subject)
+        _write_json(os.path.join(profile_dir, subject, 'profile.json'),
+                    records)
+        everything += records
+    if not os.path.isdir(profile_dir):
+        # no node was profiled
+        os.makedirs(profile_dir)
+    table = os.path.join(profile_dir, 'node_profiles.csv')
+    fp = open(table, 'w')
+    writer = csv.DictWriter(fp, TABLE_FIELDS)
+    writer.writeheader()
+    for row in cohort_table(everything):
+        writer.writerow(dict([(k, '%.3f' % v if isinstance(v, float) else v)
+                              for k, v in row.items()]))
+    fp.close()
+    return table
+
+
+def read_table(table):
+    """Rows of node_profiles.csv, with numbers converted"""
+    rows = []
+    for row in csv.DictReader(open(table)):
+        for k in TABLE_FIELDS[2:]:
+            row[k] = float(row[k]) if row[k] not in ('', 'None') else None
+        rows.append(row)
+    return rows
+
+
+def _fmt(value, fmt):
+    return '-' if value is None else fmt % value
+
+
+def report_tables(records, top=10):
+    """Slowest and largest nodes as tables for ReportSink
+
+    Returns
+    -------
+    list of (title, table) where table is a list of rows, header first
+    """
+    header = ['Node', 'Interface', 'Time (s)', 'CPU (s)', 'Peak RSS (MB)',
+              'Read (MB)', 'Written (MB)']
+
+    def rows(chosen):
+        out = [header]
+        for r in chosen[:top]:
+            name = r['node'] + ''.join(['[%s]' % p for p in r['parameters']])
+            if r['index'] is not None:
+                name += '[%d]' % r['index']
+            if len(name) > 48:
+                name = '...' + name[-45:]
+            out.append([name, r['interface'], _fmt(r['time'], '%.1f'),
+                        _fmt(r['cpu_time'], '%.1f'),
+                        _fmt(r['peak_rss'], '%.0f'), _fmt(r['read'], '%.1f'),
+                        _fmt(r['written'], '%.1f')])
+        return out
+
+    if not records:
+        return []
+    slowest = sorted(records, key=lambda r: -r['time'])
+    largest = sorted(records, key=lambda r: -(r['peak_rss'] or 0))
+    return [('Slowest nodes', rows(slowest)),
+            ('Most memory hungry nodes', rows(largest))]
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="example: \
+                        python nodeprofile.py profile_dir --top 20")
+    parser.add_argument('profile_dir', help='directory of the profiles')
+    parser.add_argument('--top', dest='top', type=int, default=10,
+                        help='nodes listed per table')
+    args = parser.parse_args()
+    table = write_profiles(args.profile_dir)
+    rows = read_table(table)
+    print("%-50s %6s %10s %10s %12s" % ('node', 'runs', 'time (s)',
+                                        'threads', 'peak (MB)'))
+    for row in sorted(rows, key=lambda r: -(r['time_max'] or 0))[:args.top]:
+        print("%-50s %6d %10s %10s %12s" % (
+            row['node'][-50:], row['runs'], _fmt(row['time_max'], '%.1f'),
+            _fmt(row['threads_max'], '%.2f'),
+            _fmt(row['peak_rss_max'], '%.0f')))
+    print("cohort table: %s" % table)
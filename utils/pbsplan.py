@@ -0,0 +1,310 @@
+"""
+PBS resource planning
+=====================
+
+Sizes the PBS request of every node from its recorded history
+(utils/nodeprofile.py) instead of one global qsub_args:
+
+ppn       threads the node used (CPU time / wall time), rounded
+mem       largest peak resident memory times mem_margin
+walltime  longest run times time_margin
+
+Tiny utility nodes (Function, IdentityInterface, ...) that ran in less than
+tiny_time seconds with little memory are not submitted at all: they run in
+the submitting process (run_without_submitting), batched with the workflow
+controller, so they do not each wait in the queue. Nodes without history
+keep their qsub_args. Nodes given their own plugin_args are always
+submitted, and their plan only ever raises the ppn, mem and walltime they
+request: a history of quick runs (e.g. cache hits) does not shrink the job
+of a node that sometimes runs long.
+
+    from pbsplan import run_workflow
+    run_workflow(workflow, c)
+
+profiles the nodes into c.profile_dir, plans their resources if
+c.resource_plan is set (with c.plugin_args as the global qsub_args; only
+printed if it is 'dry_run'), runs the workflow and writes the profiles.
+The plan of every node in the history can also be printed without a
+workflow:
+
+python pbsplan.py /mnt/gablab/sad/bips/task/profiles --qsub_args "-q many"
+"""
+import math
+import os
+import re
+from nodeprofile import enable_profiling, read_table, write_profiles
+
+BATCH_INTERFACES = ['Function', 'IdentityInterface', 'Merge', 'Select',
+                    'Rename', 'Split']
+OPTIONS = {'time_margin': 1.5,  # walltime = longest run * time_margin
+           'mem_margin': 1.5,  # mem = largest peak RSS * mem_margin
+           'min_walltime': 15 * 60.,  # seconds
+           'min_mem': 512,  # MB
+           'mem_step': 256,  # MB
+           'max_ppn': 8,
+           'thread_tolerance': 0.25,  # threads above a whole number ignored
+           'tiny_time': 5.,  # seconds
+           'tiny_mem': 256.}  # MB
+MEM_UNITS = {'b': 1. / 2 ** 20, 'kb': 1. / 1024, 'mb': 1., 'gb': 1024.,
+             'tb': 1024. ** 2}
+
+
+def load_history(profile_dir):
+    """Cohort table of the node profiles, by node name"""
+    if not os.path.isdir(profile_dir):
+        return {}
+    table = os.path.join(profile_dir, 'node_profiles.csv')
+    if not os.path.exists(table):
+        table = write_profiles(profile_dir)
+    return dict([(row['node'], row) for row in read_table(table)])
+
+
+def workflow_nodes(workflow, prefix=''):
+    """(name, node) of every node, named as in the profiles"""
+    import nipype.pipeline.engine as pe
+    prefix += workflow.name + '.'
+    nodes = []
+    for node in workflow._graph.nodes():
+        if isinstance(node, pe.Workflow):
+            nodes += workflow_nodes(node, prefix)
+        else:
+            nodes.append((prefix + node.name, node))
+    return nodes
+
+
+def format_walltime(seconds):
+    seconds = int(math.ceil(seconds / 60.)) * 60
+    return '%02d:%02d:%02d' % (seconds // 3600, seconds % 3600 // 60,
+                               seconds % 60)
+
+
+def node_resources(row, options=OPTIONS):
+    """ppn, mem (MB) and walltime (seconds) from the history of a node
+
+    Nodes whose recorded runs all failed (often killed for running out of
+    walltime or memory) get twice the margins.
+    """
+    scale = 2. if row['failed'] and row['failed'] >= row['runs'] else 1.
+    threads = row['threads_max'] or 1.
+    ppn = int(math.ceil(threads - options['thread_tolerance']))
+    ppn = min(max(ppn, 1), options['max_ppn'])
+    step = options['mem_step']
+    mem = (row['peak_rss_max'] or 0) * options['mem_margin'] * scale
+    mem = max(options['min_mem'], int(math.ceil(mem / step)) * step)
+    walltime = max(options['min_walltime'],
+                   (row['time_max'] or 0) * options['time_margin'] * scale)
+    return {'ppn': ppn, 'mem': mem, 'walltime': walltime}
+
+
+def resource_args(resources):
+    return '-l nodes=1:ppn=%d,mem=%dmb,walltime=%s' % (
+        resources['ppn'], resources['mem'],
+        format_walltime(resources['walltime']))
+
+
+def requested_resources(args):
+    """ppn, mem (MB) and walltime (seconds) requested by the -l lists of
+    qsub arguments, the last one winning"""
+    resources = {}
+    for spec in re.findall(r'-l\s+(\S+)', args or ''):
+        for item in spec.split(','):
+            key, _, value = item.partition('=')
+            if key == 'nodes':
+                match = re.search(r'ppn=(\d+)', value)
+                if match:
+                    resources['ppn'] = int(match.group(1))
+            elif key == 'mem':
+                match = re.match(r'(\d+)([kmgt]?b)?$', value.lower())
+                if match:
+                    resources['mem'] = int(math.ceil(
+                        int(match.group(1)) * MEM_UNITS[match.group(2) or 'b']))
+            elif key == 'walltime':
+                seconds = 0
+                for part in value.split(':'):
+                    seconds = seconds * 60 + float(part)
+                resources['walltime'] = seconds
+    return resources
+
+
+def node_args(node, base_args=''):
+    """qsub arguments a node's own plugin_args give it, None without"""
+    args = getattr(node, 'plugin_args', None) or {}
+    if not args.get('qsub_args'):
+        return None
+    if args.get('overwrite'):
+        return args['qsub_args']
+    return ' '.join([base_args or '', args['qsub_args']]).strip()
+
+
+def qsub_args(base, resources):
+    """base qsub arguments with their resource list replaced"""
+    base = re.sub(r'-l\s+\S+', '', base or '').split()
+    return ' '.join(base + [resource_args(resources)])
+
+
+def is_tiny(row, options=OPTIONS):
+    return (row['interface'] in BATCH_INTERFACES and
+            row['failed'] == 0 and
+            (row['time_max'] or 0) <= options['tiny_time'] and
+            (row['peak_rss_max'] or 0) <= options['tiny_mem'] and
+            (row['threads_max'] or 0) <= 1 + options['thread_tolerance'])
+
+
+def plan_node(name, row, base_args='', submit=False, options=OPTIONS,
+              own_args=None):
+    """Plan of one node
+
+    submit : never batch the node (MapNodes, nodes with their own
+             plugin_args)
+    own_args : qsub arguments of the node's own plugin_args (node_args).
+               They replace base_args, and the planned resources are never
+               below the ones they request.
+
+    Returns
+    -------
+    dict with node, action ('submit', 'batch' or 'default'), runs and for
+    submitted nodes ppn, mem, walltime and qsub_args
+    """
+    if row is None:
+        return {'node': name, 'action': 'default', 'runs': 0}
+    plan = {'node': name, 'runs': int(row['runs'])}
+    if is_tiny(row, options) and not submit:
+        plan['action'] = 'batch'
+    else:
+        plan['action'] = 'submit'
+        plan.update(node_resources(row, options))
+        if own_args is not None:
+            for key, value in requested_resources(own_args).items():
+                plan[key] = max(plan[key], value)
+            base_args = own_args
+        plan['qsub_args'] = qsub_args(base_args, plan)
+    return plan
+
+
+def make_plan(workflow, history, base_args='', **options):
+    """Plan of every node of workflow
+
+    Parameters
+    ----------
+    workflow : nipype workflow
+    history : load_history output
+    base_args : global qsub_args (queue, mail, ...); its resource list
+                (-l) is replaced by the planned one
+    options : overrides of OPTIONS
+    """
+    import nipype.pipeline.engine as pe
+    opts = dict(OPTIONS)
+    opts.update(options)
+    plan = []
+    for name, node in workflow_nodes(workflow):
+        own_args = node_args(node, base_args)
+        plan.append(plan_node(name, history.get(name), base_args,
+                              isinstance(node, pe.MapNode) or
+                              bool(node.plugin_args), opts, own_args))
+    return plan
+
+
+def apply_plan(workflow, plan):
+    """Set the planned plugin_args and batched nodes of workflow"""
+    actions = dict([(p['node'], p) for p in plan])
+    for name, node in workflow_nodes(workflow):
+        node_plan = actions.get(name)
+        if node_plan is None or node_plan['action'] == 'default':
+            continue
+        if node_plan['action'] == 'batch':
+            node.run_without_submitting = True
+        else:
+            node.plugin_args = {'qsub_args': node_plan['qsub_args'],
+                                'overwrite': True}
+
+
+def print_plan(plan):
+    print("%-50s %-8s %5s %4s %8s %9s" % ('node', 'action', 'runs', 'ppn',
+                                          'mem (MB)', 'walltime'))
+    for p in plan:
+        if p['action'] == 'submit':
+            print("%-50s %-8s %5d %4d %8d %9s" % (
+                p['node'][-50:], p['action'], p['runs'], p['ppn'], p['mem'],
+                format_walltime(p['walltime'])))
+        else:
+            print("%-50s %-8s %5d" % (p['node'][-50:], p['action'],
+                                      p['runs']))
+    counts = dict([(a, len([p for p in plan if p['action'] == a]))
+                   for a in ['submit', 'batch', 'default']])
+    print("%(submit)d nodes sized from their history, %(batch)d run in the "
+          "submitting process, %(default)d without history" % counts)
+
+
+def plan_resources(workflow, c):
+    """Plan the PBS resources of workflow with the settings of config c
+
+    Uses c.profile_dir, c.plugin_args['qsub_args'] and c.resource_plan (True
+    to apply the plan, 'dry_run' to only print it).
+
+    Returns
+    -------
+    the plan (see plan_node)
+    """
+    if not getattr(c, 'profile_dir', None):
+        raise ValueError('resource_plan needs profile_dir, the directory of '
+                         'the node profiles the resources are planned from')
+    base_args = ''
+    if isinstance(c.plugin_args, dict):
+        base_args = c.plugin_args.get('qsub_args', '')
+    plan = make_plan(workflow, load_history(c.profile_dir), base_args)
+    print_plan(plan)
+    if c.resource_plan != 'dry_run':
+        apply_plan(workflow, plan)
+    return plan
+
+
+def run_workflow(workflow, c, plugin=None, plugin_args=None):
+    """Run workflow with the profiling and planning settings of config c
+
+    Profiles the nodes if c.profile_dir is set and plans their resources if
+    c.resource_plan is set (see plan_resources). Runs on the grid with
+    plugin and plugin_args (default c.plugin and c.plugin_args) if
+    c.run_on_grid, in process otherwise.
+
+    Returns
+    -------
+    False for a dry run, True once workflow ran
+    """
+    profile_dir = getattr(c, 'profile_dir', None)
+    if profile_dir:
+        enable_profiling(workflow, profile_dir)
+    resource_plan = getattr(c, 'resource_plan', False)
+    if resource_plan:
+        plan_resources(workflow, c)
+        if resource_plan == 'dry_run':
+            return False
+    if c.run_on_grid:
+        if plugin_args is None:
+            plugin_args = c.plugin_args
+        workflow.run(plugin=plugin or c.plugin, plugin_args=plugin_args)
+    else:
+        workflow.run()
+    if profile_dir:
+        write_profiles(profile_dir)
+    return True
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="example: \
+                        python pbsplan.py profile_dir --qsub_args '-q many'")
+    parser.add_argument('profile_dir', help='directory of the profiles')
+    parser.add_argument('--qsub_args', dest='qsub_args', default='',
+                        help='global qsub arguments')
+    for key, value in sorted(OPTIONS.items()):
+        parser.add_argument('--%s' % key, dest=key, type=type(value),
+                            default=value)
+    args = parser.parse_args()
+    options = dict([(k, getattr(args, k)) for k in OPTIONS])
+    history = load_history(args.profile_dir)
+    plan = [plan_node(name, history[name], args.qsub_args, options=options)
+            for name in sorted(history)]
+    print_plan(plan)
+    for p in plan:
+        if p['action'] == 'submit':
+            print("%s: %s" % (p['node'], p['qsub_args']))
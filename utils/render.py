@@ -0,0 +1,192 @@
+import os
+import numpy as np
+
+VIEWS = ('x', 'y', 'z')
+# part of the figure cache key of render_views and SliceRenderer images:
+# change it whenever they draw differently
+PLOT_VERSION = '1'
+
+
+def _load(image):
+    from nibabel import load
+    img = load(image)
+    return np.asarray(img.get_data(), dtype=np.float64), img.get_affine()
+
+
+def ras_reorient(data, affine):
+    """Permute and flip the voxel axes of data to the closest RAS order
+
+    Returns the reoriented array and its voxel to world affine.
+    """
+    data = data.reshape(data.shape[:3])
+    axes = np.argmax(np.abs(affine[:3, :3]), axis=0)
+    if len(set(axes)) < 3:
+        return data, affine
+    order = np.argsort(axes)
+    data = np.transpose(data, order)
+    new_affine = affine.copy()
+    new_affine[:3, :3] = affine[:3, :3][:, order]
+    for i in range(3):
+        if new_affine[i, i] < 0:
+            reverse = [slice(None)] * 3
+            reverse[i] = slice(None, None, -1)
+            data = data[tuple(reverse)]
+            flip = np.eye(4)
+            flip[i, i] = -1
+            flip[i, 3] = data.shape[i] - 1
+            new_affine = new_affine.dot(flip)
+    return data, new_affine
+
+
+class SliceRenderer(object):
+    """Overlay a statistical image on a background, for several views
+
+    Both volumes are loaded once; the stat image is resampled onto the
+    reoriented background grid once, so any number of views and cuts can be
+    rendered from the cached arrays.
+
+    Parameters
+    ----------
+    stat_image : statistical image (file or (data, affine) tuple)
+    background_image : anatomical background (file or (data, affine) tuple)
+    threshold : absolute value below which the stat image is transparent
+    cmap : matplotlib colormap name of the overlay. Default = 'hot'
+    invert_background : True to display 1 - background
+    background_min : background values below this are transparent
+    """
+
+    def __init__(self, stat_image, background_image, threshold, cmap='hot',
+                 invert_background=False, background_min=None):
+        from scipy.ndimage import map_coordinates
+        if isinstance(background_image, tuple):
+            anat, anat_affine = background_image
+        else:
+            anat, anat_affine = _load(background_image)
+        if isinstance(stat_image, tuple):
+            stat, stat_affine = stat_image
+        else:
+            stat, stat_affine = _load(stat_image)
+        anat, self.affine = ras_reorient(np.asarray(anat, dtype=np.float64),
+                                         anat_affine)
+        if invert_background:
+            anat = 1 - anat
+        if background_min is not None:
+            anat[anat < background_min] = np.nan
+        self.background = anat
+
+        # background voxel -> stat voxel, evaluated once for the whole grid
+        vox2vox = np.linalg.inv(stat_affine).dot(self.affine)
+        grid = np.indices(anat.shape).reshape(3, -1)
+        coords = vox2vox[:3, :3].dot(grid) + vox2vox[:3, 3:]
+        stat = np.asarray(stat, dtype=np.float64).reshape(stat.shape[:3])
+        resampled = map_coordinates(stat, coords, order=0, mode='constant',
+                                    cval=0.).reshape(anat.shape)
+        self.stat = np.ma.masked_where(np.abs(resampled) <= threshold,
+                                       resampled)
+        self.threshold = threshold
+        self.cmap = cmap
+        if self.stat.count():
+            self.vmin, self.vmax = self.stat.min(), self.stat.max()
+        else:
+            self.vmin, self.vmax = 0, 1
+
+    def default_cut(self):
+        """World coordinate of the center of mass of the suprathreshold
+        overlay, or of the volume center when nothing survives"""
+        mask = ~np.ma.getmaskarray(self.stat)
+        if mask.any():
+            weights = np.abs(self.stat.filled(0))
+            indices = np.indices(mask.shape)
+            ijk = [(indices[i] * weights).sum() / weights.sum()
+                   for i in range(3)]
+        else:
+            ijk = [(s - 1) / 2.0 for s in self.background.shape]
+        return self.affine[:3, :3].dot(ijk) + self.affine[:3, 3]
+
+    def cut(self, view, coord):
+        """2D background and overlay arrays (rows = superior/anterior up)
+        for a view at a world coordinate (the cut is along one axis)"""
+        axis = VIEWS.index(view)
+        if np.iterable(coord):
+            xyz = np.asarray(coord, dtype=np.float64)
+        else:
+            xyz = self.affine[:3, 3].copy()
+            xyz[axis] = coord
+        ijk = np.linalg.solve(self.affine[:3, :3], xyz - self.affine[:3, 3])
+        index = int(np.clip(np.round(ijk[axis]), 0,
+                            self.background.shape[axis] - 1))
+        slicer = [slice(None)] * 3
+        slicer[axis] = index
+        return (self.background[tuple(slicer)].T,
+                self.stat[tuple(slicer)].T)
+
+    def cuts(self, views, cut_coords=None):
+        """Precompute the cuts of every view for a list of coordinates"""
+        if cut_coords is None:
+            cut_coords = [self.default_cut()]
+        return [[(view, self.cut(view, coord)) for view in views]
+                for coord in cut_coords]
+
+    def _draw(self, panels, out_file, dpi, colorbar=True, formatter='%.2f',
+              transparent=False):
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        fig = Figure(figsize=(2.6 * len(panels), 3.2))
+        FigureCanvasAgg(fig)
+        image = None
+        for i, (view, (anat, stat)) in enumerate(panels):
+            ax = fig.add_axes([i / float(len(panels)), 0.22,
+                               1. / len(panels), 0.78])
+            ax.imshow(anat, cmap='gray', origin='lower',
+                      interpolation='nearest')
+            image = ax.imshow(stat, cmap=self.cmap, origin='lower',
+                              interpolation='nearest', vmin=self.vmin,
+                              vmax=self.vmax)
+            ax.set_axis_off()
+            ax.text(0.02, 0.02, view, color='w', transform=ax.transAxes)
+        if colorbar and image is not None:
+            cax = fig.add_axes([0.3, 0.12, 0.4, 0.04])
+            cb = fig.colorbar(image, cax=cax, orientation='horizontal',
+                              format=formatter)
+            cb.set_ticks([self.vmin, self.vmax])
+        fig.savefig(out_file, dpi=dpi, transparent=transparent)
+        return out_file
+
+    def render(self, views, out_file, cut_coords=None, dpi=100, **kwargs):
+        """Render all views of one cut into a single figure"""
+        panels = self.cuts(views, None if cut_coords is None
+                           else [cut_coords])[0]
+        return self._draw(panels, out_file, dpi, **kwargs)
+
+    def render_many(self, jobs, dpi=100, workers=None, **kwargs):
+        """Render (views, cut_coords, out_file) jobs in a thread pool
+
+        Cuts are extracted up front; figures are drawn with the object
+        oriented matplotlib API, so the jobs can run concurrently (threads
+        also work inside daemonic pipeline worker processes).
+        """
+        panels = [(self.cuts(views, None if coord is None else [coord])[0],
+                   out_file) for views, coord, out_file in jobs]
+        draw = lambda job: self._draw(job[0], job[1], dpi, **kwargs)
+        if workers is None:
+            workers = min(len(panels), 4)
+        if workers <= 1 or len(panels) <= 1:
+            return [draw(job) for job in panels]
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(workers)
+        try:
+            return pool.map(draw, panels)
+        finally:
+            pool.close()
+
+
+def render_views(stat_image, background_image, threshold, out_dir=None,
+                 views=('z', 'x', 'y'), dpi=100, workers=None, **kwargs):
+    """Render one tile per view (files <view>_view.png in out_dir)"""
+    if out_dir is None:
+        out_dir = os.getcwd()
+    renderer = SliceRenderer(stat_image, background_image, threshold,
+                             **kwargs)
+    jobs = [((view,), None, os.path.join(out_dir, '%s_view.png' % view))
+            for view in views]
+    return renderer.render_many(jobs, dpi=dpi, workers=workers)
@@ -0,0 +1,144 @@
+# HTML counterpart of write_report.report: images are referenced by path (or
+# by a cached thumbnail) instead of being embedded in the document.
+
+import hashlib
+import os
+import struct
+import time
+try:
+    from html import escape
+except ImportError:
+    from cgi import escape
+
+
+def image_size(imagefile):
+    """(width, height) of a PNG or JPEG image read from its header
+
+    Only the first bytes of the file are read; other formats fall back to
+    PIL, which also only parses the header.
+    """
+    fp = open(imagefile, 'rb')
+    try:
+        head = fp.read(26)
+        if head[:8] == b'\x89PNG\r\n\x1a\n' and head[12:16] == b'IHDR':
+            return struct.unpack('>II', head[16:24])
+        if head[:2] == b'\xff\xd8':
+            fp.seek(2)
+            while True:
+                marker = fp.read(2)
+                if len(marker) < 2 or marker[0:1] != b'\xff':
+                    break
+                code = ord(marker[1:2])
+                if code in (0xd8, 0x01) or 0xd0 <= code <= 0xd7:
+                    continue
+                length = struct.unpack('>H', fp.read(2))[0]
+                if 0xc0 <= code <= 0xcf and code not in (0xc4, 0xc8, 0xcc):
+                    height, width = struct.unpack('>xHH', fp.read(5))
+                    return width, height
+                fp.seek(length - 2, 1)
+    finally:
+        fp.close()
+    from PIL import Image
+    return Image.open(imagefile).size
+
+
+def _escape(text):
+    return escape(str(text), quote=True)
+
+
+class html_report():
+    """Write report sections to a single HTML page
+
+    Has the same methods as write_report.report. Images wider than
+    max_width are shown as thumbnails (cached in <report>_files, keyed by
+    the image's path and mtime) that link to the full image; all images
+    are loaded lazily by the browser.
+    """
+
+    def __init__(self, fname, title, max_width=800, thumbnails=True):
+        self.report = fname
+        self.title = title
+        self.max_width = max_width
+        self.thumbnails = thumbnails
+        self.files_dir = os.path.splitext(fname)[0] + '_files'
+        self.elements = []
+        self.elements.append('<p class="time">%s</p>' % _escape(time.ctime()))
+        self.elements.append('<h1>%s</h1>' % _escape(title))
+
+    def _link(self, path):
+        path = os.path.abspath(path)
+        try:
+            return os.path.relpath(path, os.path.dirname(self.report))
+        except ValueError:
+            return path
+
+    def _thumbnail(self, fname, width, height):
+        stat = os.stat(fname)
+        key = hashlib.md5(('%s:%s:%s:%s' % (os.path.abspath(fname),
+                                            stat.st_mtime, stat.st_size,
+                                            self.max_width)).encode('utf-8'))
+        thumb = os.path.join(self.files_dir, key.hexdigest()[:16] + '.png')
+        if not os.path.exists(thumb):
+            from PIL import Image
+            if not os.path.exists(self.files_dir):
+                os.makedirs(self.files_dir)
+            im = Image.open(fname)
+            im.draft('RGB', (self.max_width, height))
+            im.thumbnail((self.max_width, height), Image.ANTIALIAS
+                         if hasattr(Image, 'ANTIALIAS') else Image.LANCZOS)
+            tmp = '%s.%d.png' % (thumb, os.getpid())
+            im.save(tmp)
+            os.rename(tmp, thumb)
+        return thumb
+
+    def add_text(self, text, fontsize=12):
+        # text may hold reportlab paragraph markup (<b>, <font>), which is
+        # also valid HTML
+        self.elements.append('<p style="font-size:%spt">%s</p>' %
+                             (str(fontsize), text))
+
+    def add_image(self, fname, scale=1):
+        width, height = image_size(fname)
+        width, height = int(width * scale), int(height * scale)
+        src = fname
+        if width > self.max_width:
+            height = int(height * self.max_width / float(width))
+            width = self.max_width
+            if self.thumbnails:
+                src = self._thumbnail(fname, width, height)
+        self.elements.append('<a href="%s"><img src="%s" width="%d" '
+                             'height="%d" loading="lazy" alt="%s"></a>' %
+                             (_escape(self._link(fname)),
+                              _escape(self._link(src)), width, height,
+                              _escape(os.path.split(fname)[1])))
+
+    def add_table(self, data, para=False):
+        rows = []
+        for i, row in enumerate(data):
+            tag = 'th' if i == 0 else 'td'
+            rows.append('<tr>%s</tr>' % ''.join(['<%s>%s</%s>' % (
+                tag, _escape(cell), tag) for cell in row]))
+        self.elements.append('<table>%s</table>' % '\n'.join(rows))
+
+    def add_pagebreak(self):
+        self.elements.append('<hr>')
+
+    def write(self):
+        fp = open(self.report, 'w')
+        try:
+            fp.write('<!DOCTYPE html>\n<html><head><meta charset="utf-8">'
+                     '<title>%s</title>\n<style>\n'
+                     'body {font-family: sans-serif; margin: 2em;}\n'
+                     'table {border-collapse: collapse; margin: 1em 0;}\n'
+                     'td, th {border: 1px solid #000; padding: 2px 6px; '
+                     'text-align: left; vertical-align: top;}\n'
+                     'img {display: block; margin: 0.5em 0;}\n'
+                     '.time {font-size: 10pt;}\n'
+                     '</style></head><body>\n' % _escape(self.title))
+            for element in self.elements:
+                fp.write(element)
+                fp.write('\n')
+            fp.write('</body></html>\n')
+        finally:
+            fp.close()
+        return self.report
@@ -5,7 +5,8 @@ import re
 import tempfile
 from warnings import warn
 from write_report import report
-import sqlite3
+from html_report import html_report
+from metricsdb import QAMetricsDB
 
 try:
     import pyxnat
@@ -33,7 +34,21 @@ class ReportSinkInputSpec(DynamicTraitedSpec, BaseInterfaceInputSpec):
     remove_dest_dir = traits.Bool(False, usedefault=True,
                                   desc='remove dest directory when copying dirs')
     report_name = traits.Str('Report',usedefault=True, desc='Name of report')
+    report_format = traits.Enum('pdf', 'html', usedefault=True,
+                                desc='pdf (reportlab) or html (images referenced by path)')
     json_sink = Directory(desc="place to store json in addition to base_directory")
+    metrics_db = File(desc="SQLite file collecting the QA metrics of all subjects")
+    metrics_db_wal = traits.Bool(False, usedefault=True,
+                                 desc="open metrics_db in WAL mode (needs a "
+                                      "file system with shared memory "
+                                      "support, not NFS)")
+    metrics = traits.Dict(desc="structured QA metrics of this subject, "
+                               "see metricsdb.QAMetricsDB.write_subject")
+    profile_dir = Directory(desc="node profiles written by nodeprofile.py; "
+                                 "the slowest and most memory hungry nodes "
+                                 "of the subject are listed")
+    profile_top = traits.Int(10, usedefault=True,
+                             desc="nodes listed per profile table")
     
     def __setattr__(self, key, value):
         if key not in self.copyable_trait_names():
@@ -122,7 +137,10 @@ Indicates the input fields to be dynamically created
                     raise(inst)
         
         # Begin Report
-        rep = report(os.path.abspath(os.path.join(outdir,self.inputs.report_name+'.pdf')),self.inputs.report_name)
+        if self.inputs.report_format == 'html':
+            rep = html_report(os.path.abspath(os.path.join(outdir,self.inputs.report_name+'.html')),self.inputs.report_name)
+        else:
+            rep = report(os.path.abspath(os.path.join(outdir,self.inputs.report_name+'.pdf')),self.inputs.report_name)
         
         # Loop through all inputs
         #for key, files in self.inputs._outputs.items():
@@ -159,6 +177,21 @@ Indicates the input fields to be dynamically created
                     else:
                         rep.add_text(thing)
         
+        if isdefined(self.inputs.container):
+            subject = self.inputs.container
+        else:
+            subject = self.inputs.report_name
+
+        # resources of the subject's nodes
+        if isdefined(self.inputs.profile_dir):
+            from nodeprofile import subject_records, report_tables
+            tables = report_tables(subject_records(self.inputs.profile_dir,
+                                                   subject),
+                                   self.inputs.profile_top)
+            for title, table in tables:
+                rep.add_text('<b>%s</b>' % title)
+                rep.add_table(table)
+
         # write the report
         rep.write()
         # save json
@@ -171,4 +204,8 @@ Indicates the input fields to be dynamically created
                     os.mkdir(os.path.join(self.inputs.json_sink,self.inputs.container))
                 save_json(os.path.join(self.inputs.json_sink,self.inputs.container, self.inputs.report_name+'.json'), self.inputs._outputs)
         print "json file " , os.path.join(outdir, self.inputs.report_name+'.json')
+        # store structured metrics for cohort queries
+        if isdefined(self.inputs.metrics_db) and isdefined(self.inputs.metrics):
+            QAMetricsDB(self.inputs.metrics_db,
+                        wal=self.inputs.metrics_db_wal).write_subject(subject, self.inputs.metrics)
         return None
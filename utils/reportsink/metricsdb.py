@@ -0,0 +1,253 @@
+"""
+Cohort QA metrics store
+=======================
+
+Structured QA metrics (per-run outlier counts, mean composite norm,
+registration cost, per-ROI TSNR, ...) of every subject in one SQLite file,
+so cohort questions do not require opening each subject's JSON.
+
+Example
+-------
+
+python metricsdb.py qa_metrics.sqlite summary
+python metricsdb.py qa_metrics.sqlite subjects outliers --gt 20
+python metricsdb.py qa_metrics.sqlite rois tsnr
+"""
+import os
+import random
+import sqlite3
+import time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS run_metrics (
+    subject TEXT NOT NULL,
+    run INTEGER NOT NULL,
+    metric TEXT NOT NULL,
+    value REAL,
+    PRIMARY KEY (subject, run, metric));
+CREATE INDEX IF NOT EXISTS run_metrics_metric
+    ON run_metrics (metric, value);
+CREATE TABLE IF NOT EXISTS roi_metrics (
+    subject TEXT NOT NULL,
+    run INTEGER NOT NULL,
+    roi TEXT NOT NULL,
+    metric TEXT NOT NULL,
+    value REAL,
+    PRIMARY KEY (subject, run, roi, metric));
+CREATE INDEX IF NOT EXISTS roi_metrics_roi
+    ON roi_metrics (metric, roi);
+CREATE TABLE IF NOT EXISTS subjects (
+    subject TEXT PRIMARY KEY,
+    updated REAL);
+"""
+
+OPERATORS = {'gt': '>', 'ge': '>=', 'lt': '<', 'le': '<=', 'eq': '='}
+
+
+class QAMetricsDB(object):
+    """SQLite store of cohort QA metrics
+
+    Each subject is written in a single transaction that replaces its
+    previous rows. The database runs in WAL mode with a busy timeout, and
+    writes that still hit a lock are retried with randomized backoff, so
+    many PBS jobs can write to the same file.
+
+    Parameters
+    ----------
+    filename : SQLite database
+    timeout : seconds sqlite waits on a lock before raising. Default = 60
+    retries : number of times a locked write is retried. Default = 10
+    wal : use write-ahead logging. Only for databases on local disks: WAL
+          needs shared memory, which NFS mounts shared by PBS jobs do not
+          provide. When False a database left in WAL mode is switched back
+          to a rollback journal. Default = False
+    """
+
+    def __init__(self, filename, timeout=60., retries=10, wal=False):
+        self.filename = os.path.abspath(filename)
+        self.timeout = timeout
+        self.retries = retries
+        self.wal = wal
+        self._retry(self._create)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.filename, timeout=self.timeout,
+                               isolation_level=None)
+        if self.wal:
+            conn.execute('PRAGMA journal_mode=WAL')
+        else:
+            conn.execute('PRAGMA journal_mode=DELETE')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    def _retry(self, func, *args):
+        for attempt in range(self.retries + 1):
+            try:
+                return func(*args)
+            except sqlite3.OperationalError as e:
+                if ('locked' not in str(e) and 'busy' not in str(e)) or \
+                        attempt == self.retries:
+                    raise
+                time.sleep(random.uniform(0.1, 0.5) * 2 ** min(attempt, 5))
+
+    def _create(self):
+        conn = self._connect()
+        try:
+            conn.executescript(SCHEMA)
+        finally:
+            conn.close()
+
+    def _write(self, subject, runs, rois):
+        conn = self._connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                for table in ['run_metrics', 'roi_metrics', 'subjects']:
+                    conn.execute('DELETE FROM %s WHERE subject = ?' % table,
+                                 (subject,))
+                conn.executemany('INSERT INTO run_metrics VALUES (?,?,?,?)',
+                                 [(subject, run, metric, value)
+                                  for run, metric, value in runs])
+                conn.executemany('INSERT INTO roi_metrics '
+                                 'VALUES (?,?,?,?,?)',
+                                 [(subject, run, roi, metric, value)
+                                  for run, roi, metric, value in rois])
+                conn.execute('INSERT INTO subjects VALUES (?,?)',
+                             (subject, time.time()))
+                conn.execute('COMMIT')
+            except:
+                conn.execute('ROLLBACK')
+                raise
+        finally:
+            conn.close()
+
+    def write_subject(self, subject, metrics):
+        """Replace the metrics of subject
+
+        Parameters
+        ----------
+        subject : subject id
+        metrics : dict with 'runs', a list of {metric: value} dicts (one
+                  per run) and optionally 'rois', a list (one per run) of
+                  {roi: {metric: value}} dicts
+        """
+        runs = []
+        for run, values in enumerate(metrics.get('runs', [])):
+            for metric, value in values.items():
+                runs.append((run, metric, _float(value)))
+        rois = []
+        for run, values in enumerate(metrics.get('rois', [])):
+            for roi, roi_values in values.items():
+                for metric, value in roi_values.items():
+                    rois.append((run, roi, metric, _float(value)))
+        self._retry(self._write, subject, runs, rois)
+
+    def query(self, sql, params=()):
+        """Rows of an arbitrary read-only query"""
+        def _query():
+            conn = self._connect()
+            try:
+                return conn.execute(sql, params).fetchall()
+            finally:
+                conn.close()
+        return self._retry(_query)
+
+    def subjects(self):
+        return [row[0] for row in
+                self.query('SELECT subject FROM subjects ORDER BY subject')]
+
+    def metrics(self):
+        """Names of the per-run and per-ROI metrics in the store"""
+        return ([row[0] for row in self.query(
+                    'SELECT DISTINCT metric FROM run_metrics ORDER BY 1')],
+                [row[0] for row in self.query(
+                    'SELECT DISTINCT metric FROM roi_metrics ORDER BY 1')])
+
+    def subjects_where(self, metric, op, value):
+        """Subjects with any run where metric <op> value
+
+        op is one of gt, ge, lt, le, eq (or the matching symbol)
+        """
+        op = OPERATORS.get(op, op)
+        if op not in OPERATORS.values():
+            raise ValueError('unknown operator %s' % op)
+        return self.query('SELECT subject, run, value FROM run_metrics '
+                          'WHERE metric = ? AND value %s ? '
+                          'ORDER BY subject, run' % op, (metric, value))
+
+    def run_table(self, metric):
+        """(subject, run, value) rows of a per-run metric"""
+        return self.query('SELECT subject, run, value FROM run_metrics '
+                          'WHERE metric = ? ORDER BY subject, run',
+                          (metric,))
+
+    def summary(self):
+        """(metric, runs, mean, min, max) over the cohort"""
+        return self.query('SELECT metric, COUNT(value), AVG(value), '
+                          'MIN(value), MAX(value) FROM run_metrics '
+                          'GROUP BY metric ORDER BY metric')
+
+    def roi_summary(self, metric):
+        """(roi, runs, mean, std, min, max) of a per-ROI metric"""
+        rows = self.query('SELECT roi, COUNT(value), AVG(value), '
+                          'AVG(value * value), MIN(value), MAX(value) '
+                          'FROM roi_metrics WHERE metric = ? '
+                          'GROUP BY roi ORDER BY roi', (metric,))
+        return [(roi, n, mean, max(sq - mean ** 2, 0) ** 0.5, lo, hi)
+                for roi, n, mean, sq, lo, hi in rows]
+
+
+def _float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _print_rows(header, rows):
+    print('\t'.join(header))
+    for row in rows:
+        print('\t'.join([('%.4g' % v) if isinstance(v, float) else str(v)
+                         for v in row]))
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="example: \
+                        python metricsdb.py qa_metrics.sqlite subjects \
+                        outliers --gt 20")
+    parser.add_argument('database', help='QA metrics SQLite file')
+    parser.add_argument('--wal', dest='wal', action='store_true',
+                        help='use write-ahead logging (local disks only)')
+    sub = parser.add_subparsers(dest='command')
+    sub.add_parser('summary', help='cohort summary of the per-run metrics')
+    runs = sub.add_parser('runs', help='per-run values of a metric')
+    runs.add_argument('metric')
+    where = sub.add_parser('subjects', help='subjects with runs where a '
+                                            'metric passes a threshold')
+    where.add_argument('metric')
+    for op in sorted(OPERATORS):
+        where.add_argument('--%s' % op, dest=op, type=float)
+    rois = sub.add_parser('rois', help='per-ROI distribution of a metric')
+    rois.add_argument('metric')
+    args = parser.parse_args()
+
+    if not os.path.exists(args.database):
+        parser.error('%s does not exist' % args.database)
+    db = QAMetricsDB(args.database, wal=args.wal)
+    if args.command == 'summary':
+        _print_rows(['metric', 'runs', 'mean', 'min', 'max'], db.summary())
+    elif args.command == 'runs':
+        _print_rows(['subject', 'run', args.metric],
+                    db.run_table(args.metric))
+    elif args.command == 'subjects':
+        ops = [(op, getattr(args, op)) for op in sorted(OPERATORS)
+               if getattr(args, op) is not None]
+        if len(ops) != 1:
+            parser.error('give exactly one of --%s' %
+                         ', --'.join(sorted(OPERATORS)))
+        _print_rows(['subject', 'run', args.metric],
+                    db.subjects_where(args.metric, ops[0][0], ops[0][1]))
+    elif args.command == 'rois':
+        _print_rows(['roi', 'runs', 'mean', 'std', 'min', 'max'],
+                    db.roi_summary(args.metric))
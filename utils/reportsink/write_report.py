@@ -12,13 +12,22 @@ from reportlab.lib.enums import TA_JUSTIFY, TA_RIGHT
 from reportlab.platypus import Image as Image2
 from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
 from PIL import Image
+from html_report import image_size
 
 
 def get_and_scale(imagefile,scale=1):
     from reportlab.platypus import Image as Image2
-    im1 = scale_im(Image.open(imagefile))
-    im = Image2(imagefile, im1.size[0]*scale, im1.size[1]*scale)  
+    # the display size only needs the header, not the decoded pixels
+    size = fit_size(image_size(imagefile))
+    im = Image2(imagefile, size[0]*scale, size[1]*scale)  
     return im      
+
+def fit_size(size):
+    from numpy import array 
+    # size that fits on the page with various margins...
+    width, height = letter
+    newsize = array(size)/(max(array(size)/array([width-(1*inch), height-(2*inch)])))
+    return tuple(map(lambda x: int(x), tuple(newsize)))
            
 def scale_im(im):
     from numpy import array 
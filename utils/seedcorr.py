@@ -0,0 +1,94 @@
+import numpy as np
+
+
+def normalize_timecourses(data):
+    """Center each row of data and scale it to unit norm
+
+    The dot product of two normalized rows is their Pearson correlation.
+    Constant rows are set to zero, so their correlations are 0 instead of
+    nan.
+    """
+    data = np.asarray(data, dtype=np.float64)
+    data = data - data.mean(axis=-1)[..., None]
+    norm = np.sqrt((data ** 2).sum(axis=-1))
+    norm[norm == 0] = np.inf
+    return data / norm[..., None]
+
+
+def region_means(values, labels, ids=None):
+    """Mean of values over the vertices of each label, via bincount
+
+    Parameters
+    ----------
+    values : (n,) or (k, n) array
+    labels : (n,) integer labels; negative labels are ignored
+    ids : labels to report. Default = all labels >= 0
+
+    Returns
+    -------
+    (len(ids),) or (k, len(ids)) array (nan for empty labels)
+    """
+    labels = np.asarray(labels)
+    values = np.asarray(values, dtype=np.float64)
+    valid = labels >= 0
+    if ids is None:
+        ids = np.unique(labels[valid])
+    ids = np.asarray(ids)
+    length = max(labels.max() if valid.any() else 0, ids.max()) + 1
+    counts = np.bincount(labels[valid], minlength=length).astype(np.float64)
+    counts[counts == 0] = np.nan
+    rows = np.atleast_2d(values)
+    means = np.array([np.bincount(labels[valid], weights=row[valid],
+                                  minlength=length) / counts
+                      for row in rows])[:, ids]
+    if values.ndim == 1:
+        return means[0]
+    return means
+
+
+class SeedConnectivity(object):
+    """Seed to vertex correlations from a single normalization
+
+    Timecourses are normalized once; the correlations of any number of seeds
+    with every vertex are then one matrix product, without building the
+    vertex by vertex correlation matrix.
+
+    Parameters
+    ----------
+    data : (vertices, timepoints) array
+    labels : (vertices,) integer parcellation (e.g. annotation label ids);
+             negative labels are unassigned
+    """
+
+    def __init__(self, data, labels):
+        data = np.asarray(data, dtype=np.float64)
+        self.data = data.reshape(data.shape[0], -1)
+        self.labels = np.asarray(labels)
+        self.normalized = normalize_timecourses(self.data)
+
+    def region_timecourses(self, ids):
+        """Mean timecourse of each label in ids, (len(ids), timepoints)"""
+        return region_means(self.data.T, self.labels, ids).T
+
+    def correlations(self, seeds):
+        """Correlation of each seed timecourse with every vertex
+
+        Parameters
+        ----------
+        seeds : (timepoints,) or (k, timepoints) seed timecourses
+
+        Returns
+        -------
+        (vertices,) or (k, vertices) array
+        """
+        seeds = normalize_timecourses(seeds)
+        return seeds.dot(self.normalized.T)
+
+    def region_correlations(self, ids):
+        """Correlations with every vertex for the mean timecourse of each
+        label in ids, (len(ids), vertices)"""
+        return self.correlations(self.region_timecourses(ids))
+
+    def region_table(self, correlations, ids):
+        """Mean correlation over each label in ids, per seed"""
+        return region_means(correlations, self.labels, ids)
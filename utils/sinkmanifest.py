@@ -0,0 +1,295 @@
+import glob
+import os
+import re
+import sqlite3
+import threading
+import time
+from nipype.interfaces.base import isdefined
+from imagemeta import prime
+import nipype.interfaces.io as nio
+
+
+def glob_to_regex(pattern):
+    """Translate a shell glob into a regular expression
+
+    Like glob.glob, '*' and '?' do not match across directories.
+    """
+    i, n = 0, len(pattern)
+    res = ''
+    while i < n:
+        char = pattern[i]
+        i += 1
+        if char == '*':
+            res += '[^/]*'
+        elif char == '?':
+            res += '[^/]'
+        elif char == '[':
+            j = pattern.find(']', i + 1 if pattern[i:i + 1] in ('!', ']')
+                             else i)
+            if j == -1:
+                res += '\\['
+            else:
+                stuff = pattern[i:j].replace('\\', '\\\\')
+                i = j + 1
+                if stuff[0] == '!':
+                    stuff = '^' + stuff[1:]
+                elif stuff[0] == '^':
+                    stuff = '\\' + stuff
+                res += '[%s]' % stuff
+        else:
+            res += re.escape(char)
+    return re.compile(res + '$')
+
+
+class SinkManifest(object):
+    """SQLite index of the directory listings below a sink base directory
+
+    The index lives in the base directory and keeps the entries of every
+    directory it has listed, with the directory's modification time, so
+    DataGrabber-style queries can be answered without listing the tree. A
+    listing is only used while the directory's mtime is unchanged (adding,
+    removing or renaming an entry changes it); otherwise the directory is
+    listed again. Listings taken within `racy` seconds of the directory's
+    last change are not trusted, since a coarse mtime may miss a change
+    made in the same tick.
+
+    Parameters
+    ----------
+    base_directory : DataSink base directory, e.g. sink_dir/analyses/func
+    filename : name of the index file inside base_directory
+    racy : seconds. Default = 2
+    """
+
+    def __init__(self, base_directory, filename='.manifest.sqlite', racy=2.):
+        self.base_directory = os.path.abspath(base_directory)
+        self.filename = os.path.join(self.base_directory, filename)
+        self.racy = racy
+
+    def _connect(self):
+        if not os.path.exists(self.base_directory):
+            os.makedirs(self.base_directory)
+        conn = sqlite3.connect(self.filename, timeout=60)
+        # keep the journal file, creating and deleting it on every write
+        # would change the mtime of base_directory
+        conn.execute('PRAGMA journal_mode=PERSIST')
+        conn.execute('CREATE TABLE IF NOT EXISTS dirs '
+                     '(path TEXT PRIMARY KEY, container TEXT, mtime REAL, '
+                     'listed REAL)')
+        conn.execute('CREATE TABLE IF NOT EXISTS entries '
+                     '(dir TEXT, name TEXT, isdir INTEGER, '
+                     'PRIMARY KEY (dir, name))')
+        conn.execute('CREATE INDEX IF NOT EXISTS dirs_container '
+                     'ON dirs (container)')
+        return conn
+
+    def _relpath(self, path):
+        """Path relative to base_directory, '' for base_directory itself,
+        or None if outside it"""
+        rel = os.path.relpath(os.path.abspath(path), self.base_directory)
+        if rel == os.curdir:
+            return ''
+        if rel.startswith(os.pardir):
+            return None
+        return rel.replace(os.sep, '/')
+
+    def _abspath(self, rel):
+        return os.path.join(self.base_directory, *rel.split('/'))
+
+    def _list(self, conn, rel):
+        """Entries (name, isdir) of a directory, listed from disk and
+        stored in the index"""
+        path = self._abspath(rel)
+        try:
+            mtime = os.stat(path).st_mtime
+            names = os.listdir(path)
+        except OSError:
+            return []
+        entries = [(name, int(os.path.isdir(os.path.join(path, name))))
+                   for name in names
+                   if rel or
+                   not name.startswith(os.path.basename(self.filename))]
+        with conn:
+            conn.execute('DELETE FROM entries WHERE dir = ?', (rel,))
+            conn.executemany('INSERT INTO entries VALUES (?, ?, ?)',
+                             [(rel, name, isdir) for name, isdir in entries])
+            conn.execute('INSERT OR REPLACE INTO dirs VALUES (?, ?, ?, ?)',
+                         (rel, rel.split('/')[0], mtime, time.time()))
+        return entries
+
+    def listing(self, conn, rel):
+        """Entries (name, isdir) of a directory, from the index if its
+        listing there is still valid"""
+        try:
+            mtime = os.stat(self._abspath(rel)).st_mtime
+        except OSError:
+            return []
+        row = conn.execute('SELECT mtime, listed FROM dirs WHERE path = ?',
+                           (rel,)).fetchone()
+        if row is None or row[0] != mtime or row[1] - row[0] < self.racy:
+            return self._list(conn, rel)
+        return conn.execute('SELECT name, isdir FROM entries WHERE dir = ?',
+                            (rel,)).fetchall()
+
+    def add(self, paths):
+        """Index the directories of files, and all directories below
+        directories, in paths"""
+        dirs = set()
+        for path in paths:
+            if os.path.isdir(path):
+                for root, _, _ in os.walk(path):
+                    dirs.add(root)
+            else:
+                dirs.add(os.path.dirname(os.path.abspath(path)))
+        dirs = [self._relpath(d) for d in dirs]
+        dirs = [d for d in dirs if d is not None]
+        if not dirs:
+            return 0
+        conn = self._connect()
+        try:
+            for rel in dirs:
+                self._list(conn, rel)
+        finally:
+            conn.close()
+        return len(dirs)
+
+    def update(self, container):
+        """Re-index everything below one container from disk"""
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute('DELETE FROM entries WHERE dir IN (SELECT path '
+                             'FROM dirs WHERE container = ?)', (container,))
+                conn.execute('DELETE FROM dirs WHERE container = ?',
+                             (container,))
+        finally:
+            conn.close()
+        return self.add([os.path.join(self.base_directory, container)])
+
+    def glob(self, pattern):
+        """Return the files matching a glob pattern
+
+        Directories are only listed from disk if their indexed listing is
+        missing or out of date. Returns None if pattern does not point
+        inside base_directory.
+        """
+        rel = self._relpath(pattern)
+        if not rel:
+            return None
+        parts = rel.split('/')
+        conn = self._connect()
+        try:
+            level = ['']
+            for i, part in enumerate(parts):
+                last = i == len(parts) - 1
+                if not last and not re.search(r'[*?[]', part):
+                    level = ['/'.join([d, part]).lstrip('/') for d in level]
+                    continue
+                regex = glob_to_regex(part)
+                matched = []
+                for d in level:
+                    for name, isdir in self.listing(conn, d):
+                        if (last or isdir) and regex.match(name) and \
+                                (part.startswith('.') or
+                                 not name.startswith('.')):
+                            matched.append('/'.join([d, name]).lstrip('/'))
+                level = matched
+        finally:
+            conn.close()
+        files = [self._abspath(f) for f in level]
+        return [f for f in files if os.path.exists(f)]
+
+
+class ManifestDataSink(nio.DataSink):
+    """DataSink that records the files it writes in a SinkManifest
+
+    Parameters
+    ----------
+    manifest : Boolean
+               True to update the manifest in base_directory after sinking
+    """
+
+    def __init__(self, manifest=True, **kwargs):
+        super(ManifestDataSink, self).__init__(**kwargs)
+        self._manifest = manifest
+        self._written = None
+
+    def _record(self, pathstr):
+        if self._written is not None:
+            self._written.append(pathstr)
+        return pathstr
+
+    def _substitute(self, pathstr):
+        return self._record(super(ManifestDataSink, self)._substitute(pathstr))
+
+    def _list_outputs(self):
+        self._written = []
+        try:
+            outputs = super(ManifestDataSink, self)._list_outputs()
+            if self._manifest and isdefined(self.inputs.base_directory):
+                SinkManifest(self.inputs.base_directory).add(self._written)
+        finally:
+            self._written = None
+        return outputs
+
+
+class _GlobHook(object):
+    """Stands in for the glob module of nipype.interfaces.io
+
+    DataGrabber._list_outputs calls glob.glob; while a ManifestDataGrabber
+    lists its outputs in this thread, those calls go to its _glob instead.
+    Everything else is the glob module.
+    """
+
+    def __init__(self, module):
+        self._module = module
+        self._local = threading.local()
+
+    @property
+    def func(self):
+        return getattr(self._local, 'func', None)
+
+    @func.setter
+    def func(self, func):
+        self._local.func = func
+
+    def glob(self, pattern):
+        if self.func is None:
+            return self._module.glob(pattern)
+        return self.func(pattern)
+
+    def __getattr__(self, name):
+        return getattr(self._module, name)
+
+
+if not isinstance(nio.glob, _GlobHook):
+    nio.glob = _GlobHook(nio.glob)
+_glob_hook = nio.glob
+
+
+class ManifestDataGrabber(nio.DataGrabber):
+    """DataGrabber that answers its templates from a SinkManifest
+
+    Takes the same infields/outfields, template, field_template and
+    template_args as DataGrabber. Templates inside base_directory are
+    matched against the manifest, which lists a directory again only when
+    it changed since it was indexed; other templates use glob.glob. The
+    headers of grabbed NIfTI images are cached with imagemeta, so downstream
+    shape and affine queries do not have to open the images.
+    """
+
+    def _glob(self, template):
+        files = None
+        if isdefined(self.inputs.base_directory):
+            files = SinkManifest(self.inputs.base_directory).glob(template)
+        if files is None:
+            files = glob.glob(template)
+        return files
+
+    def _list_outputs(self):
+        _glob_hook.func = self._glob
+        try:
+            outputs = super(ManifestDataGrabber, self)._list_outputs()
+        finally:
+            _glob_hook.func = None
+        prime(list(outputs.values()))
+        return outputs
@@ -0,0 +1,241 @@
+"""
+Stacked first level GLM
+=======================
+
+Ordinary least squares fit of the block design runs of a whole cohort, used
+by fmri/task/first_level.py when c.stacked_glm is True.
+"""
+
+
+def stacked_glm(subjects, design_files, con_files, in_files, threshold,
+                task_regressors, chunk_size=200000, conditions=None):
+    """Fit first level models for a whole cohort by ordinary least squares
+
+    The columns of a FEAT design are the task regressors followed by the
+    run's own motion, noise and outlier regressors. Runs whose task
+    regressors are identical (same timings, to 6 decimals) form a group:
+    the above-threshold voxels of every run in a group are stacked and
+    projected on the shared task regressors with a single matrix product,
+    while the products with the nuisance regressors, the normal equations
+    and the residuals are computed run by run, so every run gets the fit of
+    its full design. Unlike FILMGLS no prewhitening is done.
+
+    Parameters
+    ----------
+    subjects : list of subject ids
+    design_files : FEAT design matrices (.mat), one list per subject
+    con_files : FEAT t-contrast files (.con), one list per subject
+    in_files : highpassed functional runs, one list per subject
+    threshold : minimum mean intensity of a voxel to be fit
+    task_regressors : number of task regressors (the leading design
+                      columns) of every run, one list (or int) per subject
+    chunk_size : maximum number of voxels solved at once, runs with more
+                 voxels are split
+    conditions : condition names, one list per subject. The estimates of
+                 the task regressors are then named pe<i>_<condition>, as
+                 in the first level sink. Default = None (pe<i>)
+
+    Returns
+    -------
+    out_files : parameter estimates (pe<i>), residual variance
+                (sigmasquareds), dof and contrast images
+                (cope<i>_<contrast>, varcope, tstat, zstat), written to
+                _subject_<id>/_run<k>/ in the working directory
+    groups : runs fit together, as lists of '<subject>/run<k>'
+    """
+    import os
+    import re
+    import numpy as np
+    import nibabel as nb
+    from scipy import stats, special
+
+    def as_list(files):
+        if isinstance(files, list):
+            return files
+        return [files]
+
+    def run_number(fname):
+        # _highpass<k>/ of a functional run, run<k>.mat/.con of a design
+        num = re.findall('/_highpass([0-9]+)/', fname) or \
+            re.findall('run([0-9]+)', os.path.basename(fname))
+        return int(num[-1]) if num else fname
+
+    def read_fsl(fname):
+        names = []
+        rows = []
+        in_matrix = False
+        for line in open(fname):
+            line = line.strip()
+            if line.startswith('/ContrastName'):
+                parts = line.split(None, 1)
+                names.append(parts[1] if len(parts) > 1 else '')
+            elif line.startswith('/Matrix'):
+                in_matrix = True
+            elif in_matrix and line:
+                rows.append([float(x) for x in line.split()])
+        return np.atleast_2d(np.array(rows)), names
+
+    def t_to_z(tstat, dof):
+        # in log space: t.sf underflows to 0 (and z to inf) for large t
+        abs_t = np.abs(tstat)
+        logp = stats.t.logsf(abs_t, dof)
+        far = ~np.isfinite(logp)
+        if far.any():
+            # leading term of the incomplete beta tail, logsf is -inf too
+            x = dof / (dof + abs_t[far].astype(np.float64) ** 2)
+            logp[far] = np.log(0.5) + dof / 2. * np.log(x) + \
+                0.5 * np.log1p(-x) - np.log(dof / 2.) - \
+                special.betaln(dof / 2., 0.5)
+        if hasattr(special, 'ndtri_exp'):
+            z = -special.ndtri_exp(logp)
+        else:
+            z = stats.norm.isf(np.exp(logp))
+            big = ~np.isfinite(z)
+            # asymptotic inverse of the normal tail
+            zb = np.sqrt(-2 * logp[big])
+            for i in range(4):
+                zb = np.sqrt(-2 * (logp[big] + np.log(zb * np.sqrt(2 * np.pi))))
+            z[big] = zb
+        return np.sign(tstat) * z
+
+    # single subjects come out of the DataGrabber unnested
+    if len(subjects) == 1:
+        design_files = [design_files]
+        con_files = [con_files]
+        in_files = [in_files]
+
+    runs = []
+    groups = {}
+    order = []
+    if conditions is None:
+        conditions = [[] for subject in subjects]
+    for subject, designs, cons, funcs, n_task, names in zip(
+            subjects, design_files, con_files, in_files, task_regressors,
+            conditions):
+        designs = sorted(as_list(designs), key=run_number)
+        cons = sorted(as_list(cons), key=run_number)
+        funcs = sorted(as_list(funcs), key=run_number)
+        if not len(designs) == len(cons) == len(funcs):
+            raise ValueError('%s has %d designs, %d contrast files and %d '
+                             'functional runs' % (subject, len(designs),
+                                                  len(cons), len(funcs)))
+        n_task = as_list(n_task)
+        if len(n_task) == 1:
+            n_task = n_task * len(designs)
+        for k, design in enumerate(designs):
+            X = read_fsl(design)[0]
+            key = tuple(map(tuple, np.round(X[:, :n_task[k]], 6)))
+            if key not in groups:
+                groups[key] = []
+                order.append(key)
+            groups[key].append(len(runs))
+            runs.append({'subject': subject, 'run': k, 'X': X,
+                         'n_task': n_task[k], 'conditions': names,
+                         'con_file': cons[k],
+                         'in_file': funcs[k]})
+
+    out_files = []
+
+    def save(values, mask, affine, fname):
+        vol = np.zeros(mask.shape, dtype=np.float32)
+        vol[mask] = values
+        nb.Nifti1Image(vol, affine).to_filename(fname)
+        out_files.append(fname)
+
+    def load(run):
+        img = nb.load(run['in_file'])
+        data = img.get_data()
+        mask = data.mean(axis=3) > threshold
+        Y = data[mask].T.astype(np.float64)
+        Y -= Y.mean(axis=0)
+        X = run['X']
+        P = np.linalg.pinv(X)
+        run.update({'mask': mask, 'affine': img.get_affine(), 'Y': Y,
+                    'N': X[:, run['n_task']:],
+                    'XtXi': P.dot(P.T),
+                    'dof': X.shape[0] - np.linalg.matrix_rank(X),
+                    'B': np.zeros((X.shape[1], Y.shape[1])),
+                    's2': np.zeros(Y.shape[1]),
+                    'left': Y.shape[1]})
+
+    def scatter(run):
+        mask, affine, B, s2 = run['mask'], run['affine'], run['B'], run['s2']
+        dof = run['dof']
+        out_dir = os.path.abspath(os.path.join('_subject_%s' % run['subject'],
+                                               '_run%d' % run['run']))
+        if not os.path.exists(out_dir):
+            os.makedirs(out_dir)
+        for i in range(B.shape[0]):
+            if i < len(run['conditions']):
+                pe = 'pe%02d_%s.nii.gz' % (i + 1, run['conditions'][i])
+            else:
+                pe = 'pe%02d.nii.gz' % (i + 1)
+            save(B[i], mask, affine, os.path.join(out_dir, pe))
+        save(s2, mask, affine, os.path.join(out_dir, 'sigmasquareds.nii.gz'))
+        dof_file = os.path.join(out_dir, 'dof')
+        open(dof_file, 'w').write('%d\n' % dof)
+        out_files.append(dof_file)
+        C, names = read_fsl(run['con_file'])
+        for i, con in enumerate(C):
+            if i < len(names) and names[i]:
+                label = '%02d_%s' % (i + 1, names[i])
+            else:
+                label = '%02d' % (i + 1)
+            cope = con.dot(B)
+            varcope = con.dot(run['XtXi']).dot(con) * s2
+            tstat = np.zeros_like(cope)
+            good = varcope > 0
+            tstat[good] = cope[good] / np.sqrt(varcope[good])
+            zstat = t_to_z(tstat, max(dof, 1))
+            for stat, values in [('cope', cope), ('varcope', varcope),
+                                 ('tstat', tstat), ('zstat', zstat)]:
+                save(values, mask, affine,
+                     os.path.join(out_dir, '%s%s.nii.gz' % (stat, label)))
+        for key in ['mask', 'Y', 'N', 'B', 's2']:
+            del run[key]
+
+    def solve(T, pieces):
+        # pieces are (run, first voxel, last voxel + 1)
+        Y = np.hstack([run['Y'][:, a:b] for run, a, b in pieces])
+        TtY = T.T.dot(Y)
+        start = 0
+        for run, a, b in pieces:
+            stop = start + b - a
+            Yp = Y[:, start:stop]
+            XtY = np.vstack([TtY[:, start:stop], run['N'].T.dot(Yp)])
+            B = run['XtXi'].dot(XtY)
+            run['B'][:, a:b] = B
+            run['s2'][a:b] = ((Yp - run['X'].dot(B)) ** 2).sum(axis=0) / \
+                max(run['dof'], 1)
+            run['left'] -= b - a
+            if not run['left']:
+                scatter(run)
+            start = stop
+
+    for key in order:
+        members = groups[key]
+        T = runs[members[0]]['X'][:, :runs[members[0]]['n_task']]
+        pieces = []
+        size = 0
+        for idx in members:
+            run = runs[idx]
+            load(run)
+            n_voxels = run['left']
+            if not n_voxels:
+                scatter(run)
+            start = 0
+            while start < n_voxels:
+                stop = min(n_voxels, start + chunk_size - size)
+                pieces.append((run, start, stop))
+                size += stop - start
+                start = stop
+                if size >= chunk_size:
+                    solve(T, pieces)
+                    pieces = []
+                    size = 0
+        if pieces:
+            solve(T, pieces)
+
+    groups = [['%s/run%d' % (runs[idx]['subject'], runs[idx]['run'])
+               for idx in groups[key]] for key in order]
+    return out_files, groups
@@ -0,0 +1,126 @@
+import hashlib
+import json
+import os
+import shutil
+import time
+
+OUTPUTS = ['warp_field', 'affine_transformation', 'inverse_warp',
+           'unwarped_brain', 'warped_brain']
+MANIFEST = 'outputs.json'
+
+
+def file_hash(filename, blocksize=1 << 20):
+    """md5 of the contents of a file, read blocksize bytes at a time"""
+    md5 = hashlib.md5()
+    fp = open(filename, 'rb')
+    try:
+        while True:
+            block = fp.read(blocksize)
+            if not block:
+                break
+            md5.update(block)
+    finally:
+        fp.close()
+    return md5.hexdigest()
+
+
+def cache_key(subject_id, brain, segmentation, template_file):
+    """Key of a structural normalization
+
+    The subject and the contents of the brain (orig.mgz), segmentation
+    (aparc+aseg.mgz) and template, so a rerun of recon-all or a different
+    template gives a new entry.
+    """
+    md5 = hashlib.md5()
+    md5.update(str(subject_id).encode('utf-8'))
+    for filename in [brain, segmentation, template_file]:
+        md5.update(file_hash(filename).encode('utf-8'))
+    return md5.hexdigest()
+
+
+def cache_path(cache_dir, subject_id, key):
+    return os.path.join(cache_dir, str(subject_id), 'struct_norm', key)
+
+
+def lookup(path):
+    """Cached outputs stored in path, or None if there are none
+
+    Returns
+    -------
+    dict : output name -> file
+    """
+    manifest = os.path.join(path, MANIFEST)
+    if not os.path.exists(manifest):
+        return None
+    fp = open(manifest)
+    try:
+        names = json.load(fp)
+    finally:
+        fp.close()
+    outputs = dict([(name, os.path.join(path, fname))
+                    for name, fname in names.items()])
+    for fname in outputs.values():
+        if not os.path.exists(fname):
+            return None
+    return outputs
+
+
+def store(path, outputs):
+    """Copy outputs (output name -> file) into path
+
+    Files are copied into a temporary directory that is renamed to path
+    once the manifest is written, so readers never see a partial entry.
+    """
+    tmp_dir = '%s.%d.tmp' % (path, os.getpid())
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+    names = {}
+    for name in OUTPUTS:
+        fname = os.path.split(outputs[name])[1]
+        shutil.copyfile(outputs[name], os.path.join(tmp_dir, fname))
+        names[name] = fname
+    fp = open(os.path.join(tmp_dir, MANIFEST), 'w')
+    try:
+        json.dump(names, fp, indent=1)
+    finally:
+        fp.close()
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.rename(tmp_dir, path)
+    return lookup(path)
+
+
+def acquire(path, timeout=6 * 3600, poll=30):
+    """Take the lock of a cache entry, waiting while another job holds it
+
+    A lock older than timeout seconds is assumed to be left over by a job
+    that died and is broken.
+    """
+    lock = path + '.lock'
+    parent = os.path.dirname(lock)
+    if not os.path.exists(parent):
+        try:
+            os.makedirs(parent)
+        except OSError:
+            pass
+    while True:
+        try:
+            os.mkdir(lock)
+            return lock
+        except OSError:
+            try:
+                age = time.time() - os.stat(lock).st_mtime
+            except OSError:
+                continue
+            if age > timeout:
+                release(lock)
+            else:
+                time.sleep(poll)
+
+
+def release(lock):
+    try:
+        os.rmdir(lock)
+    except OSError:
+        pass
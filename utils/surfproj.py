@@ -0,0 +1,160 @@
+import logging
+import os
+import subprocess
+import time
+iflogger = logging.getLogger('interface')
+
+VOL2SURF_ENV = 'BIPS_VOL2SURF'
+# part of the figure cache key of surface plots: change it whenever the
+# projection or SurfaceRenderer draws differently
+PLOT_VERSION = '1'
+
+
+def vol2surf_command(mov, out_file, reg, hemi='lh', ref=None,
+                     trgsubject=None, sd=None, out_type='mgh',
+                     projfrac=None, projfrac_max=(0, 1, 0.1),
+                     interp=None):
+    """Argument list of an mri_vol2surf call
+
+    The executable is mri_vol2surf, or BIPS_VOL2SURF if it is set (e.g. a
+    stand-in projection script).
+    """
+    cmd = [os.environ.get(VOL2SURF_ENV, 'mri_vol2surf'), '--mov', mov,
+           '--reg', reg, '--hemi', hemi]
+    if ref is not None:
+        cmd += ['--ref', ref]
+    if trgsubject is not None:
+        cmd += ['--trgsubject', trgsubject]
+    if projfrac is not None:
+        cmd += ['--projfrac', str(projfrac)]
+    elif projfrac_max is not None:
+        cmd += ['--projfrac-max'] + [str(p) for p in projfrac_max]
+    if interp is not None:
+        cmd += ['--interp', interp]
+    cmd += ['--o', out_file, '--out_type', out_type]
+    if sd is not None:
+        cmd += ['--sd', sd]
+    return cmd
+
+
+def _run(cmd):
+    t0 = time.time()
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT)
+    output = proc.communicate()[0]
+    return dict(command=' '.join(cmd), returncode=proc.returncode,
+                elapsed=time.time() - t0,
+                output=output.decode('utf-8', 'replace'))
+
+
+def run_commands(commands, workers=None):
+    """Run argument lists in a bounded pool of subprocesses
+
+    At most workers commands run at once (default: number of cpus, but no
+    more than the number of commands). Threads only wait on the child
+    processes, so this also works inside daemonic pipeline workers.
+
+    Returns
+    -------
+    list of dicts with command, returncode, elapsed (seconds) and output
+    (stdout and stderr), in the order of commands
+    """
+    if not commands:
+        return []
+    if workers is None:
+        try:
+            from multiprocessing import cpu_count
+            workers = cpu_count()
+        except NotImplementedError:
+            workers = 1
+    workers = max(1, min(workers, len(commands)))
+    if workers == 1:
+        return [_run(cmd) for cmd in commands]
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(workers)
+    try:
+        return pool.map(_run, commands)
+    finally:
+        pool.close()
+
+
+def project_volumes(jobs, workers=None, **kwargs):
+    """Project (volume, reg_file, out_file) jobs to the surface
+
+    Remaining keyword arguments are passed to vol2surf_command. Raises
+    RuntimeError with the command's output if any projection fails.
+
+    Returns
+    -------
+    out_files, results (see run_commands)
+    """
+    commands = [vol2surf_command(mov, out_file, reg, **kwargs)
+                for mov, reg, out_file in jobs]
+    results = run_commands(commands, workers)
+    for result in results:
+        iflogger.debug('%s: exit %d in %.1f s' % (result['command'],
+                                                  result['returncode'],
+                                                  result['elapsed']))
+        if result['returncode'] != 0:
+            raise RuntimeError('%s failed with exit code %d:\n%s' % (
+                result['command'], result['returncode'], result['output']))
+    return [out_file for _, _, out_file in jobs], results
+
+
+class SurfaceRenderer(object):
+    """Off-screen PySurfer renderer that keeps one surface loaded
+
+    The Brain (and its mesh) is created on the first render; every later
+    overlay replaces the previous one on the same figure, so a subject's
+    surface is loaded once instead of once per image.
+
+    Parameters
+    ----------
+    subject_id : FreeSurfer subject
+    hemi : hemisphere. Default = 'lh'
+    surface : surface to display. Default = 'inflated'
+    subjects_dir : optional FreeSurfer subjects directory
+    """
+
+    def __init__(self, subject_id, hemi='lh', surface='inflated',
+                 subjects_dir=None):
+        self.subject_id = subject_id
+        self.hemi = hemi
+        self.surface = surface
+        self.subjects_dir = subjects_dir
+        self._brain = None
+
+    @property
+    def brain(self):
+        if self._brain is None:
+            from mayavi import mlab
+            mlab.options.offscreen = True
+            from surfer import Brain
+            if self.subjects_dir is not None:
+                os.environ['SUBJECTS_DIR'] = self.subjects_dir
+            self._brain = Brain(self.subject_id, self.hemi, self.surface)
+        return self._brain
+
+    def _clear(self):
+        overlays = getattr(self._brain, 'overlays', {})
+        for name in list(overlays):
+            try:
+                overlays.pop(name).remove()
+            except Exception:
+                pass
+
+    def render(self, overlay, out_file, thr, **kwargs):
+        """Save a montage of overlay (thresholded at thr) to out_file"""
+        brain = self.brain
+        self._clear()
+        brain.add_overlay(overlay, min=thr, name='overlay', **kwargs)
+        brain.save_montage(out_file)
+        return out_file
+
+    def close(self):
+        if self._brain is not None:
+            try:
+                self._brain.close()
+            except Exception:
+                pass
+            self._brain = None
@@ -0,0 +1,176 @@
+import numpy as np
+
+# tensor elements in the order of the design matrix columns
+TENSOR_ELEMENTS = [(0, 0), (1, 1), (2, 2), (0, 1), (0, 2), (1, 2)]
+
+
+def read_bvals_bvecs(bval_file, bvec_file):
+    """b-values (n,) and unit gradient directions (n, 3) of FSL text files
+
+    bvecs may be stored as 3 rows (FSL) or 3 columns.
+    """
+    bvals = np.loadtxt(bval_file, dtype=np.float64).ravel()
+    bvecs = np.loadtxt(bvec_file, dtype=np.float64)
+    if bvecs.shape[0] == 3 and bvecs.shape[1] != 3:
+        bvecs = bvecs.T
+    elif bvecs.shape == (3, 3):
+        bvecs = bvecs.T
+    if bvecs.shape != (len(bvals), 3):
+        raise ValueError('%s does not match the %d b-values of %s' %
+                         (bvec_file, len(bvals), bval_file))
+    norm = np.sqrt((bvecs ** 2).sum(axis=1))
+    norm[norm == 0] = 1
+    return bvals, bvecs / norm[:, None]
+
+
+def design_matrix(bvals, bvecs):
+    """b-matrix of the log-linear tensor model
+
+    log(S) = B . [Dxx, Dyy, Dzz, Dxy, Dxz, Dyz, log(S0)]
+
+    Returns
+    -------
+    (n, 7) array
+    """
+    bvals = np.asarray(bvals, dtype=np.float64)
+    g = np.asarray(bvecs, dtype=np.float64)
+    B = np.empty((len(bvals), 7))
+    for col, (i, j) in enumerate(TENSOR_ELEMENTS):
+        factor = 1. if i == j else 2.
+        B[:, col] = -factor * bvals * g[:, i] * g[:, j]
+    B[:, 6] = 1.
+    return B
+
+
+def fit_tensors(signal, design, iterations=1, min_signal=1.):
+    """Fit diffusion tensors to many voxels at once
+
+    An ordinary least squares fit of the log signal (one pseudoinverse of
+    the design matrix for all voxels) is refined by iterations of weighted
+    least squares with weights exp(2 * predicted log signal). Each
+    iteration solves the weighted normal equations of every voxel as one
+    batched linear solve.
+
+    Parameters
+    ----------
+    signal : (voxels, n) diffusion weighted signal
+    design : (n, 7) design matrix (see design_matrix)
+    iterations : weighted least squares iterations. Default = 1 (0 = OLS)
+    min_signal : signal values are clipped to at least this before the log
+
+    Returns
+    -------
+    (voxels, 7) array of Dxx, Dyy, Dzz, Dxy, Dxz, Dyz, log(S0)
+    """
+    log_signal = np.log(np.maximum(np.asarray(signal, dtype=np.float64),
+                                   min_signal))
+    params = log_signal.dot(np.linalg.pinv(design).T)
+    # outer products of the design rows, so the weighted normal matrices of
+    # all voxels are one matrix product
+    outer = (design[:, :, None] * design[:, None, :]).reshape(len(design), -1)
+    for _ in range(iterations):
+        weights = np.exp(2 * params.dot(design.T))
+        normal = weights.dot(outer).reshape(-1, 7, 7)
+        rhs = (weights * log_signal).dot(design)
+        params = np.linalg.solve(normal, rhs[..., None])[..., 0]
+    return params
+
+
+def tensor_matrices(params):
+    """(voxels, 3, 3) symmetric tensors of fit_tensors parameters"""
+    params = np.asarray(params)
+    D = np.empty((len(params), 3, 3))
+    for col, (i, j) in enumerate(TENSOR_ELEMENTS):
+        D[:, i, j] = params[:, col]
+        D[:, j, i] = params[:, col]
+    return D
+
+
+def tensor_maps(params):
+    """Eigen decomposition and scalar maps of fitted tensors
+
+    Returns
+    -------
+    dict : FA, MD, S0 (voxels,), L (voxels, 3) eigenvalues in decreasing
+           order and V (voxels, 3, 3) with the matching eigenvectors in the
+           last axis (V[:, :, 0] is the principal direction)
+    """
+    evals, evecs = np.linalg.eigh(tensor_matrices(params))
+    evals, evecs = evals[:, ::-1], evecs[:, :, ::-1]
+    md = evals.mean(axis=1)
+    num = np.sqrt(((evals - md[:, None]) ** 2).sum(axis=1))
+    den = np.sqrt((evals ** 2).sum(axis=1))
+    den[den == 0] = np.inf
+    fa = np.sqrt(1.5) * num / den
+    return {'FA': fa, 'MD': md, 'L': evals, 'V': evecs,
+            'S0': np.exp(params[:, 6])}
+
+
+def fit_image(dwi_file, bval_file, bvec_file, mask_file, base_name,
+              out_dir='.', ext='.nii', iterations=1, chunk_size=20000):
+    """Native replacement for fsl dtifit
+
+    The design matrix is built once; in-mask voxels are read and fitted
+    a slab of slices at a time, about chunk_size voxels per slab, so memory
+    does not grow with the size of the image.
+
+    Parameters
+    ----------
+    dwi_file : 4D diffusion weighted image
+    bval_file, bvec_file : FSL bvals and bvecs
+    mask_file : brain mask
+    base_name : output prefix, as dtifit's --out
+    out_dir : output directory. Default = '.'
+    ext : output extension. Default = '.nii'
+    iterations : weighted least squares iterations. Default = 1
+    chunk_size : voxels fitted together. Default = 20000
+
+    Returns
+    -------
+    dict : FA, MD, S0, L1-L3 and V1-V3 output files (dtifit names)
+    """
+    import os
+    import nibabel as nb
+    bvals, bvecs = read_bvals_bvecs(bval_file, bvec_file)
+    design = design_matrix(bvals, bvecs)
+    img = nb.load(dwi_file)
+    data = img.get_data()
+    shape = data.shape[:3]
+    if data.shape[3] != len(bvals):
+        raise ValueError('%s has %d volumes but there are %d b-values' %
+                         (dwi_file, data.shape[3], len(bvals)))
+    mask = nb.load(mask_file).get_data().reshape(shape) > 0
+
+    maps = {}
+    for name in ['FA', 'MD', 'S0', 'L1', 'L2', 'L3']:
+        maps[name] = np.zeros(shape, np.float32)
+    for name in ['V1', 'V2', 'V3']:
+        maps[name] = np.zeros(shape + (3,), np.float32)
+
+    slab = max(1, int(chunk_size // max(1, shape[0] * shape[1])))
+    for z in range(0, shape[2], slab):
+        slab_mask = mask[:, :, z:z + slab]
+        if not slab_mask.any():
+            continue
+        signal = np.asarray(data[:, :, z:z + slab], dtype=np.float64)
+        result = tensor_maps(fit_tensors(signal[slab_mask], design,
+                                         iterations))
+        for name in ['FA', 'MD', 'S0']:
+            maps[name][:, :, z:z + slab][slab_mask] = result[name]
+        for i in range(3):
+            maps['L%d' % (i + 1)][:, :, z:z + slab][slab_mask] = \
+                result['L'][:, i]
+            maps['V%d' % (i + 1)][:, :, z:z + slab][slab_mask] = \
+                result['V'][:, :, i]
+
+    affine, header = img.get_affine(), img.get_header()
+    out_files = {}
+    for name, values in maps.items():
+        out_file = os.path.abspath(os.path.join(out_dir, '%s_%s%s' % (
+            base_name, name, ext)))
+        out = nb.Nifti1Image(values, affine)
+        out.get_header().set_zooms(tuple(header.get_zooms()[:3]) +
+                                   (1.,) * (values.ndim - 3))
+        out.to_filename(out_file)
+        out_files[name] = out_file
+    return out_files
@@ -0,0 +1,163 @@
+import gzip
+import numpy as np
+from imagemeta import read_nifti_header
+
+METRICS = ['volume_means', 'volume_mean_diff2', 'slice_mean_diff2',
+           'diff2_mean_vol', 'slice_diff2_max_vol']
+# part of the figure cache key of tsdiff plots: change it whenever
+# plot_tsdiffs draws differently
+PLOT_VERSION = '1'
+
+
+def iter_volumes(filename):
+    """Yield the volumes of a 4D image one at a time as float arrays
+
+    NIfTI-1 images (.nii, .nii.gz) are read frame by frame from the file, so
+    only one volume is held in memory. Other formats are loaded with
+    nibabel.
+    """
+    info = None
+    if filename.endswith('.nii') or filename.endswith('.nii.gz'):
+        info = read_nifti_header(filename)
+    try:
+        dtype = np.dtype(info['dtype']).newbyteorder(info['byteorder'])
+    except (TypeError, KeyError):
+        import nibabel as nb
+        data = nb.load(filename).get_data()
+        data = data.reshape(data.shape[:3] + (-1,))
+        for t in range(data.shape[3]):
+            yield np.asarray(data[..., t], dtype=np.float64)
+        return
+
+    shape = (list(info['shape']) + [1, 1, 1])[:3]
+    frames = int(np.prod(info['shape'][3:])) if len(info['shape']) > 3 else 1
+    nbytes = int(np.prod(shape)) * dtype.itemsize
+    slope, inter = info['scl_slope'], info['scl_inter']
+    scale = not (slope == 0 or np.isnan(slope) or (slope == 1 and inter == 0))
+
+    if filename.endswith('.gz'):
+        fp = gzip.open(filename, 'rb')
+    else:
+        fp = open(filename, 'rb')
+    try:
+        fp.seek(info['vox_offset'])
+        for t in range(frames):
+            buf = fp.read(nbytes)
+            if len(buf) < nbytes:
+                raise IOError('%s is truncated at volume %d' % (filename, t))
+            vol = np.frombuffer(buf, dtype).reshape(shape, order='F')
+            vol = vol.astype(np.float64)
+            if scale:
+                vol = vol * slope + inter
+            yield vol
+    finally:
+        fp.close()
+
+
+def time_slice_diffs(filename, slice_axis=2):
+    """Time series difference diagnostics, streamed two volumes at a time
+
+    Computes the same metrics as nipy's time_slice_diffs without loading the
+    whole series.
+
+    Parameters
+    ----------
+    filename : 4D image
+    slice_axis : axis of the acquisition slices. Default = 2
+
+    Returns
+    -------
+    dict : volume_means (T), volume_mean_diff2 (T-1), slice_mean_diff2
+           (T-1 x slices), diff2_mean_vol (mean squared difference image)
+           and slice_diff2_max_vol (each slice taken from the difference
+           with the largest mean for that slice)
+    """
+    volume_means = []
+    volume_mean_diff2 = []
+    slice_mean_diff2 = []
+    diff2_sum = None
+    max_vol = None
+    slice_max = None
+    previous = None
+    for vol in iter_volumes(filename):
+        volume_means.append(vol.mean())
+        if previous is not None:
+            diff2 = (vol - previous) ** 2
+            volume_mean_diff2.append(diff2.mean())
+            other = tuple([i for i in range(3) if i != slice_axis])
+            slice_diff2 = diff2.mean(axis=other)
+            slice_mean_diff2.append(slice_diff2)
+            if diff2_sum is None:
+                diff2_sum = diff2
+                max_vol = diff2.copy()
+                slice_max = slice_diff2.copy()
+            else:
+                diff2_sum += diff2
+                larger = slice_diff2 > slice_max
+                slice_max[larger] = slice_diff2[larger]
+                index = [slice(None)] * 3
+                index[slice_axis] = larger
+                max_vol[tuple(index)] = diff2[tuple(index)]
+        previous = vol
+    if diff2_sum is None:
+        raise ValueError('%s needs at least two volumes' % filename)
+    return dict(volume_means=np.array(volume_means),
+                volume_mean_diff2=np.array(volume_mean_diff2),
+                slice_mean_diff2=np.array(slice_mean_diff2),
+                diff2_mean_vol=(diff2_sum /
+                                len(volume_mean_diff2)).astype(np.float32),
+                slice_diff2_max_vol=max_vol.astype(np.float32))
+
+
+def save_metrics(metrics, filename):
+    """Write tsdiff metrics to a compressed .npz file"""
+    np.savez_compressed(filename, **dict([(key, metrics[key])
+                                          for key in METRICS]))
+    return filename
+
+
+def load_metrics(filename):
+    """Read tsdiff metrics written by save_metrics"""
+    npz = np.load(filename)
+    try:
+        return dict([(key, npz[key]) for key in METRICS])
+    finally:
+        npz.close()
+
+
+def plot_tsdiffs(metrics, out_file, title=None, dpi=300):
+    """Plot tsdiff metrics like nipy's plot_tsdiffs
+
+    Parameters
+    ----------
+    metrics : dict from time_slice_diffs or an .npz from save_metrics
+    out_file : image to write
+    title : optional title of the top panel
+    dpi : resolution of out_file. Default = 300
+    """
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    if not isinstance(metrics, dict):
+        metrics = load_metrics(metrics)
+    mean_means = np.mean(metrics['volume_means'])
+    scaled_slice_diff = metrics['slice_mean_diff2'] / mean_means
+
+    fig, axes = plt.subplots(4, 1, figsize=(8, 10))
+    axes[0].plot(metrics['volume_mean_diff2'] / mean_means)
+    axes[0].set_ylabel('Scaled variance')
+    if title:
+        axes[0].set_title(title)
+    axes[1].plot(scaled_slice_diff, 'x')
+    axes[1].set_ylabel('Slice by slice variance')
+    axes[2].plot(metrics['volume_means'] / mean_means)
+    axes[2].set_ylabel('Scaled mean \n voxel intensity')
+    axes[3].plot(np.max(scaled_slice_diff, axis=1), 'k-', label='max')
+    axes[3].plot(np.mean(scaled_slice_diff, axis=1), 'b-', label='mean')
+    axes[3].plot(np.min(scaled_slice_diff, axis=1), 'g-', label='min')
+    axes[3].set_ylabel('Max/mean/min \n slice variation')
+    axes[3].set_xlabel('Difference image number')
+    axes[3].legend(loc='upper right')
+    fig.savefig(out_file, dpi=dpi)
+    plt.close(fig)
+    return out_file